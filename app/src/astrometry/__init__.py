@@ -1 +1,2 @@
-from .wcs import get_center_coords
+from .wcs import get_center_coords, read_wcs, write_wcs, wcs_cards
+from .cache import SolveCache, get_solve_cache, image_fingerprint
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import threading
+from typing import Optional
+
+import numpy as np
+from astropy.io import fits
+
+from .wcs import read_wcs, write_wcs
+from ..sequence import FrameView, open_frame, existing_file
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Plate solutions cached by image fingerprint
+
+A solution is stored as a .wcs file (the solution cards in an empty FITS
+header, like astrometry.net writes) named after a fingerprint of the image:
+a hash of its pixel data, whatever its header says, and of the optics it
+was solved with (focal length and pixel size, FOCALLEN / XPIXSZ of the
+header when not given). The same stack solved again, on any run, is
+answered by copying the cached solution into its header.
+
+Usage:
+    cache = get_solve_cache()
+    key = cache.key("stacked.fit", focal=400)
+    if not cache.apply(key, "stacked.fit"):
+        ...  # plate solve stacked.fit
+        cache.store(key, "stacked.fit")
+"""
+
+SOLVE_CACHE = os.getenv('SOLVE_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'siril-auto-stacker', 'solve'))
+
+# Rows hashed at a time, bounds the memory used on large stacks
+HASH_ROWS = 256
+
+
+def view_fingerprint(view: FrameView) -> str:
+    """
+    Hash of the stored pixel values of an image
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{view.shape} {view.dtype.str} {view.bscale} {view.bzero}".encode())
+
+    for channel in range(view.shape[0]):
+        for row in range(0, view.shape[1], HASH_ROWS):
+            h.update(np.ascontiguousarray(view.stored((channel, slice(row, row + HASH_ROWS)))).data)
+
+    return h.hexdigest()
+
+
+def image_fingerprint(path: str) -> str:
+    """
+    Hash of the stored pixel values of the image of a FITS file
+    """
+    view = open_frame(existing_file(path))
+    try:
+        return view_fingerprint(view)
+    finally:
+        view.close()
+
+
+class SolveCache:
+    def __init__(self, directory: str = SOLVE_CACHE) -> None:
+        self.logger = Logger
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path: str, focal: Optional[float] = None, pixelsize: Optional[float] = None) -> str:
+        view = open_frame(existing_file(path))
+        try:
+            focal = focal if focal is not None else view.header.get('FOCALLEN')
+            pixelsize = pixelsize if pixelsize is not None else view.header.get('XPIXSZ')
+            fingerprint = view_fingerprint(view)
+        finally:
+            view.close()
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{fingerprint} {focal} {pixelsize}".encode())
+        return h.hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.wcs")
+
+    def get(self, key: str) -> Optional[fits.Header]:
+        if not os.path.isfile(self._file(key)):
+            return None
+        try:
+            return read_wcs(self._file(key))
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable plate solution {self._file(key)}: {e}")
+            return None
+
+    def put(self, key: str, wcs: fits.Header):
+        tmp = f"{self._file(key)}.tmp"
+        fits.PrimaryHDU(header=wcs).writeto(tmp, overwrite=True, output_verify='silentfix')
+        os.replace(tmp, self._file(key))
+
+    def apply(self, key: str, path: str) -> bool:
+        """
+        Writes the cached solution of `key` in the header of `path`,
+        False when there is none
+        """
+        wcs = self.get(key)
+        if wcs is None:
+            return False
+        write_wcs(existing_file(path), wcs)
+        self.logger.info(f"Plate solution of {os.path.basename(path)} from the cache ({key})")
+        return True
+
+    def store(self, key: str, path: str) -> bool:
+        """
+        Caches the solution in the header of `path`, False when it has none
+        """
+        wcs = read_wcs(existing_file(path))
+        if wcs is None:
+            return False
+        self.put(key, wcs)
+        return True
+
+
+_cache: Optional[SolveCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_solve_cache() -> SolveCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SolveCache()
+    return _cache
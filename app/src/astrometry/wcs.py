@@ -1,17 +1,89 @@
-import subprocess
+import re
+from typing import Optional
 
+from astropy.io import fits
+from astropy.wcs import WCS
 
-def get_center_coords(wcsfile):
+from ..logger import Logger as _Logger
 
-    wcs = subprocess.run(['wcsinfo', wcsfile],
-                         stdout=subprocess.PIPE, universal_newlines=True)
-    ra = None
-    dec = None
-    
-    for line in wcs.stdout.split("\n"):
-        if "ra_center " in line:
-            ra = line.split(" ")[1].strip()
-        if "dec_center " in line:
-            dec = line.split(" ")[1].strip()
+Logger = _Logger(__name__)
 
-    return ra, dec if ra and dec else None
+"""
+WCS of plate solved images, read and written in-process
+
+Works on astrometry.net .wcs files (a header without data) and on the
+header of any FITS image Siril saved after a plate solve:
+
+    ra, dec = get_center_coords("stacked.wcs")   # decimal degrees
+    wcs = read_wcs("stacked.fit")                # the solution cards only
+    write_wcs("other.fit", wcs)                  # replaces its solution
+"""
+
+# Cards of a plate solution: the WCS, its SIP distortion and Siril's flag
+WCS_KEYWORDS = re.compile(
+    r"^(WCSAXES|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CDELT\d|CROTA\d|CD\d_\d|PC\d_\d|"
+    r"EQUINOX|RADESYS|LONPOLE|LATPOLE|(A|B|AP|BP)_(ORDER|\d+_\d+)|PLTSOLVD)$")
+
+
+def _solved_hdu(hdul: fits.HDUList) -> Optional[int]:
+    for index, hdu in enumerate(hdul):
+        if 'CTYPE1' in hdu.header and 'CRVAL1' in hdu.header:
+            return index
+    return None
+
+
+def _image_hdu(hdul: fits.HDUList) -> int:
+    for index, hdu in enumerate(hdul):
+        if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2:
+            return index
+    return 0
+
+
+def wcs_cards(header: fits.Header) -> fits.Header:
+    """
+    The plate solution cards of a header
+    """
+    return fits.Header([card for card in header.cards if WCS_KEYWORDS.match(card.keyword)])
+
+
+def read_wcs(path: str) -> Optional[fits.Header]:
+    """
+    Plate solution of a .wcs file or FITS image, None when it has none
+    """
+    with fits.open(path) as hdul:
+        index = _solved_hdu(hdul)
+        return wcs_cards(hdul[index].header) if index is not None else None
+
+
+def write_wcs(path: str, wcs: fits.Header):
+    """
+    Replaces the plate solution in the header of a FITS image
+    """
+    with fits.open(path, mode='update', do_not_scale_image_data=True) as hdul:
+        header = hdul[_image_hdu(hdul)].header
+        for keyword in [k for k in header.keys() if WCS_KEYWORDS.match(k)]:
+            del header[keyword]
+        header.update(wcs)
+
+
+def get_center_coords(wcsfile) -> tuple[Optional[float], Optional[float]]:
+    """
+    RA and DEC (decimal degrees) of the center of a solved image, what
+    wcsinfo reports as ra_center / dec_center. (None, None) when unsolved
+    """
+    try:
+        with fits.open(wcsfile) as hdul:
+            index = _solved_hdu(hdul)
+            if index is None:
+                return None, None
+            header = hdul[index].header
+            # .wcs files have no data, astrometry.net records the image size
+            width = header.get('IMAGEW', header.get('NAXIS1'))
+            height = header.get('IMAGEH', header.get('NAXIS2'))
+
+            ra, dec = WCS(wcs_cards(header), naxis=2, relax=True).all_pix2world(
+                (width - 1) / 2, (height - 1) / 2, 0)
+            return float(ra), float(dec)
+    except Exception as e:
+        Logger.warning(f"Failed to read the WCS of {wcsfile}: {e}")
+        return None, None
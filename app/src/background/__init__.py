@@ -0,0 +1 @@
+from .extractor import BackgroundExtractor, background_backend, extract_background, native_output_file, remove_gradient
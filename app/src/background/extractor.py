@@ -0,0 +1,316 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+from astropy.io import fits
+
+from ..graxpert import graxpert
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Background gradient extraction in-process, without GraXpert
+
+The image is cut into a grid of boxes (`grid` boxes along its short side).
+Every box is read with a stride, about SAMPLES x SAMPLES pixels of it,
+and its stars are sigma-clipped away: its background is the median of
+what is left. Boxes that lost too many pixels to clipping (a bright star,
+the core of a galaxy) or that stand out of the fitted surface are dropped,
+and a smooth surface is fitted on the rest:
+
+    polynomial  least squares polynomial of x and y of degree `degree`
+    rbf         thin plate spline through the boxes, `smoothing` trades
+                exactness for smoothness like GraXpert's smoothing
+
+The polynomial is evaluated at full resolution in tiles of TILE_ROWS rows,
+the spline on a lattice of one point every RBF_STEP pixels then resized to
+the image. The surface is subtracted (the median sky level is kept) or the
+image is divided by it (then scaled back to the median sky level).
+
+BACKGROUND_BACKEND picks what remove_gradient runs: graxpert (default) or
+native, with the BACKGROUND_METHOD surface (rbf by default).
+
+Usage:
+    output = extract_background("starless.fit", method='rbf', smoothing=0.1)
+
+    extractor = BackgroundExtractor(grid=24, method='polynomial', degree=3)
+    corrected = extractor.correct(data)    # (channels, height, width) or (height, width)
+"""
+
+METHODS = ['polynomial', 'rbf']
+CORRECTIONS = ['subtraction', 'division']
+
+# Pixels read along each side of a box
+SAMPLES = 32
+
+# Rows of the image evaluated at a time
+TILE_ROWS = 256
+
+# Pixels between the lattice points the spline is evaluated on
+RBF_STEP = 16
+
+# Boxes that lost more of their pixels to clipping are on a bright object
+MAX_CLIPPED = 0.5
+
+
+def background_backend() -> str:
+    backend = os.getenv('BACKGROUND_BACKEND', 'graxpert')
+    if backend not in ['graxpert', 'native']:
+        raise Exception(f"Unknown BACKGROUND_BACKEND: {backend}")
+    return backend
+
+
+def _mad_sigma(values: np.ndarray, axis=None, keepdims=False) -> tuple[np.ndarray, np.ndarray]:
+    median = np.nanmedian(values, axis=axis, keepdims=True)
+    sigma = 1.4826 * np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    if not keepdims:
+        median, sigma = np.squeeze(median, axis=axis), np.squeeze(sigma, axis=axis)
+    return median, sigma
+
+
+def _thin_plate(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """
+    r**2 * log(r) between every point and every center
+    """
+    r2 = (points ** 2).sum(axis=1)[:, None] + (centers ** 2).sum(axis=1)[None] - 2 * points @ centers.T
+    r2 = np.maximum(r2, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r2 > 0, 0.5 * r2 * np.log(r2), 0)
+
+
+class BackgroundExtractor:
+    def __init__(self,
+                 grid: int = 24,
+                 method: str = 'polynomial',
+                 degree: int = 3,
+                 smoothing: float = 0.1,
+                 correction: str = 'subtraction',
+                 sigma: float = 2.5,
+                 iterations: int = 3) -> None:
+        """
+        grid: boxes along the short side of the image
+        sigma: clipping of the stars in a box, and of the boxes off the surface
+        """
+        if method not in METHODS:
+            raise Exception(f"Unknown background method: {method}")
+        if correction not in CORRECTIONS:
+            raise Exception(f"Unknown background correction: {correction}")
+
+        self.logger = Logger
+        self.grid = grid
+        self.method = method
+        self.degree = degree
+        self.smoothing = smoothing
+        self.correction = correction
+        self.sigma = sigma
+        self.iterations = iterations
+
+    def samples(self, channel: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Box centers (y, x in pixels) and background level of the boxes
+        without bright objects
+        """
+        height, width = channel.shape
+        box = max(min(height, width) // self.grid, 1)
+        step = max(box // SAMPLES, 1)
+        per_box = box // step
+        box = per_box * step
+        rows, cols = height // box, width // box
+        # The grid is centered, the margins left out are under a box
+        top, left = (height - rows * box) // 2, (width - cols * box) // 2
+
+        blocks = channel[top:top + rows * box:step, left:left + cols * box:step].astype(np.float32)\
+            .reshape(rows, per_box, cols, per_box).swapaxes(1, 2).reshape(rows, cols, -1)
+
+        for _ in range(self.iterations):
+            median, sigma = _mad_sigma(blocks, axis=-1, keepdims=True)
+            blocks = np.where(np.abs(blocks - median) > self.sigma * np.maximum(sigma, 1e-12), np.nan, blocks)
+
+        clipped = np.isnan(blocks).mean(axis=-1)
+        with np.errstate(all='ignore'):
+            levels = np.nanmedian(blocks, axis=-1)
+
+        ys = top + (np.arange(rows) + 0.5) * box
+        xs = left + (np.arange(cols) + 0.5) * box
+        ys, xs = np.meshgrid(ys, xs, indexing='ij')
+
+        keep = (clipped <= MAX_CLIPPED) & np.isfinite(levels)
+        return ys[keep], xs[keep], levels[keep]
+
+    def _polynomial(self, ys: np.ndarray, xs: np.ndarray, values: np.ndarray, shape: tuple[int, int]):
+        """
+        Coefficients C of the polynomial sum(C[j, i] * x**i * y**j), x and y in [-1, 1]
+        """
+        height, width = shape
+        u, v = 2 * xs / width - 1, 2 * ys / height - 1
+        terms = [(i, j) for j in range(self.degree + 1) for i in range(self.degree + 1 - j)]
+        A = np.stack([u ** i * v ** j for i, j in terms], axis=1)
+        solution, *_ = np.linalg.lstsq(A, values, rcond=None)
+
+        coefficients = np.zeros((self.degree + 1, self.degree + 1))
+        for (i, j), c in zip(terms, solution):
+            coefficients[j, i] = c
+        return coefficients
+
+    def _evaluate_polynomial(self, coefficients: np.ndarray, shape: tuple[int, int],
+                             rows: Optional[slice] = None, points: Optional[tuple] = None) -> np.ndarray:
+        height, width = shape
+        powers = np.arange(self.degree + 1)
+        if points is not None:
+            u, v = 2 * points[1] / width - 1, 2 * points[0] / height - 1
+            return np.einsum('ni,ji,nj->n', u[:, None] ** powers, coefficients, v[:, None] ** powers)
+
+        # Separable: the rows of the tile by the columns of the image
+        y = 2 * (np.arange(height)[rows] + 0.5) / height - 1
+        x = 2 * (np.arange(width) + 0.5) / width - 1
+        return ((y[:, None] ** powers) @ coefficients @ (x[:, None] ** powers).T).astype(np.float32)
+
+    def _spline(self, ys: np.ndarray, xs: np.ndarray, values: np.ndarray, shape: tuple[int, int]):
+        """
+        Weights and affine part of the thin plate spline, coordinates in units of the long side
+        """
+        scale = max(shape)
+        points = np.stack([ys, xs], axis=1) / scale
+        n = len(points)
+
+        K = _thin_plate(points, points)
+        # Regularisation in units of a tenth of the average kernel value,
+        # GraXpert's 0.1 still follows gradients a few boxes wide
+        K[np.diag_indices(n)] += self.smoothing * max(np.abs(K).mean(), 1e-12) / 10
+        P = np.hstack([np.ones((n, 1)), points])
+
+        system = np.block([[K, P], [P.T, np.zeros((3, 3))]])
+        solution = np.linalg.solve(system, np.concatenate([values, np.zeros(3)]))
+        return points, solution[:n], solution[n:]
+
+    def _evaluate_spline(self, spline, points: np.ndarray, scale: int) -> np.ndarray:
+        centers, weights, affine = spline
+        points = points / scale
+        values = np.empty(len(points))
+        for start in range(0, len(points), 4096):
+            chunk = points[start:start + 4096]
+            values[start:start + 4096] = _thin_plate(chunk, centers) @ weights + affine[0] + chunk @ affine[1:]
+        return values
+
+    def fit(self, channel: np.ndarray):
+        """
+        Surface of the background of a channel, the boxes far from the
+        first fit are dropped before the second
+        """
+        ys, xs, values = self.samples(channel)
+        needed = (self.degree + 1) * (self.degree + 2) // 2 if self.method == 'polynomial' else 4
+        if len(values) < needed:
+            raise Exception(f"Only {len(values)} background boxes, {needed} needed")
+
+        for attempt in range(2):
+            if self.method == 'polynomial':
+                surface = self._polynomial(ys, xs, values, channel.shape)
+                fitted = self._evaluate_polynomial(surface, channel.shape, points=(ys, xs))
+            else:
+                surface = self._spline(ys, xs, values, channel.shape)
+                fitted = self._evaluate_spline(surface, np.stack([ys, xs], axis=1), max(channel.shape))
+
+            if attempt == 1:
+                break
+            residuals = values - fitted
+            median, sigma = _mad_sigma(residuals)
+            keep = np.abs(residuals - median) <= self.sigma * max(float(sigma), 1e-12)
+            if keep.sum() < needed or keep.all():
+                break
+            ys, xs, values = ys[keep], xs[keep], values[keep]
+
+        self.logger.debug(f"Background fitted on {len(values)} boxes ({self.method})")
+        return surface
+
+    def _lattice(self, spline, shape: tuple[int, int]) -> np.ndarray:
+        """
+        The spline on a lattice of RBF_STEP pixels, resized to the image
+        """
+        height, width = shape
+        # Lattice point k is at the center of the k-th RBF_STEP pixels, where resize puts it
+        ys = (np.arange(-(-height // RBF_STEP)) + 0.5) * RBF_STEP
+        xs = (np.arange(-(-width // RBF_STEP)) + 0.5) * RBF_STEP
+        points = np.stack(np.meshgrid(ys, xs, indexing='ij'), axis=-1).reshape(-1, 2)
+        lattice = self._evaluate_spline(spline, points, max(shape)).reshape(len(ys), len(xs)).astype(np.float32)
+        full = cv.resize(lattice, (len(xs) * RBF_STEP, len(ys) * RBF_STEP), interpolation=cv.INTER_LINEAR)
+        return full[:height, :width]
+
+    def correct_channel(self, channel: np.ndarray) -> np.ndarray:
+        surface = self.fit(channel)
+        # The spline is resized from its lattice, the polynomial evaluated tile by tile
+        lattice = self._lattice(surface, channel.shape) if self.method == 'rbf' else None
+
+        def background(rows: slice) -> np.ndarray:
+            if lattice is not None:
+                return lattice[rows]
+            return self._evaluate_polynomial(surface, channel.shape, rows=rows)
+
+        out = np.empty(channel.shape, dtype=np.float32)
+        for row in range(0, channel.shape[0], TILE_ROWS):
+            rows = slice(row, row + TILE_ROWS)
+            if self.correction == 'subtraction':
+                out[rows] = channel[rows] - background(rows)
+            else:
+                out[rows] = channel[rows] / np.maximum(background(rows), 1e-12)
+
+        # Back to the sky level of the image
+        level = float(np.median(background(slice(None, None, RBF_STEP))[:, ::RBF_STEP]))
+        if self.correction == 'subtraction':
+            out += np.float32(level)
+        else:
+            out *= np.float32(level)
+        return out
+
+    def correct(self, data: np.ndarray) -> np.ndarray:
+        """
+        The image without its background gradient, float32
+        """
+        if data.ndim == 2:
+            return self.correct_channel(data)
+        return np.stack([self.correct_channel(channel) for channel in data])
+
+
+def native_output_file(file: str) -> str:
+    """
+    Where extract_background writes what it made of `file`
+    """
+    return f"{os.path.dirname(file)}/{Path(file).stem}_background.fits"
+
+
+def extract_background(file: str, output: Optional[str] = None, **kwargs) -> str:
+    """
+    Writes `file` without its background gradient as float32 FITS,
+    returns the path written (`kwargs` go to BackgroundExtractor)
+    """
+    output = output if output else native_output_file(file)
+    with fits.open(file) as hdul:
+        hdu = next(h for h in hdul if h.is_image and h.data is not None)
+        data = hdu.data
+        header = hdu.header.copy()
+
+    corrected = BackgroundExtractor(**kwargs).correct(data)
+
+    for key in ['BZERO', 'BSCALE']:
+        header.remove(key, ignore_missing=True)
+    tmp = f"{output}.tmp"
+    fits.PrimaryHDU(corrected, header=header).writeto(tmp, overwrite=True)
+    os.replace(tmp, output)
+    return output
+
+
+def remove_gradient(file: str, smoothing: float = 0.1, correction: str = 'subtraction', gpu: bool = False) -> str:
+    """
+    Background extraction of `file` by the BACKGROUND_BACKEND, returns
+    the file written
+    """
+    if background_backend() == 'native':
+        method = os.getenv('BACKGROUND_METHOD', 'rbf')
+        Logger.info(f"Native background extraction ({method}): {file}")
+        return extract_background(file, method=method, smoothing=smoothing, correction=correction)
+
+    Logger.info(f"GraXpert background extraction: {file}")
+    return graxpert(file, "background-extraction",
+                    ["-correction", correction.capitalize(), "-smoothing", str(smoothing), "-bg"], gpu=gpu)
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import argparse
+
+from pysiril.siril import *  # type: ignore
+from pysiril.wrapper import *  # type: ignore
+
+from .convert import convert
+from .screen import screen
+from .calibrate import calibrate
+from .register import register
+from .stack import stack
+from .postprocess import postprocess
+from .pool import get_siril
+from .logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Runs a whole recipe of stages in one process on one Siril session
+
+The recipe is a JSON file with a list of steps. Every step names a stage and
+the keyword arguments of its function (plus an optional "name" for the
+timing summary), environment variables in string values are expanded:
+
+    {
+        "steps": [
+            {"stage": "convert", "src": "$BASE_DIR/Flat", "fitseq": true},
+            {"stage": "calibrate", "seq": "$BASE_DIR/Flat/process/flats.fit",
+             "frame": "flats", "fitseq": true, "master_bias": "$MASTER_BIAS_FILE"},
+            {"stage": "stack", "seq": "$BASE_DIR/Flat/process/pp_flats.seq", "frame": "flats"}
+        ]
+    }
+
+Usage:
+    poetry run python -m src.batch recipe.json
+"""
+
+STAGES = {
+    "convert": convert,
+    "screen": screen,
+    "calibrate": calibrate,
+    "register": register,
+    "stack": stack,
+    "postprocess": postprocess,
+}
+
+
+def load_recipe(file: str) -> list[dict]:
+    with open(file, 'r') as f:
+        recipe = json.load(f)
+
+    steps = recipe['steps'] if isinstance(recipe, dict) else recipe
+
+    for i, step in enumerate(steps):
+        if step.get('stage') not in STAGES:
+            raise Exception(
+                f"Step {i + 1} has an unknown stage: {step.get('stage')} (expected one of {', '.join(STAGES)})")
+
+    return steps
+
+
+def _expand(value):
+    return os.path.expandvars(value) if isinstance(value, str) else value
+
+
+class BatchRunner:
+    def __init__(self, siril) -> None:
+        """
+        siril: pysiril Wrapper every step runs on
+        """
+        self.logger = Logger
+        self.siril = siril
+        # (step name, seconds, succeeded)
+        self.timings: list[tuple[str, float, bool]] = []
+
+    def run_step(self, step: dict):
+        kwargs = {k: _expand(v)
+                  for k, v in step.items() if k not in ['stage', 'name']}
+        stage = step['stage']
+        name = f"{stage} {step.get('name', os.path.basename(str(next(iter(kwargs.values()), ''))))}"
+
+        started = time.perf_counter()
+        success = False
+
+        try:
+            result = STAGES[stage](self.siril, **kwargs)
+            success = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings.append((name, elapsed, success))
+            self.logger.info(f"[{name}] Took {elapsed:.1f}s")
+
+    def run(self, steps: list[dict]):
+        for step in steps:
+            self.run_step(step)
+
+    def summary(self):
+        for name, elapsed, success in self.timings:
+            status = "done" if success else "failed"
+            self.logger.info(f"{status.upper():8} {elapsed:8.1f}s  {name}")
+
+        per_stage: dict[str, float] = {}
+        for name, elapsed, _ in self.timings:
+            stage = name.split(' ')[0]
+            per_stage[stage] = per_stage.get(stage, 0) + elapsed
+
+        for stage, elapsed in per_stage.items():
+            self.logger.info(f"{'TOTAL':8} {elapsed:8.1f}s  {stage}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('recipe', type=str, help="JSON recipe of stages to run")
+
+    args = parser.parse_args()
+    steps = load_recipe(args.recipe)
+
+    App = get_siril()
+    runner = BatchRunner(Wrapper(App))  # type: ignore
+
+    try:
+        App.Open()
+        runner.run(steps)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
+    finally:
+        runner.summary()
+        Logger.info("Siril Closed")
+        App.Close()
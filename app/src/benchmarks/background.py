@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+from astropy.io import fits
+
+from ..background import extract_background
+from ..graxpert import graxpert, get_graxpert_worker
+from .synthetic import SyntheticCamera
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Native background extraction vs GraXpert
+
+Renders a starless-like image: a flat sky, a gradient (linear, vignetting
+and a slow wave, different in every channel), the stars of SyntheticCamera
+and Gaussian noise. Every method extracts the background of the same file,
+and for each the benchmark reports:
+    - seconds of the first run (GraXpert starts and loads its model) and
+      the best of the others, file read and write included
+    - residual gradient: spread (1st to 99th percentile) of the box means
+      of what is left once the known stars are taken away, in percent of
+      the sky level. The input is reported as `input`
+
+GraXpert runs through the worker, GRAXPERT_RUNNER=stand-in measures the
+worker round trip without GraXpert. Methods that fail are reported with
+their error.
+
+Usage:
+    poetry run python -m src.benchmarks.background
+    poetry run python -m src.benchmarks.background --size=6000x4000 --methods polynomial rbf --out=background.json
+"""
+
+SKY = 1000
+NOISE = 10
+METHODS = ['polynomial', 'rbf', 'graxpert']
+
+# Boxes along the short side of the image the residual gradient is measured on
+RESIDUAL_BOXES = 40
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--size',
+                    required=False,
+                    type=str,
+                    default='3000x2000',
+                    dest="size",
+                    help="WIDTHxHEIGHT of the image")
+
+parser.add_argument('--channels',
+                    required=False,
+                    type=int,
+                    default=3,
+                    dest="channels",
+                    help="Channels of the image")
+
+parser.add_argument('--methods',
+                    required=False,
+                    nargs='+',
+                    default=METHODS,
+                    choices=METHODS,
+                    dest="methods",
+                    help="Background extractions to compare")
+
+parser.add_argument('--smoothing',
+                    required=False,
+                    type=float,
+                    default=0.1,
+                    dest="smoothing",
+                    help="Smoothing of the rbf and GraXpert extractions")
+
+parser.add_argument('--runs',
+                    required=False,
+                    type=int,
+                    default=3,
+                    dest="runs",
+                    help="Runs of every method")
+
+parser.add_argument('--out',
+                    required=False,
+                    type=str,
+                    default=None,
+                    dest="out",
+                    help="Write the results as JSON to this file")
+
+
+def synthetic_image(width: int, height: int, channels: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The image (channels, height, width) float32 and its stars alone
+    """
+    camera = SyntheticCamera(width, height, stars=max(width * height // 7500, 100))
+    rng = np.random.default_rng(0)
+    y = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
+    x = np.linspace(-1, 1, width, dtype=np.float32)[None, :]
+
+    image, stars = [], []
+    for channel in range(channels):
+        angle = rng.uniform(0, 2 * np.pi)
+        gradient = 0.3 * (np.cos(angle) * x + np.sin(angle) * y) + \
+            0.2 * (x ** 2 + y ** 2) + 0.08 * np.sin(2 * x + channel) * np.cos(1.5 * y)
+        star = camera.star_image(1, channel + 1)
+        stars.append(star)
+        image.append(SKY * (1 + gradient) + star + NOISE * rng.standard_normal((height, width), dtype=np.float32))
+
+    return np.stack(image).astype(np.float32), np.stack(stars)
+
+
+def residual_gradient(image: np.ndarray, stars: np.ndarray) -> float:
+    """
+    Spread of the box means of the background left, percent of the sky
+    """
+    spreads = []
+    for channel in image - stars:
+        box = min(channel.shape) // RESIDUAL_BOXES
+        rows, cols = channel.shape[0] // box, channel.shape[1] // box
+        means = channel[:rows * box, :cols * box].reshape(rows, box, cols, box).mean(axis=(1, 3))
+        spreads.append(np.percentile(means, 99) - np.percentile(means, 1))
+    return round(float(max(spreads)) / SKY * 100, 3)
+
+
+def _extract(method: str, file: str, smoothing: float) -> str:
+    if method == 'graxpert':
+        return graxpert(file, "background-extraction",
+                        ["-correction", "Subtraction", "-smoothing", str(smoothing), "-bg"])
+    return extract_background(file, method=method, smoothing=smoothing)
+
+
+def run(image: np.ndarray, stars: np.ndarray, methods: list[str], smoothing: float, runs: int) -> list[dict]:
+    directory = tempfile.mkdtemp(prefix="background-bench-")
+    try:
+        file = os.path.join(directory, "starless.fits")
+        fits.PrimaryHDU(image).writeto(file)
+
+        results = [{"method": "input", "residual_pct": residual_gradient(image, stars)}]
+        for method in methods:
+            result: dict = {"method": method}
+            if method == 'graxpert' and os.getenv('GRAXPERT_WORKER', '1') != '0':
+                result["runner"] = get_graxpert_worker().runner
+            try:
+                times = []
+                for _ in range(max(runs, 1)):
+                    started = time.perf_counter()
+                    output = _extract(method, file, smoothing)
+                    times.append(time.perf_counter() - started)
+
+                result["first_s"] = round(times[0], 3)
+                result["seconds"] = round(min(times[1:] if len(times) > 1 else times), 3)
+                result["residual_pct"] = residual_gradient(fits.getdata(output).astype(np.float32), stars)
+                os.remove(output)
+            except Exception as e:
+                Logger.warning(f"{method} failed: {e}")
+                result["error"] = str(e)
+            results.append(result)
+
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    try:
+        width, height = [int(n) for n in args.size.lower().split('x')]
+        image, stars = synthetic_image(width, height, args.channels)
+        Logger.info(f"Benchmarking background extraction on {image.shape}")
+
+        results = run(image, stars, args.methods, args.smoothing, args.runs)
+        for r in results:
+            if 'error' in r:
+                Logger.info(f"{r['method']:<12} failed: {r['error']}")
+            elif r['method'] == 'input':
+                Logger.info(f"{r['method']:<12} residual gradient {r['residual_pct']}%")
+            else:
+                Logger.info(
+                    f"{r['method']:<12} {r['seconds']:>8}s (first {r['first_s']}s) "
+                    f"residual gradient {r['residual_pct']}%")
+
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=1)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+from typing import Optional
+
+import numpy as np
+
+from ..sequence import SequenceReader, open_frame, write_image
+from ..sequence.compression import CODECS
+from ..stacking import StackEngine
+from .synthetic import SyntheticCamera
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Plain vs tile-compressed FITS for intermediate sequences
+
+Writes the same frames once per codec and reports, for each:
+    - bytes on disk and the ratio to plain FITS
+    - write throughput (MB of image per second, compression included)
+    - full frame read throughput (decompression included, page cache warm)
+    - throughput of reading the frames tile by tile as StackEngine does
+      (squares, or full-width bands of compressed frames)
+    - read time of the whole sequence at --disk-mbps, the slower of the
+      disk and the decompression
+Every compressed frame is read back and compared with the original.
+
+Usage:
+    poetry run python -m src.benchmarks.compression /data/lights/process/pp_lights_.seq
+    poetry run python -m src.benchmarks.compression --synthetic=20 --disk-mbps=350 --out=compression.json
+"""
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('seq', type=str, nargs='?', default=None,
+                    help="Sequence (.seq or FITS sequence) to benchmark on, synthetic frames without one")
+
+parser.add_argument('--synthetic',
+                    required=False,
+                    type=int,
+                    default=10,
+                    dest="synthetic",
+                    help="Number of synthetic 16-bit CFA frames when no sequence is given")
+
+parser.add_argument('--frames',
+                    required=False,
+                    type=int,
+                    default=10,
+                    dest="frames",
+                    help="Frames of the sequence to benchmark on")
+
+parser.add_argument('--codecs',
+                    required=False,
+                    nargs='+',
+                    default=['none', 'rice', 'hcompress'],
+                    choices=['none'] + list(CODECS),
+                    dest="codecs",
+                    help="Codecs to compare, none is plain FITS")
+
+parser.add_argument('--disk-mbps',
+                    required=False,
+                    type=float,
+                    default=350,
+                    dest="disk_mbps",
+                    help="Sequential throughput of the process disk (a USB SSD does ~350MB/s)")
+
+parser.add_argument('--out',
+                    required=False,
+                    type=str,
+                    default=None,
+                    dest="out",
+                    help="Writes the results as JSON")
+
+
+def sequence_frames(seq: str, count: int) -> list[np.ndarray]:
+    process_dir = os.path.dirname(os.path.abspath(seq))
+    name = os.path.basename(seq).split('.')[0]
+    reader = SequenceReader(process_dir, name)
+
+    frames = []
+    for view in reader.frames()[:count]:
+        data = view.physical()
+        frames.append(data.astype(np.uint16) if view.integer else data)
+    reader.close()
+    return frames
+
+
+def benchmark(frames: list[np.ndarray], codec: Optional[str], directory: str, disk_mbps: float) -> dict:
+    size = sum(f.nbytes for f in frames) / 1e6
+    paths = [os.path.join(directory, f"bench_{i:05d}.fit") for i in range(len(frames))]
+
+    start = time.perf_counter()
+    written = [write_image(path, frame, codec=codec if codec else '')
+               for path, frame in zip(paths, frames)]
+    write_time = time.perf_counter() - start
+    on_disk = sum(os.path.getsize(f) for f in written)
+
+    start = time.perf_counter()
+    for path, frame in zip(written, frames):
+        view = open_frame(path)
+        data = view.physical()
+        view.close()
+        if not np.array_equal(data.reshape(frame.shape), frame):
+            raise Exception(f"{codec} did not round-trip {path}")
+    read_time = time.perf_counter() - start
+
+    views = [open_frame(f) for f in written]
+    height, width = views[0].shape[1:]
+    tiles = StackEngine(written, {}).tiles(height, width, views[0].tile_rows)
+    start = time.perf_counter()
+    for view in views:
+        for y0, y1, x0, x1 in tiles:
+            view[:, y0:y1, x0:x1]
+    tile_time = time.perf_counter() - start
+    for view in views:
+        view.close()
+
+    return {
+        "codec": CODECS[codec] if codec else "none",
+        "frames": len(frames),
+        "image_mb": round(size, 1),
+        "disk_mb": round(on_disk / 1e6, 1),
+        "ratio": round(size * 1e6 / on_disk, 2),
+        "write_mbps": round(size / write_time, 1),
+        "read_mbps": round(size / read_time, 1),
+        "tile_read_mbps": round(size / tile_time, 1),
+        # Reading from the disk and decompressing overlap, the slower one wins
+        "read_s_at_disk": round(max(on_disk / 1e6 / disk_mbps, read_time), 2),
+    }
+
+
+def run(frames: list[np.ndarray], codecs: list[str], disk_mbps: float) -> list[dict]:
+    directory = tempfile.mkdtemp(prefix="compression-benchmark-")
+    try:
+        return [benchmark(frames, None if codec == 'none' else codec, directory, disk_mbps)
+                for codec in codecs]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    try:
+        camera = SyntheticCamera()
+        frames = sequence_frames(args.seq, args.frames) if args.seq else \
+            [camera.render('lights', index=i + 1) for i in range(args.synthetic)]
+        Logger.info(
+            f"Benchmarking {len(frames)} frames of {frames[0].shape} {frames[0].dtype}")
+
+        results = run(frames, args.codecs, args.disk_mbps)
+        for r in results:
+            Logger.info(
+                f"{r['codec']:<12} {r['disk_mb']:>8}MB x{r['ratio']:<5} write {r['write_mbps']:>7}MB/s "
+                f"read {r['read_mbps']:>7}MB/s tiles {r['tile_read_mbps']:>7}MB/s "
+                f"{r['read_s_at_disk']}s at {args.disk_mbps:g}MB/s")
+
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=1)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
@@ -0,0 +1,508 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+import platform
+import multiprocessing
+from typing import Callable, Optional
+
+from pysiril.wrapper import *  # type: ignore
+
+from ..siril import Frame, Session, SirilWrapper, PostProcess
+from ..siril import stages
+from ..siril.instance import set_compression
+from ..siril.preprocess import calibrate, screen, get_calibrate_backend
+from ..calibration import CalibrationEngine
+from ..sequence import included_frames
+from ..pool import get_siril
+from .synthetic import SyntheticCamera, SyntheticSession
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+End-to-end pipeline benchmark on synthetic sessions
+
+For every dataset size (frames x width x height) a SyntheticSession is
+written to a temporary working directory, then the stages of the pipeline
+run on it one after the other, each in a forked process:
+
+    masters     biases, darks and flats stacked, flats calibrated first
+    screen      quality screening of the lights of every night
+    calibrate   lights of every night
+    merge       nights merged (multi-night datasets)
+    register
+    stack
+    nebula      PostProcess.nebula on the stack (--nebula, needs Siril,
+                Starnet++ and GraXpert)
+
+Every stage reports its wall time, the frames and MB it read (frames/s,
+MB/s) and the peak RSS of its process and of its largest child (worker
+pool, Siril). Stages use the *_BACKEND settings of the environment, or
+--backend for all of them; Siril stages lease an instance like the CLIs do
+(SIRIL_POOL_SOCKET).
+
+Results are compared with --baseline (JSON written by --save-baseline):
+a stage slower or larger than the baseline by more than --tolerance is a
+regression, and the exit code is 1.
+
+Usage:
+    poetry run python -m src.benchmarks.pipeline --sizes 10x1500x1000 30x3000x2000
+    poetry run python -m src.benchmarks.pipeline --nights=2 --backend=native --baseline=benchmarks.json
+    poetry run python -m src.benchmarks.pipeline --save-baseline=benchmarks.json
+"""
+
+STAGES = ['masters', 'screen', 'calibrate', 'merge', 'register', 'stack', 'nebula']
+
+# Backend settings of the stages, see stages.get_backend
+BACKEND_STAGES = ['calibrate', 'merge', 'register', 'stack']
+
+# Session layout when the environment doesn't give one
+SESSION_ENV = {
+    'BIASES_NAME': 'biases',
+    'DARKS_NAME': 'darks',
+    'FLATS_NAME': 'flats',
+    'LIGHTS_NAME': 'lights',
+    'BIASES_DIR_NAME': 'Bias',
+    'DARKS_DIR_NAME': 'Dark',
+    'FLATS_DIR_NAME': 'Flat',
+    'LIGHTS_DIR_NAME': 'Light',
+    'PROCESS_DIR_NAME': 'process',
+    'BIASES_STACKED_PREFIX': 'stacked_',
+    'DARKS_STACKED_PREFIX': 'stacked_',
+    'FLATS_STACKED_PREFIX': 'stacked_pp_',
+    'LIGHTS_STACKED_PREFIX': 'stacked_r_pp_',
+    'PREPROCESS_PREFIX': 'pp_',
+    'REGISTERED_PREFIX': 'r_',
+    'FITS_EXTENSION': 'fit',
+    'MULTINIGHT_DIR_NAME': 'night_',
+}
+
+# Metrics where higher is worse, compared with the baseline
+COMPARED = ['seconds', 'rss_mb', 'children_rss_mb']
+# Stages quicker than this are too noisy to flag
+MIN_COMPARED_SECONDS = 1.0
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--sizes',
+                    required=False,
+                    nargs='+',
+                    default=['8x1500x1000', '24x3000x2000'],
+                    dest="sizes",
+                    help="Datasets to benchmark, lights per night x width x height")
+
+parser.add_argument('--nights',
+                    required=False,
+                    type=int,
+                    default=1,
+                    dest="nights",
+                    help="Nights of lights, darks and flats")
+
+parser.add_argument('--calibration-frames',
+                    required=False,
+                    type=int,
+                    default=8,
+                    dest="calibration_frames",
+                    help="Biases, darks and flats per night")
+
+parser.add_argument('--stars',
+                    required=False,
+                    type=float,
+                    default=300,
+                    dest="stars",
+                    help="Stars per megapixel")
+
+parser.add_argument('--read-noise',
+                    required=False,
+                    type=float,
+                    default=8,
+                    dest="read_noise",
+                    help="Read noise in ADU")
+
+parser.add_argument('--dither',
+                    required=False,
+                    type=float,
+                    default=15,
+                    dest="dither",
+                    help="Dither between the frames of a night, in pixels")
+
+parser.add_argument('--hot-pixels',
+                    required=False,
+                    type=int,
+                    default=200,
+                    dest="hot_pixels",
+                    help="Hot pixels of the sensor")
+
+parser.add_argument('--gradient',
+                    required=False,
+                    type=float,
+                    default=0.2,
+                    dest="gradient",
+                    help="Change of the sky background across a light")
+
+parser.add_argument('--backend',
+                    required=False,
+                    type=str,
+                    default=None,
+                    choices=['siril', 'native'],
+                    dest="backend",
+                    help="Backend of every stage, the *_BACKEND environment otherwise")
+
+parser.add_argument('--stages',
+                    required=False,
+                    nargs='+',
+                    default=[s for s in STAGES if s != 'nebula'],
+                    choices=STAGES,
+                    dest="stages",
+                    help="Stages to run, in pipeline order")
+
+parser.add_argument('--nebula',
+                    required=False,
+                    action='store_true',
+                    default=False,
+                    dest="nebula",
+                    help="Also time PostProcess.nebula on the stack")
+
+parser.add_argument('--workdir',
+                    required=False,
+                    type=str,
+                    default=None,
+                    dest="workdir",
+                    help="Where datasets are written (and kept), a temporary directory otherwise")
+
+parser.add_argument('--baseline',
+                    required=False,
+                    type=str,
+                    default=None,
+                    dest="baseline",
+                    help="Results to compare with")
+
+parser.add_argument('--save-baseline',
+                    required=False,
+                    type=str,
+                    default=None,
+                    dest="save_baseline",
+                    help="Writes the results as the new baseline")
+
+parser.add_argument('--tolerance',
+                    required=False,
+                    type=float,
+                    default=0.15,
+                    dest="tolerance",
+                    help="Slowdown (or RSS growth) over the baseline that counts as a regression")
+
+
+def parse_size(size: str) -> tuple[int, int, int]:
+    try:
+        frames, width, height = [int(v) for v in size.lower().split('x')]
+    except ValueError:
+        raise Exception(f"Dataset sizes are frames x width x height, ie: 24x3000x2000, not {size}")
+    return frames, width, height
+
+
+def _rss_mb(maxrss: int) -> float:
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _run_stage(connection, task: Callable, siril: bool):
+    App = None
+    error = None
+    started = time.perf_counter()
+
+    try:
+        Siril = None
+        if siril:
+            App = get_siril()
+            if App.Open() is not True:
+                raise Exception("Failed to start Siril")
+            Siril = Wrapper(App)  # type: ignore
+            Siril.set16bits()
+            Siril.setext(os.environ['FITS_EXTENSION'])
+            set_compression(Siril)
+        task(Siril)
+    except Exception as e:
+        error = str(e)
+    finally:
+        if App is not None:
+            App.Close()
+
+    connection.send({
+        'seconds': time.perf_counter() - started,
+        'rss_mb': _rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        'children_rss_mb': _rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        'error': error,
+    })
+    connection.close()
+
+
+def measure(task: Callable, siril: bool = False) -> dict:
+    """
+    Runs task(Siril) in a forked process, so its peak RSS is its own
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage, args=(sender, task, siril))
+    process.start()
+    sender.close()
+
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': f"Stage process died ({process.exitcode})"}
+    process.join()
+
+    if result.get('error'):
+        raise Exception(result['error'])
+    return result
+
+
+def benchmark_session(working_dir: str, nights: int) -> Session:
+    def frame(kind: str) -> Frame:
+        return Frame(
+            name=os.environ[f'{kind}_NAME'],
+            dir=os.environ[f'{kind}_DIR_NAME'],
+            process_dir=os.environ['PROCESS_DIR_NAME'],
+            stacked_prefix=os.environ[f'{kind}_STACKED_PREFIX'],
+        )
+
+    return Session(biases=frame('BIASES'), darks=frame('DARKS'), flats=frame('FLATS'), lights=frame('LIGHTS'),
+                   working_dir=working_dir, multiple=nights > 1)
+
+
+class PipelineBenchmark:
+    def __init__(self, dataset: SyntheticSession, stages_to_run: list[str]) -> None:
+        self.logger = Logger
+        self.dataset = dataset
+        self.session = dataset.session
+        self.stages = [s for s in STAGES if s in stages_to_run]
+        self.fits_extension = os.environ['FITS_EXTENSION']
+        self.preprocess_prefix = os.environ['PREPROCESS_PREFIX']
+
+    def _files(self, frame: Frame, sequences: list[str]) -> list[str]:
+        return sum([included_frames(self.session.get_process_dir(frame), s, self.fits_extension)
+                    for s in sequences], [])
+
+    def _uses_siril(self, frames: list[Frame], stage_names: list[str]) -> bool:
+        return any(stages.get_backend(self.session, frame, stage) == 'siril'
+                   for frame in frames for stage in stage_names)
+
+    def _light_sequences(self, prefix: str = '') -> list[str]:
+        lights = self.session.lights
+        return [f"{prefix}{self.dataset.sequence(lights, night)}" for night in self.dataset.nights_of(lights)]
+
+    def _lights_sequence(self) -> str:
+        """
+        Calibrated sequence of every night, merged when there are several
+        """
+        lights = self.session.lights
+        if self.session.multiple:
+            return f"{self.preprocess_prefix}{lights.name}_merged"
+        return f"{self.preprocess_prefix}{lights.name}"
+
+    def masters(self, Siril):
+        session = self.session
+        stages.stack(Siril, session, session.biases, session.biases.name, session.biases.stacked_name)
+        bias_file = f"{session.get_process_dir(session.biases)}/{session.biases.stacked_name}.{self.fits_extension}"
+
+        for night in self.dataset.nights_of(session.darks):
+            out = f"{session.darks.stacked_name}_{night}" if night else session.darks.stacked_name
+            stages.stack(Siril, session, session.darks, self.dataset.sequence(session.darks, night), out)
+
+        for night in self.dataset.nights_of(session.flats):
+            sequence = self.dataset.sequence(session.flats, night)
+            # Biases come from the master library in a real session
+            calibrate_params = {"cfa": True, "equalize_cfa": True, "all": True, "sighi": 3, "siglo": 3,
+                                "prefix": self.preprocess_prefix, "bias": bias_file}
+
+            if get_calibrate_backend(session, session.flats) == 'native':
+                CalibrationEngine(calibrate_params).run(
+                    session.get_process_dir(session.flats), sequence, self.fits_extension)
+            else:
+                Siril.cd(session.get_process_dir(session.flats))
+                [calibrate_result] = Siril.calibrate(sequence, **calibrate_params)
+                if calibrate_result is not True:
+                    raise Exception(f"Failed to calibrate {sequence}")
+
+            out = f"{session.flats.stacked_name}_{night}" if night else session.flats.stacked_name
+            stages.stack(Siril, session, session.flats, f"{self.preprocess_prefix}{sequence}", out)
+
+    def screen(self, Siril):
+        for night in self.dataset.nights_of(self.session.lights):
+            screen(self.session, self.session.lights, night)
+
+    def calibrate(self, Siril):
+        for night in self.dataset.nights_of(self.session.lights):
+            calibrate(Siril, self.session, self.session.lights, night)
+
+    def merge(self, Siril):
+        stages.merge(Siril, self.session, self.session.lights,
+                     self._light_sequences(self.preprocess_prefix), self._lights_sequence())
+
+    def register(self, Siril):
+        stages.register(Siril, self.session, self.session.lights, self._lights_sequence())
+
+    def stack(self, Siril):
+        lights = self.session.lights
+        out = f"{lights.stacked_name}_merged" if self.session.multiple else lights.stacked_name
+        stages.stack(Siril, self.session, lights, stages.registered_sequence(self._lights_sequence()), out)
+
+    def nebula(self, Siril):
+        lights = self.session.lights
+        out = f"{lights.stacked_name}_merged" if self.session.multiple else lights.stacked_name
+
+        wrapper = SirilWrapper(None, Siril, self.session)
+        PostProcess(wrapper, lights)\
+            .load(f"{self.session.get_process_dir(lights)}/{out}.{self.fits_extension}")\
+            .nebula(stretch=True, denoise=False)
+
+    def inputs(self, stage: str) -> list[str]:
+        """
+        Files a stage reads, for its throughput
+        """
+        session = self.session
+        if stage == 'masters':
+            return self._files(session.biases, [session.biases.name]) + \
+                self._files(session.darks, [self.dataset.sequence(session.darks, n)
+                                            for n in self.dataset.nights_of(session.darks)]) + \
+                self._files(session.flats, [self.dataset.sequence(session.flats, n)
+                                            for n in self.dataset.nights_of(session.flats)])
+        if stage in ['screen', 'calibrate']:
+            return self._files(session.lights, self._light_sequences())
+        if stage == 'merge':
+            return self._files(session.lights, self._light_sequences(self.preprocess_prefix))
+        if stage == 'register':
+            return self._files(session.lights, [self._lights_sequence()])
+        if stage == 'stack':
+            return self._files(session.lights, [stages.registered_sequence(self._lights_sequence())])
+        return []
+
+    def run(self) -> dict[str, dict]:
+        results = {}
+        session = self.session
+
+        for stage in self.stages:
+            if stage == 'merge' and not session.multiple:
+                continue
+
+            siril = stage == 'nebula' or (stage == 'masters' and self._uses_siril(
+                [session.biases, session.darks, session.flats], ['stack', 'calibrate'])) or \
+                (stage in BACKEND_STAGES and self._uses_siril([session.lights], [stage]))
+
+            files = self.inputs(stage)
+            size = sum(os.path.getsize(f) for f in files) / 1e6
+
+            self.logger.info(f"[{stage}] Running on {len(files)} frames ({size:.0f}MB)")
+            result = measure(getattr(self, stage), siril=siril)
+            result.update(
+                frames=len(files),
+                mb=round(size, 1),
+                fps=round(len(files) / result['seconds'], 2),
+                mbps=round(size / result['seconds'], 1),
+                backend='siril' if siril else 'native',
+            )
+            result.pop('error')
+            results[stage] = result
+
+            self.logger.info(
+                f"[{stage}] {result['seconds']:.1f}s {result['fps']} frames/s {result['mbps']}MB/s "
+                f"RSS {result['rss_mb']:.0f}MB (children {result['children_rss_mb']:.0f}MB)")
+
+        return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Regressions of the results over the baseline, as messages
+    """
+    regressions = []
+    for dataset, stage_results in results.items():
+        for stage, result in stage_results.items():
+            previous = baseline.get(dataset, {}).get(stage)
+            if not previous:
+                continue
+
+            for metric in COMPARED:
+                if not previous.get(metric):
+                    continue
+                change = result[metric] / previous[metric] - 1
+                Logger.info(f"{dataset} {stage:<10} {metric:<16} {previous[metric]:>9.1f} -> {result[metric]:>9.1f} ({change:+.0%})")
+                if change > tolerance and not (metric == 'seconds' and previous[metric] < MIN_COMPARED_SECONDS):
+                    regressions.append(
+                        f"{dataset} {stage} {metric}: {previous[metric]:.1f} -> {result[metric]:.1f} ({change:+.0%})")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    for key, value in SESSION_ENV.items():
+        os.environ.setdefault(key, value)
+    if args.backend:
+        for stage in BACKEND_STAGES:
+            os.environ[f"{stage.upper()}_BACKEND"] = args.backend
+
+    stages_to_run = args.stages + (['nebula'] if args.nebula else [])
+    root = args.workdir if args.workdir else tempfile.mkdtemp(prefix="pipeline-benchmark-")
+    results: dict[str, dict] = {}
+
+    try:
+        for size in args.sizes:
+            frames, width, height = parse_size(size)
+            dataset_name = f"{size}x{args.nights}n"
+            working_dir = os.path.join(root, dataset_name)
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+            camera = SyntheticCamera(width, height,
+                                     stars=args.stars,
+                                     read_noise=args.read_noise,
+                                     hot_pixels=args.hot_pixels,
+                                     gradient=args.gradient,
+                                     dither=args.dither)
+            dataset = SyntheticSession(benchmark_session(working_dir, args.nights), camera,
+                                       lights=frames,
+                                       darks=args.calibration_frames,
+                                       flats=args.calibration_frames,
+                                       biases=args.calibration_frames,
+                                       nights=args.nights)
+
+            Logger.info(f"Dataset {dataset_name}: {working_dir}")
+            dataset.write()
+            results[dataset_name] = PipelineBenchmark(dataset, stages_to_run).run()
+
+        for dataset_name, stage_results in results.items():
+            total = sum(r['seconds'] for r in stage_results.values())
+            Logger.info(f"{dataset_name}: {total:.1f}s")
+
+        regressions = []
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline.get('results', {}), args.tolerance)
+            for regression in regressions:
+                Logger.warning(f"Regression: {regression}")
+
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as f:
+                json.dump({
+                    'machine': {'cpus': os.cpu_count(), 'platform': platform.platform(),
+                                'python': platform.python_version()},
+                    'backend': args.backend,
+                    'results': results,
+                }, f, indent=1)
+            Logger.info(f"Baseline saved: {args.save_baseline}")
+
+        if regressions:
+            exit(1)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,290 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from ..conversion import raw_header
+from ..sequence import frame_file, write_seq, write_image, compression
+from ..siril import Frame, Session
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Synthetic sessions to benchmark the pipeline on
+
+SyntheticCamera renders 16-bit RGGB frames of a fixed star field with a
+simple sensor model:
+
+    bias        BIAS_LEVEL, a column pattern and read noise
+    darks       + dark current and hot pixels, scaled by the exposure
+    flats       + FLAT_LEVEL through the vignetting and the CFA gains
+    lights      + sky with a linear gradient and Gaussian stars, through
+                  the vignetting and CFA gains, with shot noise
+
+Every night of lights looks at the field rotated by `rotation` degrees more
+than the previous one and shifted by up to `night_offset` pixels, and every
+frame of a night is dithered by up to `dither` pixels. Renders are seeded
+by (frame type, night, index), so the same arguments always give the same
+frames.
+
+SyntheticSession writes them where convert would have: the converted
+sequence of every night of every frame type (individual frames numbered
+from 1 and their .seq, bottom-up with BAYERPAT like RawConverter, tile
+compressed with FITS_COMPRESSION), ready to screen, calibrate, register
+and stack. Multi-night sessions also get their empty night directories.
+
+Usage:
+    camera = SyntheticCamera(3000, 2000, stars=300, dither=20)
+    SyntheticSession(session, camera, lights=30, darks=10, flats=10, biases=10).write()
+"""
+
+BIAS_LEVEL = 2048
+FLAT_LEVEL = 20000
+DARK_CURRENT = 0.02  # ADU/s
+HOT_PIXEL_CURRENT = (5, 50)  # ADU/s
+VIGNETTING = 0.3  # loss at the corners
+
+# Gain of the R, G, G, B pixels of an RGGB cell
+CFA_GAINS = [0.8, 1.0, 1.0, 0.7]
+
+# Render seeds of the frame types
+FRAME_KINDS = ['biases', 'darks', 'flats', 'lights']
+
+_worker: dict = {}
+
+
+class SyntheticCamera:
+    def __init__(self,
+                 width: int = 3000,
+                 height: int = 2000,
+                 stars: float = 300,
+                 fwhm: float = 3.0,
+                 sky: float = 800,
+                 gradient: float = 0.2,
+                 read_noise: float = 8,
+                 hot_pixels: int = 200,
+                 exposure: float = 120,
+                 dither: float = 15,
+                 night_offset: float = 60,
+                 rotation: float = 0.5,
+                 seed: int = 0
+                 ) -> None:
+        """
+        stars: per megapixel, sky: ADU of background in a light,
+        gradient: change of the sky across the frame (0.2 is +-10%),
+        dither / night_offset: pixels, rotation: degrees per night
+        """
+        self.width = width
+        self.height = height
+        self.stars = stars
+        self.fwhm = fwhm
+        self.sky = sky
+        self.gradient = gradient
+        self.read_noise = read_noise
+        self.hot_pixels = hot_pixels
+        self.exposure = exposure
+        self.dither = dither
+        self.night_offset = night_offset
+        self.rotation = rotation
+        self.seed = seed
+
+        # Enough of the sky to cover every dither and rotation
+        margin = night_offset + dither + np.hypot(width, height) * np.radians(abs(rotation)) * 4
+        rng = np.random.default_rng(seed)
+        count = int(stars * (width + 2 * margin) * (height + 2 * margin) / 1e6)
+        self.field = rng.uniform([-margin, -margin], [width + margin, height + margin], (count, 2))
+        self.flux = np.minimum(5000 * (1 + rng.pareto(1.5, count)), 1e6)
+
+        self._sensor: Optional[dict] = None
+
+    def __getstate__(self) -> dict:
+        # Workers rebuild the sensor arrays, they are larger than a frame
+        return dict(self.__dict__, _sensor=None)
+
+    def sensor(self) -> dict:
+        if self._sensor is None:
+            rng = np.random.default_rng((self.seed, 1))
+            y = np.linspace(-1, 1, self.height, dtype=np.float32)[:, None]
+            x = np.linspace(-1, 1, self.width, dtype=np.float32)[None, :]
+            gains = np.tile(np.array(CFA_GAINS, dtype=np.float32).reshape(2, 2),
+                            (self.height // 2 + 1, self.width // 2 + 1))[:self.height, :self.width]
+
+            self._sensor = {
+                'columns': rng.normal(0, 2, self.width).astype(np.float32),
+                'hot': rng.integers(0, self.width * self.height, self.hot_pixels),
+                'hot_current': rng.uniform(*HOT_PIXEL_CURRENT, self.hot_pixels),
+                # Flat field: vignetting through the colour filters
+                'response': (1 - VIGNETTING * (x ** 2 + y ** 2) / 2) * gains,
+            }
+        return self._sensor
+
+    def pose(self, night: int, index: int) -> tuple[float, np.ndarray]:
+        """
+        Rotation (radians) and shift of a light, relative to the field
+        """
+        night_rng = np.random.default_rng((self.seed, 2, night))
+        frame_rng = np.random.default_rng((self.seed, 3, night, index))
+        shift = night_rng.uniform(-self.night_offset, self.night_offset, 2) * (night > 1) + \
+            frame_rng.uniform(-self.dither, self.dither, 2)
+        return np.radians(self.rotation * (night - 1)), shift
+
+    def star_image(self, night: int, index: int) -> np.ndarray:
+        angle, shift = self.pose(night, index)
+        center = np.array([self.width, self.height]) / 2
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        positions = (self.field - center) @ rotation.T + center + shift
+
+        sigma = self.fwhm / 2.3548
+        radius = int(np.ceil(3 * sigma))
+        inside = (positions[:, 0] > -radius) & (positions[:, 0] < self.width + radius) & \
+            (positions[:, 1] > -radius) & (positions[:, 1] < self.height + radius)
+        positions, flux = positions[inside], self.flux[inside]
+
+        # One stamp per star, summed with bincount
+        offsets = np.arange(-radius, radius + 1)
+        xs = np.floor(positions[:, 0])[:, None, None] + offsets[None, None, :]
+        ys = np.floor(positions[:, 1])[:, None, None] + offsets[None, :, None]
+        values = flux[:, None, None] / (2 * np.pi * sigma ** 2) * np.exp(
+            -((xs - positions[:, 0, None, None]) ** 2 + (ys - positions[:, 1, None, None]) ** 2) / (2 * sigma ** 2))
+        xs, ys = np.broadcast_arrays(xs, ys)
+
+        valid = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        pixels = (ys[valid] * self.width + xs[valid]).astype(np.int64)
+        return np.bincount(pixels, weights=values[valid], minlength=self.width * self.height)\
+            .reshape(self.height, self.width).astype(np.float32)
+
+    def background(self, night: int) -> np.ndarray:
+        angle = np.random.default_rng((self.seed, 4, night)).uniform(0, 2 * np.pi)
+        y = np.linspace(-0.5, 0.5, self.height, dtype=np.float32)[:, None]
+        x = np.linspace(-0.5, 0.5, self.width, dtype=np.float32)[None, :]
+        return self.sky * (1 + self.gradient * (np.cos(angle) * x + np.sin(angle) * y))
+
+    def render(self, kind: str, night: int = 1, index: int = 1) -> np.ndarray:
+        """
+        A frame of `kind` (biases, darks, flats, lights), top-down uint16
+        """
+        sensor = self.sensor()
+        rng = np.random.default_rng((self.seed, 5, FRAME_KINDS.index(kind), night, index))
+
+        signal = np.zeros((self.height, self.width), dtype=np.float32)
+        if kind == 'flats':
+            signal += FLAT_LEVEL * sensor['response']
+        elif kind == 'lights':
+            signal += (self.background(night) + self.star_image(night, index)) * sensor['response']
+
+        if kind in ['darks', 'lights']:
+            signal += DARK_CURRENT * self.exposure
+            signal.ravel()[sensor['hot']] += sensor['hot_current'] * self.exposure
+
+        # Shot noise of the signal, then the read noise around the bias
+        noise = np.sqrt(signal + self.read_noise ** 2, dtype=np.float32)
+        data = signal + BIAS_LEVEL + sensor['columns'][None, :] + \
+            noise * rng.standard_normal(signal.shape, dtype=np.float32)
+
+        return np.clip(np.rint(data), 0, 65535).astype(np.uint16)
+
+    def metadata(self, kind: str) -> dict:
+        """
+        What RawConverter reads from the EXIF of a raw
+        """
+        exposure = {'biases': 1 / 4000, 'flats': 1 / 100}.get(kind, self.exposure)
+        return {'exposure': exposure, 'iso': 800, 'temperature': 20.0,
+                'timestamp': '2024-01-01T22:00:00', 'tags': {'EXIF:Model': 'Synthetic'}}
+
+
+def _init_worker(camera: SyntheticCamera):
+    _worker.update(camera=camera)
+
+
+def _write(task: tuple[str, int, int, str]) -> int:
+    kind, night, index, out = task
+    camera: SyntheticCamera = _worker['camera']
+
+    data = camera.render(kind, night, index)
+    header = raw_header(camera.metadata(kind), 'RGGB', data.shape)
+    for key in ['BZERO', 'BSCALE']:
+        header.remove(key, ignore_missing=True)
+
+    # Stored bottom-up, like Siril and RawConverter
+    return os.path.getsize(write_image(out, data[::-1], header))
+
+
+class SyntheticSession:
+    def __init__(self,
+                 session: Session,
+                 camera: SyntheticCamera,
+                 lights: int = 20,
+                 darks: int = 10,
+                 flats: int = 10,
+                 biases: int = 10,
+                 nights: int = 1,
+                 workers: Optional[int] = None
+                 ) -> None:
+        """
+        Darks and flats are written for every night, like the session
+        directories of a multi-night target. Biases (from the master
+        library in a real session) are written once
+        """
+        if nights > 1 and not session.multiple:
+            raise Exception("Several nights need a multi-night session")
+
+        self.logger = Logger
+        self.session = session
+        self.camera = camera
+        self.counts = {'lights': lights, 'darks': darks, 'flats': flats, 'biases': biases}
+        self.nights = nights
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+
+    def nights_of(self, frame: Frame) -> list[str]:
+        """
+        Night names as Session.get_night returns them
+        """
+        if not self.session.multiple or frame is self.session.biases:
+            return [""]
+        return [str(n) for n in range(1, self.nights + 1)]
+
+    def sequence(self, frame: Frame, night: str) -> str:
+        return f"{frame.name}_{night}" if night else frame.name
+
+    def write(self) -> dict[str, int]:
+        """
+        Writes every sequence, returns the bytes written per frame type
+        """
+        tasks: list[tuple[str, int, int, str]] = []
+        sequences = []
+
+        for kind in FRAME_KINDS:
+            frame: Optional[Frame] = getattr(self.session, kind)
+            if frame is None or not self.counts[kind]:
+                continue
+
+            process_dir = self.session.get_process_dir(frame)
+            os.makedirs(process_dir, exist_ok=True)
+
+            for night in self.nights_of(frame):
+                if night:
+                    os.makedirs(f"{self.session.working_dir}/{frame.dir}/{os.environ['MULTINIGHT_DIR_NAME']}{night}",
+                                exist_ok=True)
+                sequence = self.sequence(frame, night)
+                indices = list(range(1, self.counts[kind] + 1))
+                tasks += [(kind, int(night) if night else 1, i,
+                           frame_file(process_dir, sequence, i, os.environ['FITS_EXTENSION'])) for i in indices]
+                sequences.append((process_dir, sequence, indices))
+
+        self.logger.info(
+            f"Writing {len(tasks)} synthetic {self.camera.width}x{self.camera.height} frames on {self.workers} workers")
+
+        written = {kind: 0 for kind in FRAME_KINDS}
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(self.camera,)) as pool:
+            for (kind, *_), size in zip(tasks, pool.map(_write, tasks)):
+                written[kind] += size
+
+        for process_dir, sequence, indices in sequences:
+            write_seq(process_dir, sequence, indices, fz=compression() is not None)
+
+        return written
@@ -2,11 +2,14 @@ import os
 import os.path
 
 from pathlib import Path
+from typing import Optional
 import argparse
 
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
+from .pool import get_siril
+from .calibration import CalibrationEngine
 from .logger import Logger as _Logger
 
 """
@@ -14,6 +17,10 @@ Calibrates a sequence of images
 
 Usage:
     poetry run python -m src.calibrate flats.fit -F flats -fitseq --bias=master_bias.fit
+    poetry run python -m src.calibrate lights.seq -f lights --dark=master_dark.fit --backend=native
+
+    from src.calibrate import calibrate
+    calibrate(siril, "flats.fit", "flats", fitseq=True, master_bias="master_bias.fit")
 
 """
 
@@ -64,24 +71,35 @@ parser.add_argument('-fitseq',
                     dest="fitseq",
                     help="Should use a FITS sequence?")
 
-args = parser.parse_args()
-
-
-App = Siril()  # type: ignore
-siril = Wrapper(App)  # type: ignore
+parser.add_argument('--selected',
+                    required=False,
+                    action='store_true',
+                    dest="selected",
+                    help="Only calibrate the frames selected in the .seq file (ie: after src.screen)")
 
-if args.frame == 'flats' and args.master_bias is None:
-    Logger.warn("Not using Master Bias for Flats Calibration")
+parser.add_argument('-b', '--backend',
+                    required=False,
+                    type=str,
+                    default=os.getenv('CALIBRATE_BACKEND', 'siril'),
+                    dest="backend",
+                    choices=['siril', 'native'],
+                    help="Calibrate with Siril or with the native CalibrationEngine")
 
 
 def calibrate(
-    seq=args.seq,
-    frame=args.frame,
-    fitseq=args.fitseq,
-    master_bias=args.master_bias,
-    master_dark=args.master_dark,
-    master_flat=args.master_flat,
+    siril,
+    seq: str,
+    frame: str = 'lights',
+    fitseq: bool = False,
+    master_bias: Optional[str] = None,
+    master_dark: Optional[str] = None,
+    master_flat: Optional[str] = None,
+    backend: str = 'siril',
+    selected: bool = False,
 ) -> bool:
+    if frame == 'flats' and master_bias is None:
+        Logger.warn("Not using Master Bias for Flats Calibration")
+
     siril.setcpu(cpu_cores)
     siril.set16bits()
     siril.setext(fits_extension)
@@ -93,7 +111,7 @@ def calibrate(
     calibrate_params = {
         "cfa": True,
         "equalize_cfa": True,
-        "all": True,
+        "all": not selected,
         "prefix": prefix,
         "sighi": 3,
         "siglo": 3,
@@ -115,6 +133,12 @@ def calibrate(
 
     Logger.json("Calibration Parameters", calibrate_params)
 
+    if backend == 'native':
+        CalibrationEngine(calibrate_params).run(
+            str(Path(seq).parent), name, fits_extension)
+        Logger.info(f"Calibrated {frame} Frames")
+        return True
+
     [calibrate_result] = siril.calibrate(
         name, **calibrate_params)
 
@@ -126,9 +150,18 @@ def calibrate(
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    App = get_siril()
+
     try:
         App.Open()
-        calibrate()
+        calibrate(Wrapper(App), args.seq, frame=args.frame,  # type: ignore
+                  fitseq=args.fitseq,
+                  master_bias=args.master_bias,
+                  master_dark=args.master_dark,
+                  master_flat=args.master_flat,
+                  backend=args.backend,
+                  selected=args.selected)
     except Exception as e:
         Logger.error(f"Error: {e}")
         exit(1)
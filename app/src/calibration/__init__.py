@@ -0,0 +1 @@
+from .engine import CalibrationEngine, Masters, SharedArray
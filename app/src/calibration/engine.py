@@ -0,0 +1,321 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+from astropy.io import fits
+
+from ..sequence import FrameView, SequenceReader, bayer_pattern, open_frame, frame_file, frame_header, primary_header, write_seq, write_image, compression
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Native calibration backend, a drop-in for Wrapper.calibrate
+
+Takes the same calibrate_params dicts as Siril (see
+preprocess.get_calibrate_params): bias, dark, flat, cc='dark', siglo,
+sighi, cfa, equalize_cfa, debayer, prefix and all.
+
+The masters are loaded once into shared memory and prepared there:
+    - the flat is bias subtracted already (pp_flats), it is normalized to
+      a mean of 1 (per CFA channel with equalize_cfa) and inverted, so
+      flat fielding is a multiplication
+    - hot and cold pixels are found once on the master dark
+Each worker of the process pool then runs one fused pass per frame:
+(light - dark or bias) * inverse flat, cosmetic correction of the deviant
+pixels from their same-colour neighbours, and debayering.
+
+Calibrated frames are written as {prefix}{sequence}_{index}.fit next to the
+input, with a .seq file, exactly where Siril would put them. With fitseq
+they go in one FITS sequence, {prefix}{sequence}.fit and {prefix}{sequence}.seq,
+laid out like the ones RawConverter writes.
+
+Usage:
+    CalibrationEngine(calibrate_params).run(process_dir, "lights_1")
+"""
+
+_worker: dict = {}
+
+# Same colour neighbours of a pixel in a Bayer matrix, and in a mono image
+CFA_NEIGHBOURS = [(-2, 0), (2, 0), (0, -2), (0, 2),
+                  (-2, -2), (-2, 2), (2, -2), (2, 2)]
+MONO_NEIGHBOURS = [(-1, 0), (1, 0), (0, -1), (0, 1),
+                   (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+# OpenCV names Bayer patterns after the second row
+BAYER_CODES = {
+    'RGGB': cv.COLOR_BayerBG2RGB,
+    'BGGR': cv.COLOR_BayerRG2RGB,
+    'GRBG': cv.COLOR_BayerGB2RGB,
+    'GBRG': cv.COLOR_BayerGR2RGB,
+}
+
+
+def load_master(path: str) -> np.ndarray:
+    """
+    Master as float32 in ADU, Siril's float masters are in [0, 1]
+    """
+    master = open_frame(path)
+    data = master.physical()
+    master.close()
+
+    if not master.integer and data.max() <= 1:
+        data *= 65535
+
+    return data
+
+
+def inverse_flat(flat: np.ndarray, equalize_cfa: bool) -> np.ndarray:
+    inverse = np.zeros_like(flat)
+
+    if equalize_cfa:
+        # Every CFA channel normalized on its own keeps the colour balance
+        for y in range(2):
+            for x in range(2):
+                channel = flat[:, y::2, x::2]
+                inverse[:, y::2, x::2] = channel / np.mean(channel)
+    else:
+        inverse = flat / np.mean(flat)
+
+    with np.errstate(divide='ignore'):
+        return np.where(inverse > 1e-3, 1 / inverse, 0).astype(np.float32)
+
+
+def deviant_pixels(dark: np.ndarray, sigma_low: float, sigma_high: float) -> np.ndarray:
+    """
+    Flat indices of the hot and cold pixels of a master dark
+    """
+    median = np.median(dark)
+    sigma = 1.4826 * np.median(np.abs(dark - median))
+    deviant = (dark > median + sigma_high * sigma) | (dark < median - sigma_low * sigma)
+    return np.flatnonzero(deviant).astype(np.int64)
+
+
+class SharedArray:
+    def __init__(self, name: str, shape: tuple, dtype: str) -> None:
+        """
+        Attaches to an existing block, see SharedArray.create
+        """
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self.array: Optional[np.ndarray] = None
+
+    @classmethod
+    def create(cls, data: np.ndarray) -> 'SharedArray':
+        shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+        shared = cls(shm.name, data.shape, data.dtype.str)
+        shared.shm = shm
+        shared.array = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared.array[...] = data
+        return shared
+
+    def __getstate__(self) -> dict:
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state: dict):
+        self.__init__(**state)
+
+    def attach(self) -> np.ndarray:
+        if self.array is None:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+            self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        return self.array
+
+    def close(self, unlink: bool = False):
+        self.array = None
+        if self.shm is not None:
+            self.shm.close()
+            if unlink:
+                self.shm.unlink()
+            self.shm = None
+
+
+class Masters:
+    def __init__(self, calibrate_params: dict) -> None:
+        """
+        Loads and prepares the masters of calibrate_params in shared memory
+        """
+        self.logger = Logger
+        self.offset: Optional[SharedArray] = None
+        self.inverse_flat: Optional[SharedArray] = None
+        self.deviant: Optional[SharedArray] = None
+
+        dark = calibrate_params.get('dark')
+        bias = calibrate_params.get('bias')
+        flat = calibrate_params.get('flat')
+
+        # The master dark holds the bias too, the bias is only used without one
+        if dark:
+            dark_data = load_master(dark)
+            self.offset = SharedArray.create(dark_data)
+            if calibrate_params.get('cc') == 'dark':
+                self.deviant = SharedArray.create(deviant_pixels(
+                    dark_data, float(calibrate_params.get('siglo', 3)),
+                    float(calibrate_params.get('sighi', 3))))
+                self.logger.info(
+                    f"Found {self.deviant.shape[0]} deviant pixels in {dark}")
+        elif bias:
+            self.offset = SharedArray.create(load_master(bias))
+
+        if flat:
+            self.inverse_flat = SharedArray.create(inverse_flat(
+                load_master(flat), bool(calibrate_params.get('equalize_cfa'))))
+
+    def shared(self) -> dict[str, Optional[SharedArray]]:
+        """
+        What workers need to attach to the masters, it pickles to names only
+        """
+        return {'offset': self.offset, 'inverse_flat': self.inverse_flat, 'deviant': self.deviant}
+
+    def close(self):
+        for shared in self.shared().values():
+            if shared is not None:
+                shared.close(unlink=True)
+
+
+def cosmetic(data: np.ndarray, deviant: np.ndarray, cfa: bool) -> np.ndarray:
+    """
+    Replaces deviant pixels with the median of their same-colour neighbours
+    """
+    channels, height, width = data.shape
+    ys, xs = np.unravel_index(deviant % (height * width), (height, width))
+    neighbours = CFA_NEIGHBOURS if cfa else MONO_NEIGHBOURS
+
+    for c in range(channels):
+        samples = np.stack([
+            data[c, np.clip(ys + dy, 0, height - 1), np.clip(xs + dx, 0, width - 1)]
+            for dy, dx in neighbours
+        ])
+        data[c, ys, xs] = np.median(samples, axis=0)
+
+    return data
+
+
+def calibrate_frame(view: FrameView, masters: dict, params: dict) -> np.ndarray:
+    data = view.physical()
+
+    if masters['offset'] is not None:
+        data -= masters['offset']
+    if masters['inverse_flat'] is not None:
+        data *= masters['inverse_flat']
+    if masters['deviant'] is not None and len(masters['deviant']):
+        data = cosmetic(data, masters['deviant'], bool(params.get('cfa')))
+
+    data = np.clip(data, 0, 65535)
+
+    if params.get('debayer') and data.shape[0] == 1:
+        rgb = cv.cvtColor(data[0].astype(np.uint16),
+                          BAYER_CODES[bayer_pattern(view)])
+        return np.moveaxis(rgb, -1, 0)
+
+    return data.astype(np.uint16)
+
+
+def write_frame(view: FrameView, data: np.ndarray, out: str, codec: Optional[str] = None) -> str:
+    """
+    codec: see write_image, '' writes plain FITS whatever FITS_COMPRESSION says
+    """
+    header = frame_header(view)
+    # A debayered frame is not a CFA image anymore
+    if data.shape[0] == 3 and view.shape[0] == 1:
+        header.remove('BAYERPAT', ignore_missing=True)
+
+    return write_image(out, data, header, codec=codec)
+
+
+def write_fitseq(out: str, files: list[str]) -> str:
+    """
+    FITS sequence of the images of `files`, in order: the first one in the
+    primary HDU, the others in an image extension each. Not compressed, as
+    RawConverter's
+    """
+    tmp = f"{out}.tmp"
+    for i, file in enumerate(files):
+        # One frame in memory at a time
+        with fits.open(file) as hdul:
+            header = primary_header(hdul[0].header)
+            if i == 0:
+                fits.PrimaryHDU(hdul[0].data, header).writeto(tmp, overwrite=True)
+            else:
+                with fits.open(tmp, mode='append') as sequence:
+                    sequence.append(fits.ImageHDU(hdul[0].data, header))
+
+    os.replace(tmp, out)
+    return out
+
+
+def _init_worker(shared: dict[str, Optional[SharedArray]], params: dict, codec: Optional[str]):
+    _worker.update(shared=shared, params=params, codec=codec, arrays={
+        name: array.attach() if array is not None else None for name, array in shared.items()})
+
+
+def _calibrate(task: tuple[FrameView, str]) -> str:
+    view, out = task
+    written = write_frame(view, calibrate_frame(
+        view, _worker['arrays'], _worker['params']), out, _worker['codec'])
+    view.close()
+    return written
+
+
+class CalibrationEngine:
+    def __init__(self, calibrate_params: dict, workers: Optional[int] = None) -> None:
+        """
+        calibrate_params: same dict as given to Wrapper.calibrate
+        """
+        self.logger = Logger
+        self.params = calibrate_params
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.prefix = calibrate_params.get(
+            'prefix', os.environ['PREPROCESS_PREFIX'])
+
+    def run(self, process_dir: str, sequence: str, fits_extension: str = os.getenv('FITS_EXTENSION', 'fit')) -> list[str]:
+        """
+        Calibrates a sequence of process_dir, returns the calibrated files
+        """
+        reader = SequenceReader(process_dir, sequence, fits_extension)
+        selected = not self.params.get('all')
+        # FITS sequences number their images from 0, output files from 1
+        start = 1 if reader.is_fitseq else 0
+        calibrated = f"{self.prefix}{sequence}"
+
+        indices = [i for i in reader.indices if not selected or i not in reader.excluded]
+        if not indices:
+            raise Exception(f"No frames to calibrate in {sequence}")
+
+        fitseq = bool(self.params.get('fitseq'))
+        # A FITS sequence is assembled from plain frames once they are all written
+        out_dir = tempfile.mkdtemp(prefix=f".{calibrated}.", dir=process_dir) if fitseq else process_dir
+
+        tasks = [(reader.frame(i), frame_file(out_dir, calibrated, i + start, fits_extension))
+                 for i in indices]
+        self.logger.info(
+            f"Calibrating {len(tasks)} frames of {sequence} on {self.workers} workers")
+
+        masters = Masters(self.params)
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=_init_worker,
+                                     initargs=(masters.shared(), self.params, '' if fitseq else None)) as pool:
+                outputs = list(pool.map(_calibrate, tasks))
+
+            if fitseq:
+                outputs = [write_fitseq(os.path.join(process_dir, f"{calibrated}.{fits_extension}"), outputs)]
+                write_seq(process_dir, calibrated, list(range(len(indices))), fitseq=True)
+            else:
+                write_seq(process_dir, calibrated, [i + start for i in indices], fz=compression() is not None)
+        finally:
+            masters.close()
+            reader.close()
+            if fitseq:
+                shutil.rmtree(out_dir, ignore_errors=True)
+
+        self.logger.info(f"Calibrated {sequence}: {calibrated}")
+        return outputs
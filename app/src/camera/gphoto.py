@@ -5,11 +5,9 @@ import glob
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
+from ..pool import get_siril
 from ..logger import Logger as _Logger
 
-_Siril = Siril()  # type: ignore
-sirilWrapper = Wrapper(_Siril)  # type: ignore
-
 Logger = _Logger(__name__)
 
 """
@@ -23,8 +21,8 @@ ISOS = [
 
 class Camera():
     def __init__(self):
-        self.sirilApp = _Siril
-        self.siril = sirilWrapper
+        self.sirilApp = get_siril()
+        self.siril = Wrapper(self.sirilApp)  # type: ignore
         self.logger = Logger
 
         self.model = self.get_model()
@@ -0,0 +1 @@
+from .targets import Target, TargetCatalog, get_catalog, target_name, target_coordinates, normalize
@@ -0,0 +1,218 @@
+import os
+import re
+import csv
+import threading
+from typing import Optional
+
+from astropy import units as u
+from astropy.coordinates import ICRS, SkyCoord, get_icrs_coordinates
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Offline resolver of target names
+
+targets.csv, next to this module, lists the Messier objects and the NGC,
+IC and Sharpless targets usually imaged from here, with their catalog
+cross-identifications and common names. Every name of every target is
+normalised into one index when the catalog is first used, so these all
+resolve to the same target with a dictionary lookup:
+
+    "NGC 650", "ngc0651", "M76", "Messier 76", "Little Dumbbell",
+    "little_dumbbell_nebula"
+
+TARGET_CATALOG adds catalogs in the same semicolon separated format (the
+OpenNGC NGC.csv and addendum.csv can be used as is), several separated by
+os.pathsep. Names that are in no catalog are only sent to Sesame with
+TARGET_ONLINE_LOOKUP=1.
+
+Usage:
+    target = get_catalog().resolve("M76 2024-01-12")
+    coords = target_coordinates(target_name(session.working_dir))
+"""
+
+BUNDLED_CATALOG = os.path.join(os.path.dirname(__file__), 'targets.csv')
+
+# Words dropped from the end of common names, "Little Dumbbell Nebula" is
+# also found as "Little Dumbbell"
+GENERIC_WORDS = ['nebula', 'galaxy', 'galaxies', 'cluster']
+
+_DESIGNATION = r"(messier|sharpless|ngc|ic|sh\s?2|m)[\s_-]*0*(\d+)([a-z]?)"
+_PREFIXES = {'messier': 'm', 'sharpless': 'sh2', 'sh 2': 'sh2'}
+
+
+def _designation(match: re.Match) -> str:
+    prefix = _PREFIXES.get(match[1], match[1])
+    return f"{prefix}{int(match[2])}{match[3]}"
+
+
+def _words(name: str) -> list[str]:
+    return re.sub(r"[^a-z0-9]+", " ", name.lower().replace("'", "")).split()
+
+
+def normalize(name: str) -> str:
+    """
+    Index key of a name: "NGC 0651" -> "ngc651", "Bode's Galaxy" -> "bodesgalaxy"
+    """
+    words = _words(name)
+    match = re.fullmatch(_DESIGNATION, " ".join(words))
+    return _designation(match) if match else "".join(words)
+
+
+def short_name(name: str) -> Optional[str]:
+    """
+    Index key of a common name without "the" and its generic last word
+    """
+    words = _words(name)
+    if words and words[0] == 'the':
+        words = words[1:]
+    if len(words) > 1 and words[-1] in GENERIC_WORDS:
+        words = words[:-1]
+    key = "".join(words)
+    return key if key and key != normalize(name) else None
+
+
+def _degrees(sexagesimal: str, scale: float) -> float:
+    sign = -1 if sexagesimal.strip().startswith('-') else 1
+    parts = [abs(float(p)) for p in sexagesimal.strip().lstrip('+-').split(':')]
+    return sign * scale * sum(p / 60 ** i for i, p in enumerate(parts))
+
+
+class Target:
+    def __init__(self, name: str, type: str, ra: float, dec: float, names: list[str]) -> None:
+        """
+        ra, dec: J2000 decimal degrees
+        """
+        self.name = name
+        self.type = type
+        self.ra = ra
+        self.dec = dec
+        self.names = names
+
+    def coords(self) -> SkyCoord:
+        return SkyCoord(ra=self.ra * u.deg, dec=self.dec * u.deg, frame=ICRS)
+
+    def __repr__(self) -> str:
+        return f"Target({self.name}, {self.ra:.4f}, {self.dec:+.4f}, {self.names})"
+
+
+class TargetCatalog:
+    def __init__(self, paths: list[str]) -> None:
+        self.logger = Logger
+        self.targets: list[Target] = []
+        # Normalised name -> target
+        self.index: dict[str, Target] = {}
+
+        for path in paths:
+            self.load(path)
+
+    def load(self, path: str) -> int:
+        """
+        Adds the targets of a catalog, names already indexed keep their target
+        """
+        targets = []
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f, delimiter=';'):
+                if not row.get('RA') or not row.get('Dec'):
+                    # OpenNGC duplicates and non-existent objects
+                    continue
+
+                names = [row['Name']]
+                names += [f"M{m}" for m in (row.get('M') or '').split(',') if m.strip()]
+                names += [f"NGC{n}" for n in (row.get('NGC') or '').split(',') if n.strip()]
+                names += [f"IC{i}" for i in (row.get('IC') or '').split(',') if i.strip()]
+                names += [n for n in (row.get('Identifiers') or '').split(',') if n.strip()]
+                names += [n for n in (row.get('Common names') or '').split(',') if n.strip()]
+
+                targets.append(Target(row['Name'], row.get('Type') or '',
+                                      _degrees(row['RA'], 15), _degrees(row['Dec'], 1),
+                                      [n.strip() for n in names]))
+
+        # Full names first, so a short name never hides a full one
+        for target in targets:
+            for name in target.names:
+                self.index.setdefault(normalize(name), target)
+        for target in targets:
+            for name in target.names:
+                key = short_name(name)
+                if key:
+                    self.index.setdefault(key, target)
+
+        self.targets += targets
+        self.logger.debug(f"Loaded {len(targets)} targets from {path}")
+        return len(targets)
+
+    def lookup(self, name: str) -> Optional[Target]:
+        """
+        Target of exactly this name
+        """
+        return self.index.get(normalize(name)) or self.index.get(short_name(name) or "")
+
+    def resolve(self, text: str) -> Optional[Target]:
+        """
+        Target of a name, or of the first designation ("NGC7000_HOO") or
+        longest run of words ("2024-01 Heart Nebula HaO3") of a longer text
+        """
+        target = self.lookup(text)
+        if target:
+            return target
+
+        words = _words(text)
+        for match in re.finditer(rf"(?<![a-z0-9]){_DESIGNATION}(?![a-z0-9])", " ".join(words)):
+            target = self.index.get(_designation(match))
+            if target:
+                return target
+
+        for length in range(len(words) - 1, 0, -1):
+            for start in range(len(words) - length + 1):
+                target = self.index.get("".join(words[start:start + length]))
+                if target:
+                    return target
+
+        return None
+
+
+_catalog: Optional[TargetCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> TargetCatalog:
+    """
+    The bundled catalog and the ones of TARGET_CATALOG, indexed once per process
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            extra = [p for p in os.getenv('TARGET_CATALOG', '').split(os.pathsep) if p]
+            _catalog = TargetCatalog([BUNDLED_CATALOG] + extra)
+    return _catalog
+
+
+def target_name(working_dir: str) -> str:
+    """
+    Target name of a session, from the name of its directory
+    """
+    return os.path.basename(os.path.normpath(working_dir)).replace('_', " ")
+
+
+def target_coordinates(name: str) -> Optional[SkyCoord]:
+    """
+    Coordinates of a target from the catalogs, then from Sesame when
+    TARGET_ONLINE_LOOKUP=1
+    """
+    target = get_catalog().resolve(name)
+    if target:
+        Logger.info(f"Resolved {name}: {target.name} ({', '.join(target.names[1:])})")
+        return target.coords()
+
+    if os.getenv('TARGET_ONLINE_LOOKUP', '0') == '0':
+        Logger.warning(f"{name} is not in the target catalog")
+        return None
+
+    try:
+        return get_icrs_coordinates(name=name, parse=False, cache=False)
+    except Exception as e:
+        Logger.warning(f"Failed to resolve {name}: {e}")
+        return None
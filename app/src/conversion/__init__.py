@@ -0,0 +1 @@
+from .raw import RawConverter, decode_raw, raw_header
@@ -0,0 +1,251 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from astropy.io import fits
+
+from ..metadata import ExifService, get_exif_service
+from ..sequence import frame_file, write_seq, write_image, compression
+from ..logger import Logger as _Logger
+
+try:
+    import rawpy  # type: ignore
+except ImportError:
+    rawpy = None
+
+Logger = _Logger(__name__)
+
+"""
+Native raw conversion backend, a drop-in for Wrapper.convert
+
+Raws are decoded with LibRaw (rawpy) across a process pool into 16-bit CFA
+FITS frames, laid out the way Siril's convert writes them:
+
+    - {sequence}_00001.fit ... and {sequence}_.seq, numbered from 1 in file
+      name order
+    - or a FITS sequence: {sequence}.fit with one HDU per raw, and
+      {sequence}.seq
+
+The visible area of the sensor is stored as is (no black level, no
+scaling), bottom-up like Siril (ROWORDER), with BAYERPAT. The EXIF of the
+whole directory is read in one exiftool batch (see metadata.ExifService)
+and written in the same pass: INSTRUME, EXPTIME, ISOSPEED, CCD-TEMP,
+DATE-OBS and FOCALLEN.
+
+A FITS sequence is laid out up front (every frame has the same size), each
+worker then writes its frame straight at its offset in the file. Individual
+frames are tile-compressed with FITS_COMPRESSION (see sequence.compression).
+
+Usage:
+    RawConverter(process_dir, "lights_1").run(list_raws(lights_dir))
+"""
+
+BITPIX = 16
+BZERO = 32768
+BLOCK_SIZE = 2880
+
+# EXIF tags written as they are, the others come from metadata.frame_metadata
+HEADER_TAGS = ['EXIF:Model', 'EXIF:FocalLength']
+
+
+def _padded(size: int) -> int:
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def decode_raw(path: str) -> tuple[np.ndarray, str]:
+    """
+    Visible CFA of a raw, top-down, and its Bayer pattern (ie: RGGB)
+    """
+    if rawpy is None:
+        raise Exception("The native converter needs rawpy: pip install rawpy")
+
+    with rawpy.imread(path) as raw:
+        colors = raw.raw_colors_visible
+        if raw.num_colors != 3 or colors.shape[0] < 2 or \
+                not np.array_equal(colors[2:4, :4], colors[:2, :4]) or \
+                not np.array_equal(colors[:4, 2:4], colors[:4, :2]):
+            raise Exception(f"{path} is not a Bayer raw")
+
+        description = raw.color_desc.decode()
+        pattern = "".join(description[c] for c in colors[:2, :2].ravel())
+        data = np.array(raw.raw_image_visible, dtype=np.uint16)
+
+    return data, pattern
+
+
+def raw_header(metadata: dict, pattern: str, shape: tuple[int, int], extension: bool = False) -> fits.Header:
+    """
+    Header of a converted raw, for an image HDU of `shape` (height, width)
+    """
+    height, width = shape
+    header = fits.Header()
+    if extension:
+        header['XTENSION'] = ('IMAGE', 'Image extension')
+    else:
+        header['SIMPLE'] = (True, 'conforms to FITS standard')
+    header['BITPIX'] = BITPIX
+    header['NAXIS'] = 2
+    header['NAXIS1'] = width
+    header['NAXIS2'] = height
+    if extension:
+        header['PCOUNT'] = 0
+        header['GCOUNT'] = 1
+    else:
+        header['EXTEND'] = True
+    header['BZERO'] = BZERO
+    header['BSCALE'] = 1
+    header['ROWORDER'] = ('BOTTOM-UP', 'Order of the rows in image array')
+
+    tags = metadata.get('tags', {})
+    if tags.get('EXIF:Model'):
+        header['INSTRUME'] = (str(tags['EXIF:Model']).strip(), 'instrument name')
+    if metadata.get('timestamp'):
+        header['DATE-OBS'] = (metadata['timestamp'], 'YYYY-MM-DDThh:mm:ss observation start')
+    if metadata.get('exposure') is not None:
+        header['EXPTIME'] = (metadata['exposure'], '[s] Exposure time duration')
+    if metadata.get('iso') is not None:
+        header['ISOSPEED'] = (metadata['iso'], 'ISO camera setting')
+    if metadata.get('temperature') is not None:
+        header['CCD-TEMP'] = (metadata['temperature'], '[degC] CCD temperature')
+    if tags.get('EXIF:FocalLength'):
+        header['FOCALLEN'] = (float(tags['EXIF:FocalLength']), '[mm] Focal length')
+
+    header['BAYERPAT'] = (pattern, 'Bayer color pattern')
+    header['XBAYROFF'] = (0, 'X offset of Bayer array')
+    header['YBAYROFF'] = (0, 'Y offset of Bayer array')
+    return header
+
+
+def _header_bytes(header: fits.Header, size: int = 0) -> bytes:
+    """
+    Header blocks, grown to `size` bytes with blank cards before END so
+    every HDU of a FITS sequence takes the same room
+    """
+    blocks = header.tostring().encode()
+    if len(blocks) >= size:
+        return blocks
+
+    end = blocks.rstrip(b' ').rfind(b'END')
+    return blocks[:end] + b' ' * (size - len(blocks)) + blocks[end:]
+
+
+def _stored(data: np.ndarray) -> bytes:
+    """
+    Data unit of a top-down uint16 image: bottom-up, big-endian int16 + BZERO
+    """
+    stored = (data[::-1] ^ np.uint16(0x8000)).astype('>u2')
+    return stored.tobytes()
+
+
+def _convert(task: tuple[str, dict, str]) -> str:
+    path, metadata, out = task
+    data, pattern = decode_raw(path)
+
+    header = raw_header(metadata, pattern, data.shape)
+    if compression():
+        return write_image(out, data[::-1], header)
+
+    tmp = f"{out}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(_header_bytes(header))
+        stored = _stored(data)
+        f.write(stored + b'\0' * (_padded(len(stored)) - len(stored)))
+    os.replace(tmp, out)
+    return out
+
+
+def _convert_hdu(task: tuple[str, dict, str, int, int, tuple[int, int], int]) -> int:
+    """
+    Writes a frame at its offset of a FITS sequence laid out by RawConverter
+    """
+    path, metadata, out, offset, header_size, shape, extension = task
+    data, pattern = decode_raw(path)
+    if data.shape != shape:
+        raise Exception(f"{path} is {data.shape}, the FITS sequence is laid out for {shape}")
+
+    header = _header_bytes(raw_header(
+        metadata, pattern, data.shape, extension=bool(extension)), header_size)
+    fd = os.open(out, os.O_WRONLY)
+    try:
+        os.pwrite(fd, header, offset)
+        os.pwrite(fd, _stored(data), offset + len(header))
+    finally:
+        os.close(fd)
+    return offset
+
+
+class RawConverter:
+    def __init__(self,
+                 process_dir: str,
+                 sequence: str,
+                 fits_extension: str = os.getenv('FITS_EXTENSION', 'fit'),
+                 fitseq: bool = False,
+                 workers: Optional[int] = None,
+                 exif: Optional[ExifService] = None
+                 ) -> None:
+        self.logger = Logger
+        self.process_dir = process_dir
+        self.sequence = sequence.rstrip('_')
+        self.fits_extension = fits_extension
+        self.fitseq = fitseq
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.exif = exif if exif else get_exif_service()
+
+    def _metadata(self, raws: list[str]) -> list[dict]:
+        # Workers only need the tags the header is written from
+        return [dict(m, tags={k: v for k, v in m['tags'].items() if k in HEADER_TAGS})
+                for m in self.exif.read(raws)]
+
+    def _convert_files(self, raws: list[str], metadata: list[dict]) -> str:
+        tasks = [(path, m, frame_file(self.process_dir, self.sequence, i + 1, self.fits_extension))
+                 for i, (path, m) in enumerate(zip(raws, metadata))]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(_convert, tasks))
+
+        return write_seq(self.process_dir, self.sequence, list(range(1, len(raws) + 1)),
+                         fz=compression() is not None)
+
+    def _convert_fitseq(self, raws: list[str], metadata: list[dict]) -> str:
+        """
+        Not compressed even with FITS_COMPRESSION, every HDU has to have a
+        known size to be written at its offset
+        """
+        # Every raw of a directory has the size of the first one, and its
+        # header the same number of blocks
+        data, pattern = decode_raw(raws[0])
+        header_size = max(len(_header_bytes(raw_header(m, pattern, data.shape, extension=bool(i))))
+                          for i, m in enumerate(metadata))
+        frame_size = header_size + _padded(data.size * 2)
+
+        out = os.path.join(self.process_dir, f"{self.sequence}.{self.fits_extension}")
+        tmp = f"{out}.tmp"
+        with open(tmp, 'wb') as f:
+            f.truncate(frame_size * len(raws))
+
+        tasks = [(path, m, tmp, i * frame_size, header_size, data.shape, i)
+                 for i, (path, m) in enumerate(zip(raws, metadata))]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(_convert_hdu, tasks))
+
+        os.replace(tmp, out)
+        return write_seq(self.process_dir, self.sequence, list(range(len(raws))), fitseq=True)
+
+    def run(self, raws: list[str]) -> str:
+        """
+        Converts the raws, in this order, returns the .seq file
+        """
+        if not raws:
+            raise Exception(f"No raws to convert for {self.sequence}")
+
+        os.makedirs(self.process_dir, exist_ok=True)
+        self.logger.info(
+            f"Converting {len(raws)} raws to {self.sequence} on {self.workers} workers")
+
+        metadata = self._metadata(raws)
+        seq = self._convert_fitseq(raws, metadata) if self.fitseq else self._convert_files(raws, metadata)
+
+        self.logger.info(f"Converted {len(raws)} raws: {seq}")
+        return seq
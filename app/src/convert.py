@@ -2,11 +2,15 @@ import os
 import os.path
 
 from pathlib import Path
+from typing import Optional
 import argparse
 
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
+from .conversion import RawConverter
+from .metadata import list_raws
+from .pool import get_siril
 from .logger import Logger as _Logger
 Logger = _Logger(__name__)
 
@@ -15,6 +19,10 @@ Converts a directory of images to FITS format
 
 Usage:
     poetry run python -m src.convert /siril-auto-stack/sample/pleiades-sm/lights -fitseq
+    poetry run python -m src.convert /siril-auto-stack/sample/pleiades-sm/lights --backend=native
+
+    from src.convert import convert
+    convert(siril, "/siril-auto-stack/sample/pleiades-sm/lights", fitseq=True)
 
 """
 
@@ -50,19 +58,21 @@ parser.add_argument('-debayer',
                     dest="debayer",
                     help="Should the images be debayered?")
 
-args = parser.parse_args()
-
-if args.out is None:
-    Logger.warning(
-        "Dest directory not specified with -o or --out - using src directory")
-    args.out = f"{args.src}/{process_dir_name}"
+parser.add_argument('-b', '--backend',
+                    required=False,
+                    type=str,
+                    default=os.getenv('CONVERT_BACKEND', 'siril'),
+                    dest="backend",
+                    choices=['siril', 'native'],
+                    help="Convert with Siril or decode the raws in a process pool (RawConverter)")
 
 
-App = Siril()  # type: ignore
-print('app success BANG')
-siril = Wrapper(App)  # type: ignore
+def convert(siril, src: str, out: Optional[str] = None, fitseq: bool = False, debayer: bool = False, backend: str = 'siril') -> bool:
+    if out is None:
+        Logger.warning(
+            "Dest directory not specified with -o or --out - using src directory")
+        out = f"{src}/{process_dir_name}"
 
-def convert(src=args.src, out=args.out, fitseq=args.fitseq, debayer=args.debayer) -> bool:
     siril.setcpu(cpu_cores)
     siril.set16bits()
     siril.setext(fits_extension)
@@ -78,6 +88,14 @@ def convert(src=args.src, out=args.out, fitseq=args.fitseq, debayer=args.debayer
 
     Logger.json("Conversion Params", conversion_params)
 
+    if backend == 'native':
+        if debayer:
+            raise Exception("The native converter only writes CFA frames")
+        RawConverter(os.path.join(src, out), name, fits_extension,
+                     fitseq=fitseq).run(list_raws(src))
+        Logger.info(f"Converted Frames: {src}")
+        return True
+
     [conversion_result] = siril.convert(name, **conversion_params)
 
     if conversion_result is not True:
@@ -90,9 +108,13 @@ def convert(src=args.src, out=args.out, fitseq=args.fitseq, debayer=args.debayer
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    App = get_siril()
+
     try:
         App.Open()
-        convert()
+        convert(Wrapper(App), args.src, out=args.out,  # type: ignore
+                fitseq=args.fitseq, debayer=args.debayer, backend=args.backend)
     except Exception as e:
         Logger.error(f"Error: {e}")
         exit(1)
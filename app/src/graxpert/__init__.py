@@ -0,0 +1 @@
+from .client import GraXpertWorker, get_graxpert_worker, graxpert, output_file, GRAXPERT_TIMEOUT
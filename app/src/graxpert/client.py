@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import atexit
+import itertools
+import subprocess
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Optional
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+GraXpert jobs sent to one long-lived worker process (see worker.py)
+
+Calling the graxpert command line for every image starts Python, imports
+GraXpert and loads the AI model each time. GraXpertWorker starts the worker
+on first use and keeps it: jobs are queued on its stdin and their results
+come back as Futures, so a caller can queue several images and do something
+else meanwhile.
+
+A job that takes longer than GRAXPERT_TIMEOUT seconds (1800 by default)
+kills the worker. A worker that crashed or was killed fails the jobs it had
+queued and is started again for the next job; run() retries a job once
+after a crash.
+
+GRAXPERT_WORKER=0 runs the command line for every job like before,
+GRAXPERT_RUNNER=stand-in runs the jobs without GraXpert (tests).
+
+Usage:
+    output = graxpert(starless_file, "background-extraction", ["-smoothing", "0.1", "-bg"])
+
+    worker = get_graxpert_worker()
+    futures = [worker.submit(f, "denoising") for f in files]
+    outputs = [f.result() for f in futures]
+"""
+
+GRAXPERT_TIMEOUT = float(os.getenv('GRAXPERT_TIMEOUT', '1800'))
+
+# Seconds to wait for the worker to import GraXpert and say it is ready
+START_TIMEOUT = 120
+
+
+def output_file(file: str) -> str:
+    """
+    Where GraXpert writes what it made of `file`
+    """
+    return f"{os.path.dirname(file)}/{Path(file).stem}_GraXpert.fits"
+
+
+class GraXpertWorker:
+    def __init__(self, runner: Optional[str] = None, timeout: float = GRAXPERT_TIMEOUT) -> None:
+        self.logger = Logger
+        self.runner = runner if runner else os.getenv('GRAXPERT_RUNNER', 'graxpert')
+        self.timeout = timeout
+        self.process: Optional[subprocess.Popen] = None
+        self.restarts = 0
+        self._ids = itertools.count(1)
+        # Job id -> Future of its output file
+        self._pending: dict[int, Future] = {}
+        self._ready: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker process, waits for GraXpert to be imported
+        """
+        with self._lock:
+            if self.alive():
+                return
+            # Run as `python -m src.graxpert.worker` from the directory of the src package
+            root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                [root] + [p for p in [os.getenv('PYTHONPATH')] if p]))
+
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", f"{__package__}.worker", "--runner", self.runner],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1, env=env)
+            self._ready = Future()
+            threading.Thread(target=self._read, args=(self.process, self._ready),
+                             name="graxpert-reader", daemon=True).start()
+            ready = self._ready
+
+        hello = ready.result(START_TIMEOUT)
+        self.logger.info(f"GraXpert worker started: {hello['runner']} (pid {hello['pid']})")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        with self._lock:
+            process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()  # type: ignore
+            process.wait(5)
+        except Exception:
+            process.kill()
+            process.wait()
+
+    def kill(self):
+        """
+        Hard stop of a worker that hangs, its queued jobs fail
+        """
+        with self._lock:
+            process = self.process
+        if process is not None and process.poll() is None:
+            self.logger.warning(f"Killing GraXpert worker (pid {process.pid})")
+            process.kill()
+
+    def _read(self, process: subprocess.Popen, ready: Future):
+        for line in process.stdout:  # type: ignore
+            result = json.loads(line)
+            if result['id'] is None:
+                if result['ok']:
+                    ready.set_result(result)
+                else:
+                    ready.set_exception(Exception(result['error']))
+                continue
+
+            with self._lock:
+                future = self._pending.pop(result['id'], None)
+            if future is None:
+                continue
+            if result['ok']:
+                self.logger.debug(f"GraXpert job {result['id']} done in {result['seconds']}s")
+                future.set_result(result['output'])
+            else:
+                future.set_exception(Exception(f"GraXpert failed: {result['error']}"))
+
+        # The worker is gone: every job it had fails
+        code = process.wait()
+        for pipe in [process.stdout, process.stdin]:
+            try:
+                pipe.close()  # type: ignore
+            except Exception:
+                pass
+        error = Exception(f"GraXpert worker exited with {code}")
+        if not ready.done():
+            ready.set_exception(error)
+
+        with self._lock:
+            if self.process is process:
+                self.process = None
+                self.restarts += 1
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def submit(self, file: str, command: str, args: Optional[list[str]] = None, gpu: bool = False) -> Future:
+        """
+        Queues a job, the Future gets the file GraXpert wrote
+        """
+        self.start()
+
+        job = {"id": next(self._ids), "command": command, "file": os.path.abspath(file),
+               "args": args if args else [], "gpu": gpu}
+        future: Future = Future()
+
+        with self._lock:
+            self._pending[job['id']] = future
+            process = self.process
+        try:
+            process.stdin.write(json.dumps(job) + "\n")  # type: ignore
+            process.stdin.flush()  # type: ignore
+        except Exception as e:
+            with self._lock:
+                self._pending.pop(job['id'], None)
+            future.set_exception(Exception(f"GraXpert worker is gone: {e}"))
+
+        return future
+
+    def run(self, file: str, command: str, args: Optional[list[str]] = None, gpu: bool = False) -> str:
+        """
+        Runs a job and waits for it, once more after a worker crash
+        """
+        for attempt in [1, 2]:
+            future = self.submit(file, command, args, gpu)
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                self.kill()
+                raise Exception(f"GraXpert {command} of {file} timed out after {self.timeout}s")
+            except Exception as e:
+                if attempt == 2 or self.alive():
+                    # GraXpert failed on this image, the worker is fine
+                    raise
+                self.logger.warning(f"Retrying GraXpert {command} of {file}: {e}")
+
+        raise Exception(f"GraXpert {command} of {file} failed")
+
+
+_worker: Optional[GraXpertWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_graxpert_worker() -> GraXpertWorker:
+    """
+    The process wide worker, stopped at exit
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = GraXpertWorker()
+            atexit.register(_worker.stop)
+    return _worker
+
+
+def graxpert(file: str, command: str, args: Optional[list[str]] = None, gpu: bool = False) -> str:
+    """
+    Runs a GraXpert command on `file`, returns the file it wrote
+    """
+    if os.getenv('GRAXPERT_WORKER', '1') != '0':
+        return get_graxpert_worker().run(file, command, args, gpu)
+
+    graxpert_cmd = [
+        "graxpert",
+        file,
+        "-cli",
+        *(args if args else []),
+        "-gpu", "true" if gpu else "false",
+        "--command", command
+    ]
+    subprocess.run(graxpert_cmd)
+    return output_file(file)
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from astropy.io import fits
+
+from .client import output_file
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Long-lived GraXpert process, started by GraXpertWorker (see client.py)
+
+Jobs come in on stdin and results go out on the original stdout, one JSON
+object per line, in the order the jobs came in:
+
+    {"id": 1, "command": "background-extraction", "file": "/.../starless.fit",
+     "args": ["-correction", "Subtraction", "-smoothing", "0.1", "-bg"],
+     "gpu": false}
+                            -> {"id": 1, "ok": true, "output": "/.../starless_GraXpert.fits",
+                                "seconds": 41.2}
+
+Whatever GraXpert prints goes to stderr, so it can't break the protocol.
+
+Runners:
+    graxpert    GraXpert's command line run in this process: Python and
+                GraXpert are imported once and the ONNX sessions of its
+                models are kept, every model is loaded from disk once
+    stand-in    no AI: background extraction subtracts the median of each
+                channel, denoising copies the image. For tests, without
+                GraXpert (GRAXPERT_STAND_IN_DELAY adds seconds per job)
+
+Usage:
+    poetry run python -m src.graxpert.worker --runner=stand-in
+"""
+
+
+def _cache_onnx_sessions():
+    """
+    GraXpert creates an onnxruntime.InferenceSession for every image, the
+    ones created with the same model and options are kept and reused
+    """
+    import onnxruntime  # type: ignore
+
+    sessions: dict = {}
+    InferenceSession = onnxruntime.InferenceSession
+
+    def cached(model, *args, **kwargs):
+        key = (str(model), repr(args), repr(sorted(kwargs.items())))
+        if key not in sessions:
+            Logger.info(f"Loading model {model}")
+            sessions[key] = InferenceSession(model, *args, **kwargs)
+        return sessions[key]
+
+    onnxruntime.InferenceSession = cached
+
+
+class GraXpertRunner:
+    def __init__(self) -> None:
+        from graxpert.main import main  # type: ignore
+
+        self.main = main
+        try:
+            _cache_onnx_sessions()
+        except ImportError:
+            Logger.warning("onnxruntime not found, GraXpert models are loaded for every job")
+
+    def run(self, command: str, file: str, args: list[str], gpu: bool) -> str:
+        argv = sys.argv
+        sys.argv = ["graxpert", file, "-cli", *args,
+                    "-gpu", "true" if gpu else "false", "--command", command]
+        try:
+            self.main()
+        except SystemExit as e:
+            if e.code not in [None, 0]:
+                raise Exception(f"GraXpert {command} exited with {e.code}")
+        finally:
+            sys.argv = argv
+
+        if not os.path.isfile(output_file(file)):
+            raise Exception(f"GraXpert {command} wrote no {output_file(file)}")
+        return output_file(file)
+
+
+class StandInRunner:
+    def __init__(self) -> None:
+        self.delay = float(os.getenv('GRAXPERT_STAND_IN_DELAY', '0'))
+
+    def run(self, command: str, file: str, args: list[str], gpu: bool) -> str:
+        with fits.open(file) as hdul:
+            hdu = next(h for h in hdul if h.is_image and h.data is not None)
+            data = hdu.data.astype(np.float32)
+            header = hdu.header.copy()
+
+        if command == 'background-extraction':
+            axes = (-2, -1)
+            data = data - np.median(data, axis=axes, keepdims=True) + np.float32(0.1) * data.max()
+        elif command != 'denoising':
+            raise Exception(f"Unknown GraXpert command: {command}")
+
+        time.sleep(self.delay)
+        for key in ['BZERO', 'BSCALE']:
+            header.remove(key, ignore_missing=True)
+        fits.PrimaryHDU(data, header=header).writeto(output_file(file), overwrite=True)
+        return output_file(file)
+
+
+RUNNERS = {
+    'graxpert': GraXpertRunner,
+    'stand-in': StandInRunner,
+}
+
+
+def serve(runner_name: str):
+    # The protocol keeps the real stdout, anything printed goes to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    try:
+        runner = RUNNERS[runner_name]()
+    except Exception as e:
+        protocol.write(json.dumps({"id": None, "ok": False, "error": f"Failed to start {runner_name}: {e}"}) + "\n")
+        return
+
+    protocol.write(json.dumps({"id": None, "ok": True, "runner": runner_name, "pid": os.getpid()}) + "\n")
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        started = time.perf_counter()
+        try:
+            output = runner.run(job['command'], job['file'], job.get('args', []), job.get('gpu', False))
+            result = {"id": job['id'], "ok": True, "output": output}
+        except Exception as e:
+            result = {"id": job['id'], "ok": False, "error": str(e)}
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        protocol.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GraXpert worker")
+    parser.add_argument('-r', '--runner',
+                        required=False,
+                        type=str,
+                        default=os.getenv('GRAXPERT_RUNNER', 'graxpert'),
+                        choices=list(RUNNERS),
+                        dest="runner",
+                        help="What runs the jobs")
+
+    args = parser.parse_args()
+
+    try:
+        serve(args.runner)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
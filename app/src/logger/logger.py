@@ -1,8 +1,9 @@
 import logging
-import inspect
 import pprint
+import sys
 from datetime import datetime, timedelta
 from .color import *
+from .writer import write, flush
 import os
 
 # https://pygments.org/docs/styles/#ansiterminalstyle
@@ -29,90 +30,117 @@ dracula
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 
-def pprint_color(obj) -> None:
+def pprint_color(obj) -> str:
     """Pretty-print in color."""
-    print(
-        highlight(
-            pprint.pformat(obj, indent=1, depth=4, width=80, compact=True),
-            PythonLexer(),
-            Terminal256Formatter(style=get_style_by_name("dracula")),
-        ),
-        end="",
+    return highlight(
+        pprint.pformat(obj, indent=1, depth=4, width=80, compact=True),
+        PythonLexer(),
+        Terminal256Formatter(style=get_style_by_name("dracula")),
     )
 
 
+def message(msg, args) -> str:
+    """
+    msg % args like logging, with the args appended when msg has no
+    placeholder for them (ie: Logger.warning("Failed to delete raws", e))
+    """
+    if not args:
+        return f"{msg}"
+    try:
+        return f"{msg}" % args
+    except (TypeError, ValueError):
+        return " ".join(f"{a}" for a in (msg, *args))
+
+
 class Logger(logging.Logger):
-    format_string = f"%(message)s"
+    """
+    Lines are written by a background thread (see writer.py). The caller
+    file and line are only looked up when the level is enabled, LOG_LEVEL
+    (DEBUG by default) sets the level
+    """
 
     def inspector(self):
-        return inspect.stack()[2].filename, inspect.stack()[2].lineno
+        frame = sys._getframe(2)
+        return frame.f_code.co_filename, frame.f_lineno
 
     def __init__(self, name):
-        super().__init__(name)
-        formatter = logging.Formatter(self.format_string, datefmt=TIME_FORMAT)
-        shandler = logging.StreamHandler()
-        shandler.setFormatter(formatter)
-        shandler.setLevel(logging.NOTSET)
-        self.handler = shandler
-        self.handlers.append(shandler)
+        super().__init__(name, os.getenv('LOG_LEVEL', 'DEBUG').upper())
+
+    def flush(self):
+        flush()
 
     def log(self, msg, *args, **kwargs):
-        colored_message = f"{msg}"
-        super().debug(colored_message, *args, **kwargs)
+        if not self.isEnabledFor(logging.DEBUG):
+            return
+        write((sys.stderr, f"{message(msg, args)}\n"))
 
     def debug(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.DEBUG):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
         fileName, lineno = self.inspector()
-        colored_message = f"{fg.MAGENTA}[DEBUG]{fg.RESET} {time} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}\n{style.DIM}{msg}{style.RESET_ALL}"
-        super().debug(colored_message, *args, **kwargs)
+        colored_message = f"{fg.MAGENTA}[DEBUG]{fg.RESET} {time} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}\n{style.DIM}{message(msg, args)}{style.RESET_ALL}"
+        write((sys.stderr, f"{colored_message}\n"))
 
     def config(self, c, *args, **kwargs):
+        if not self.isEnabledFor(logging.INFO):
+            return
         colored_message = f"{fg.CYAN}{style.BRIGHT}[{c.name}]{bg.RESET}{style.RESET_ALL} {fg.CYAN}{c.get()} {style.RESET_ALL}{fg.RESET}{style.RESET_ALL}"
-        super().info(colored_message, *args, **kwargs)
-        pprint_color(c.options())
+        write((sys.stderr, f"{message(colored_message, args)}\n"),
+              (sys.stdout, pprint_color(c.options())))
 
     def action(self, name, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.INFO):
+            return
         colored_message = (
-            f"{fg.GREEN}[{name}]{fg.RESET} {fg.WHITE}{msg}{style.RESET_ALL}"
+            f"{fg.GREEN}[{name}]{fg.RESET} {fg.WHITE}{message(msg, args)}{style.RESET_ALL}"
         )
-        super().info(colored_message, *args, **kwargs)
+        write((sys.stderr, f"{colored_message}\n"))
 
     def info(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.INFO):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
         fileName, lineno = self.inspector()
+        msg = message(msg, args)
         colored_message = f"{time} {fg.GREEN}[INFO] {msg}{fg.RESET} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}"
-        super().info(colored_message, *args, **kwargs)
-        with open(INFO_LOG_FILE, "a") as f:
-            f.write(
-                f"{time} {fileName.replace('/home/stephen/siril-auto-stack/app/src/', '')}#{lineno} {msg}\n")
+        write((sys.stderr, f"{colored_message}\n"),
+              (os.getenv('INFO_LOG_FILE', INFO_LOG_FILE),
+               f"{time} {fileName.replace('/home/stephen/siril-auto-stack/app/src/', '')}#{lineno} {msg}\n"))
 
     def warning(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.WARNING):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
         colored_message = (
-            f"{fg.YELLOW}[WARN]{fg.RESET} {time} {fg.YELLOW}{msg}{fg.RESET}"
+            f"{fg.YELLOW}[WARN]{fg.RESET} {time} {fg.YELLOW}{message(msg, args)}{fg.RESET}"
         )
-        super().warning(colored_message, *args, **kwargs)
+        write((sys.stderr, f"{colored_message}\n"))
 
     def error(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.ERROR):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
         fileName, lineno = self.inspector()
+        msg = message(msg, args)
         colored_message = f"{fg.RED}[ERROR] {fg.RED}{msg}{fg.RESET} {time} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}"
-        super().error(colored_message, *args, **kwargs)
-        with open(ERROR_LOG_FILE, "a") as f:
-            f.write(f"{time} {fileName}#{lineno} {msg}\n")
+        write((sys.stderr, f"{colored_message}\n"),
+              (os.getenv('ERROR_LOG_FILE', ERROR_LOG_FILE), f"{time} {fileName}#{lineno} {msg}\n"))
 
     def critical(self, msg, *args, **kwargs):
+        if not self.isEnabledFor(logging.CRITICAL):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
-        colored_message = f"{time} {fg.RED}{style.BRIGHT}'[CRITICAL] {style.RESET_ALL}\n{fg.RED}{msg}{fg.RESET}"
-        super().critical(colored_message, *args, **kwargs)
+        colored_message = f"{time} {fg.RED}{style.BRIGHT}'[CRITICAL] {style.RESET_ALL}\n{fg.RED}{message(msg, args)}{fg.RESET}"
+        write((sys.stderr, f"{colored_message}\n"))
 
     def json(self, msg, json):
+        if not self.isEnabledFor(logging.INFO):
+            return
         time = datetime.now().strftime(TIME_FORMAT)
         fileName, lineno = self.inspector()
-        super().info(
-            f"{fg.BLUE}{msg}{fg.RESET} {time} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}"
-        )
-        pprint_color(json)
+        write((sys.stderr, f"{fg.BLUE}{msg}{fg.RESET} {time} {style.DIM}{fileName}#{lineno}{style.RESET_ALL}\n"),
+              (sys.stdout, pprint_color(json)))
 
 # def time(self, *args, **kwargs):
 #     super().debug(datetime.now().strftime("%H:%M:%S"), *args, **kwargs)
@@ -0,0 +1,146 @@
+import os
+import sys
+import queue
+import atexit
+import threading
+from typing import Optional
+
+"""
+Background writer of the log lines
+
+Logger formats a line and hands it over with write(): the console and the
+log files are written by one daemon thread, which drains whatever is
+queued and writes it in one go per destination, so logging never waits on
+the terminal or the disk. Log files are opened once, in append mode, and
+shared with forked processes.
+
+A forked process (pool workers, pipeline stages) writes synchronously: it
+can exit with os._exit(), without running the atexit flush of a writer
+thread. LOG_ASYNC=0 writes synchronously everywhere.
+
+Usage:
+    write((sys.stderr, line), (INFO_LOG_FILE, f"{line}\\n"))
+    flush()  # everything written so far is on the console and in the files
+"""
+
+# Longest wait of flush() for the writer thread, in seconds
+FLUSH_TIMEOUT = 5
+
+_STOP = object()
+
+
+class LogWriter:
+    def __init__(self) -> None:
+        self.synchronous = os.getenv('LOG_ASYNC', '1') == '0'
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # Log file path -> file descriptor
+        self._files: dict[str, int] = {}
+
+    def write(self, *entries: tuple) -> None:
+        """
+        entries: (stream or log file path, text)
+        """
+        if self.synchronous:
+            with self._lock:
+                self._write(list(entries))
+            return
+
+        if self._thread is None:
+            self._start()
+        self._queue.put(entries)
+
+    def flush(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(FLUSH_TIMEOUT)
+
+    def stop(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(FLUSH_TIMEOUT)
+
+    def after_fork(self) -> None:
+        """
+        The child drops what the parent had queued (the parent writes it)
+        and writes its own lines synchronously
+        """
+        self.synchronous = True
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._write([entry for item in items if isinstance(item, tuple) for entry in item])
+
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if any(item is _STOP for item in items):
+                return
+
+    def _write(self, entries: list[tuple]) -> None:
+        # Console lines keep their order across stdout and stderr, every log
+        # file gets one write
+        runs: list[tuple] = []
+        files: dict[str, list[str]] = {}
+        for target, text in entries:
+            if isinstance(target, str):
+                files.setdefault(target, []).append(text)
+            elif runs and runs[-1][0] is target:
+                runs[-1][1].append(text)
+            else:
+                runs.append((target, [text]))
+
+        for target, texts in runs + list(files.items()):
+            text = "".join(texts)
+            try:
+                if isinstance(target, str):
+                    os.write(self._file(target), text.encode())
+                else:
+                    target.write(text)
+                    target.flush()
+            except Exception as e:
+                # Logging must not bring the pipeline down
+                sys.__stderr__.write(f"[log-writer] Failed to write to {target}: {e}\n")
+
+    def _file(self, path: str) -> int:
+        if path not in self._files:
+            self._files[path] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return self._files[path]
+
+
+_writer = LogWriter()
+
+atexit.register(_writer.stop)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_writer.after_fork)
+
+
+def write(*entries: tuple) -> None:
+    _writer.write(*entries)
+
+
+def flush() -> None:
+    """
+    Waits for the lines logged so far to be written
+    """
+    _writer.flush()
@@ -5,7 +5,9 @@ from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
 import argparse
-from .siril import SirilWrapper, Frame, PostProcess, Session
+from .siril import SirilWrapper, Frame, PostProcess, Session, traced, trace_context, get_tracer
+from .siril.trace import tracing_enabled
+from .pipeline import SessionPipeline
 from .logger import Logger as _Logger
 
 with open(os.environ['INFO_LOG_FILE'], 'r+') as f:
@@ -75,13 +77,27 @@ session = Session(
 
 siril = SirilWrapper(
     sirilApp=_Siril,  # type: ignore
-    sirilWrapper=Wrapper(_Siril),  # type: ignore
+    sirilWrapper=traced(Wrapper(_Siril), name="main"),  # type: ignore
     remove_work=DELETE_WORK_AFTER_PROCESSING,
     session=session
 )
 
 post = PostProcess(siril, lights)
 
+
+def report_trace():
+    """
+    Per-stage summary of the Siril commands and the Chrome trace, written to
+    SIRIL_TRACE_FILE ({workdir}/siril_trace.json by default)
+    """
+    if not tracing_enabled():
+        return
+
+    tracer = get_tracer()
+    tracer.summary()
+    tracer.write(os.getenv('SIRIL_TRACE_FILE', os.path.join(args.workdir, 'siril_trace.json')))
+
+
 try:
     """
     TODO: Add support for stacking multiple nights
@@ -96,21 +112,23 @@ try:
     siril.start()
 
     def post_process():
-        post\
-            .load(siril.get_stacked_file(lights))\
-            .nebula(
-                stretch=True,
-                ra=siril.target_ra,  # decimal degrees
-                dec=siril.target_dec,  # decimal degrees
-                remove_work=True,
-                denoise=False,
-                star_stretch=True,
-                extra_star_denoise=False,
-            )
-
-    siril.preprocess(darks, delete_raws=True)
-    siril.preprocess(flats, delete_raws=True)
-    siril.preprocess(lights, delete_raws=True)
+        with trace_context(stage='postprocess', frame=lights.name):
+            post\
+                .load(siril.get_stacked_file(lights))\
+                .nebula(
+                    stretch=True,
+                    ra=siril.target_ra,  # decimal degrees
+                    dec=siril.target_dec,  # decimal degrees
+                    remove_work=True,
+                    denoise=False,
+                    star_stretch=True,
+                    extra_star_denoise=False,
+                )
+
+    # Darks, flats and every night of lights are scheduled as one graph
+    # STACK_INCREMENTAL=1 adds every night to the target's accumulated stack
+    SessionPipeline(session, delete_raws=True,
+                    incremental=os.getenv('STACK_INCREMENTAL', '0') != '0').run()
 
     # siril.stack(lights, rmgreen=False)
 
@@ -128,10 +146,12 @@ try:
     """
 
     siril.stop()
+    report_trace()
     Logger.info("[COMPLETED] Success!")
 except Exception as e:
     Logger.error(e)
     siril.stop()
+    report_trace()
     Logger.error("[COMPLETED] Error!")
     exit(1)
 
@@ -0,0 +1,58 @@
+import argparse
+
+from .siril import MasterLibrary
+from .logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Indexes and queries the master library (BIAS_LIBRARY / MASTER_LIBRARY_PATH)
+
+Usage:
+    poetry run python -m src.masters --refresh
+    poetry run python -m src.masters -t darks -m Canon_EOS_Rebel_T8i -i 800 -e 120 --temperature=18
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-t', '--type',
+                        required=False,
+                        type=str,
+                        default=None,
+                        dest="type",
+                        choices=['biases', 'darks', 'flats'],
+                        help="Master type to list or look up")
+
+    parser.add_argument('-m', '--model', type=str, default=None, dest="model",
+                        help="Camera model, ie: Canon_EOS_Rebel_T8i")
+    parser.add_argument('-i', '--iso', type=int, default=None, dest="iso")
+    parser.add_argument('-e', '--exposure', type=float, default=None, dest="exposure",
+                        help="Exposure in seconds")
+    parser.add_argument('--temperature', type=float, default=None, dest="temperature",
+                        help="Sensor temperature in °C")
+    parser.add_argument('--date', type=str, default=None, dest="date",
+                        help="ISO date of the session, ie: 2023-10-14")
+
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        dest="refresh",
+                        help="Re-read every directory, not only the ones that changed")
+
+    args = parser.parse_args()
+    library = MasterLibrary()
+    library.refresh(full=args.refresh)
+
+    if args.model and args.type:
+        master = library.nearest(args.type, args.model, args.iso,
+                                 exposure=args.exposure,
+                                 temperature=args.temperature,
+                                 date=args.date)
+        Logger.info(f"Nearest master: {master}" if master else "No matching master")
+    else:
+        for master in library.masters(args.type):
+            Logger.info(
+                f"{master['type']} {master['model']} ISO {master['iso']} {master['exposure']}s {master['temperature']}°C {master['date']}: {master['path']}")
+
+    library.close()
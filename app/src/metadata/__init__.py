@@ -0,0 +1 @@
+from .exif import ExifService, get_exif_service, frame_metadata, list_raws, RAW_EXTENSIONS
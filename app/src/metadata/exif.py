@@ -0,0 +1,196 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Optional
+from exiftool import ExifToolHelper  # type: ignore
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+EXIF of whole frame directories, read once
+
+All the raws of a directory go to one persistent exiftool process in a
+single batch, and what it returns is cached in SQLite keyed by (path, size,
+mtime). Unchanged files never reach exiftool again, across runs too.
+
+Every frame comes back as a dict:
+
+    {
+        'path': '/.../lights/IMG_0001.CR3',
+        'model': 'Canon_EOS_Rebel_T8i',
+        'iso': 800,
+        'exposure': 120.0,                  # seconds
+        'temperature': 18.0,                # sensor, °C, None when unknown
+        'timestamp': '2023-10-14T22:01:13',
+        'tags': {...}                       # everything exiftool returned
+    }
+
+Usage:
+    exif = get_exif_service()
+    frames = exif.read_directory(lights_dir)
+    exif.first(lights_dir)['iso']
+"""
+
+RAW_EXTENSIONS = os.getenv(
+    'RAW_EXTENSIONS', 'cr2,cr3,nef,arw,raf,orf,rw2,dng').lower().split(',')
+
+EXIF_CACHE = os.getenv('EXIF_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'siril-auto-stacker', 'exif.sqlite'))
+
+# Files per exiftool call, keeps the command line and the reply bounded
+BATCH_SIZE = 256
+
+TAGS = [
+    "EXIF:ISO", "EXIF:Make", "EXIF:Model", "EXIF:ExposureTime",
+    "EXIF:DateTimeOriginal", "EXIF:FNumber", "EXIF:FocalLength",
+    "MakerNotes:CameraTemperature", "MakerNotes:AmbientTemperature",
+    "MakerNotes:BulbDuration", "Composite:ImageSize", "Composite:LensID",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exif (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    tags TEXT
+);
+"""
+
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value) if value not in [None, ''] else None
+    except (TypeError, ValueError):
+        return None
+
+
+def frame_metadata(path: str, tags: dict) -> dict:
+    model = tags.get('EXIF:Model')
+    iso = _number(tags.get('EXIF:ISO'))
+    timestamp = tags.get('EXIF:DateTimeOriginal')
+    temperature = _number(tags.get('MakerNotes:CameraTemperature'))
+    if temperature is None:
+        temperature = _number(tags.get('MakerNotes:AmbientTemperature'))
+
+    return {
+        'path': path,
+        'model': str(model).strip().replace(' ', '_') if model else None,
+        'iso': int(iso) if iso is not None else None,
+        'exposure': _number(tags.get('EXIF:ExposureTime')),
+        'temperature': temperature,
+        # 2023:10:14 22:01:13 -> 2023-10-14T22:01:13
+        'timestamp': str(timestamp).replace(':', '-', 2).replace(' ', 'T') if timestamp else None,
+        'tags': tags,
+    }
+
+
+def list_raws(directory: str) -> list[str]:
+    return sorted([
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if not f.startswith('.') and f.split('.')[-1].lower() in RAW_EXTENSIONS
+    ])
+
+
+class ExifService:
+    def __init__(self, cache: str = EXIF_CACHE) -> None:
+        self.logger = Logger
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._exiftool: Optional[ExifToolHelper] = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        self.db = sqlite3.connect(cache, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def _tool(self) -> ExifToolHelper:
+        """
+        One exiftool process (-stay_open) for the life of the service
+        """
+        if self._exiftool is None:
+            # A broken file must not fail the whole batch
+            self._exiftool = ExifToolHelper(check_execute=False)
+        return self._exiftool
+
+    def read(self, files: list[str]) -> list[dict]:
+        """
+        Metadata of every file, in order. Only the files that are not
+        cached, or changed since, are read by exiftool
+        """
+        files = [os.path.abspath(f) for f in files]
+        stats = {f: os.stat(f) for f in files}
+
+        with self._lock:
+            cached = {}
+            for i in range(0, len(files), BATCH_SIZE):
+                batch = files[i:i + BATCH_SIZE]
+                cached.update({path: (size, mtime_ns, tags) for path, size, mtime_ns, tags in self.db.execute(
+                    f"SELECT path, size, mtime_ns, tags FROM exif WHERE path IN ({','.join('?' * len(batch))})", batch)})
+
+            tags = {}
+            missing = []
+            for f in files:
+                entry = cached.get(f)
+                if entry and entry[:2] == (stats[f].st_size, stats[f].st_mtime_ns):
+                    tags[f] = json.loads(entry[2])
+                else:
+                    missing.append(f)
+
+            if missing:
+                self.logger.info(f"Reading EXIF of {len(missing)} files")
+                tags.update(self._read(missing, stats))
+
+        return [frame_metadata(f, tags.get(f, {})) for f in files]
+
+    def _read(self, files: list[str], stats: dict) -> dict:
+        tags = {}
+
+        for i in range(0, len(files), BATCH_SIZE):
+            batch = files[i:i + BATCH_SIZE]
+            results = self._tool().get_tags(files=batch, tags=TAGS)
+            # exiftool reports the files it could read, keyed by SourceFile
+            by_file = {os.path.abspath(r.get('SourceFile', '')): r for r in results}
+
+            with self.db:
+                for f in batch:
+                    result = {k: v for k, v in by_file.get(f, {}).items() if k != 'SourceFile'}
+                    tags[f] = result
+                    self.db.execute("INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?)",
+                                    (f, stats[f].st_size, stats[f].st_mtime_ns, json.dumps(result)))
+
+        return tags
+
+    def read_directory(self, directory: str) -> list[dict]:
+        """
+        Metadata of every raw of a directory, in file name order
+        """
+        return self.read(list_raws(directory))
+
+    def first(self, directory: str) -> dict:
+        raws = list_raws(directory)
+        if not raws:
+            raise Exception(f"No raw frames in {directory}")
+        return self.read(raws[:1])[0]
+
+    def close(self):
+        with self._lock:
+            if self._exiftool is not None:
+                if self._exiftool.running:
+                    self._exiftool.terminate()
+                self._exiftool = None
+            self.db.close()
+
+
+_service: Optional[ExifService] = None
+
+
+def get_exif_service() -> ExifService:
+    """
+    The process wide service, its exiftool process is started on first use
+    """
+    global _service
+    if _service is None:
+        _service = ExifService()
+    return _service
@@ -0,0 +1,3 @@
+from .graph import Node, Pipeline
+from .manifest import Manifest
+from .session import SessionPipeline
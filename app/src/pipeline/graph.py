@@ -0,0 +1,224 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Optional
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Dependency-aware scheduler
+
+A Pipeline is a graph of Nodes. A node starts as soon as every node it
+depends on has completed and its cpu / ram cost fits in what is left of the
+budget. A node that is bigger than the whole budget still runs, but alone.
+
+Usage:
+    pipeline = Pipeline(cpu_budget=20, ram_budget=32)
+    pipeline.add(Node("convert:darks_1", convert_darks, cpu=2))
+    pipeline.add(Node("stack:darks_1", stack_darks, deps=["convert:darks_1"], cpu=4))
+    pipeline.run()
+"""
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def total_ram_gb() -> float:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return 8.0
+
+
+class Node:
+    def __init__(self,
+                 name: str,
+                 task: Callable,
+                 deps: Optional[list[str]] = None,
+                 cpu: int = 1,
+                 ram: float = 0,
+                 stage: Optional[str] = None
+                 ) -> None:
+        """
+        name: unique name of the node, ie: "calibrate:lights_1"
+        task: called with the node once its dependencies are done
+        deps: names of the nodes this one waits for
+        cpu: cores the task uses (also handed to Siril with setcpu)
+        ram: GB of memory the task is expected to use
+        """
+        self.name = name
+        self.task = task
+        self.deps = list(deps) if deps else []
+        self.cpu = cpu
+        self.ram = ram
+        self.stage = stage if stage else name.split(':')[0]
+
+        self.status = PENDING
+        # Set by tasks that found their outputs already up to date
+        self.cached = False
+        self.result = None
+        self.error: Optional[Exception] = None
+        self.started: Optional[float] = None
+        self.elapsed: float = 0
+
+    def __repr__(self) -> str:
+        return f"<Node {self.name} {self.status} {self.elapsed:.1f}s>"
+
+
+class Pipeline:
+    def __init__(self,
+                 cpu_budget: Optional[int] = None,
+                 ram_budget: Optional[float] = None
+                 ) -> None:
+        self.logger = Logger
+        self.cpu_budget = cpu_budget if cpu_budget else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.ram_budget = ram_budget if ram_budget else float(
+            os.getenv('RAM_BUDGET_GB', total_ram_gb()))
+        self.nodes: dict[str, Node] = {}
+
+    def add(self, node: Node) -> Node:
+        if node.name in self.nodes:
+            raise Exception(f"Duplicate pipeline node: {node.name}")
+
+        # A node can never ask for more than the whole machine
+        node.cpu = max(1, min(node.cpu, self.cpu_budget))
+        self.nodes[node.name] = node
+        return node
+
+    def validate(self):
+        for node in self.nodes.values():
+            for dep in node.deps:
+                if dep not in self.nodes:
+                    raise Exception(
+                        f"{node.name} depends on unknown node: {dep}")
+
+        # Kahn's algorithm, anything left over is part of a cycle
+        indegree = {name: len(n.deps) for name, n in self.nodes.items()}
+        ready = [name for name, d in indegree.items() if d == 0]
+        visited = 0
+
+        while ready:
+            name = ready.pop()
+            visited += 1
+            for child in self.dependents(name):
+                indegree[child.name] -= 1
+                if indegree[child.name] == 0:
+                    ready.append(child.name)
+
+        if visited != len(self.nodes):
+            cycle = [name for name, d in indegree.items() if d > 0]
+            raise Exception(f"Pipeline has a dependency cycle: {cycle}")
+
+    def dependents(self, name: str) -> list[Node]:
+        return [n for n in self.nodes.values() if name in n.deps]
+
+    def _priorities(self) -> dict[str, int]:
+        """
+        Length of the longest chain of work waiting on each node so the
+        critical path (ie: lights) is started before side branches
+        """
+        priorities: dict[str, int] = {}
+
+        def priority(name: str) -> int:
+            if name not in priorities:
+                children = self.dependents(name)
+                priorities[name] = 1 + \
+                    max([priority(c.name) for c in children], default=0)
+            return priorities[name]
+
+        for name in self.nodes:
+            priority(name)
+
+        return priorities
+
+    def _fits(self, node: Node, running: list[Node]) -> bool:
+        if not running:
+            return True
+
+        cpu = sum([n.cpu for n in running])
+        ram = sum([n.ram for n in running])
+        return cpu + node.cpu <= self.cpu_budget and ram + node.ram <= self.ram_budget
+
+    def _run_node(self, node: Node) -> Node:
+        node.started = time.perf_counter()
+        self.logger.info(
+            f"[{node.name}] Started (cpu: {node.cpu}, ram: {node.ram}GB)")
+
+        try:
+            node.result = node.task(node)
+            node.status = DONE
+            self.logger.info(f"[{node.name}] Completed")
+        except Exception as e:
+            node.error = e
+            node.status = FAILED
+            self.logger.error(f"[{node.name}] Failed: {e}")
+        finally:
+            node.elapsed = time.perf_counter() - node.started
+
+        return node
+
+    def _skip(self, node: Node, reason: str):
+        node.status = SKIPPED
+        self.logger.warning(f"[{node.name}] Skipped: {reason}")
+
+    def run(self) -> dict[str, Node]:
+        self.validate()
+        priorities = self._priorities()
+
+        pending = sorted(self.nodes.values(),
+                         key=lambda n: priorities[n.name], reverse=True)
+        running: dict = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.nodes))) as pool:
+            while pending or running:
+                for node in list(pending):
+                    deps = [self.nodes[d] for d in node.deps]
+
+                    if any([d.status in [FAILED, SKIPPED] for d in deps]):
+                        pending.remove(node)
+                        self._skip(node, "an upstream node did not complete")
+                        continue
+
+                    if not all([d.status == DONE for d in deps]):
+                        continue
+
+                    if not self._fits(node, list(running.values())):
+                        continue
+
+                    pending.remove(node)
+                    node.status = RUNNING
+                    running[pool.submit(self._run_node, node)] = node
+
+                if not running:
+                    # Nothing can start and nothing will finish
+                    for node in pending:
+                        self._skip(node, "dependencies can never complete")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+
+        self.summary()
+        return self.nodes
+
+    def failed(self) -> list[Node]:
+        return [n for n in self.nodes.values() if n.status in [FAILED, SKIPPED]]
+
+    def raise_for_errors(self):
+        failed = self.failed()
+        if failed:
+            raise Exception(
+                f"Pipeline failed: {', '.join([n.name for n in failed])}", [n.error for n in failed if n.error])
+
+    def summary(self):
+        for node in self.nodes.values():
+            status = "cached" if node.cached else node.status
+            self.logger.info(
+                f"{status.upper():8} {node.elapsed:8.1f}s  {node.name}")
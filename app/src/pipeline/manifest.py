@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from typing import Optional
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Per working directory record of what every pipeline stage last ran with
+
+For every stage the manifest stores a fingerprint made of:
+    - a fast content hash of each input file
+    - the stage parameters (calibrate_params, stack_params, ...)
+    - the fingerprints of the stages it depends on
+and the content hash of each file the stage produced. The parameters and
+dependencies are also kept as a fingerprint of their own (settings): once
+convert deleted the raws, its missing inputs alone don't make it stale, a
+change of its settings still does.
+
+A stage is skipped when its fingerprint is unchanged and its outputs are
+still on disk untouched. Because a stage's fingerprint includes the
+fingerprints of its dependencies, a change cascades downstream only: a new
+master flat for night 1 re-runs the calibration of night 1's lights (and
+the merge / register / stack after it) but not night 2.
+"""
+
+MANIFEST_FILE_NAME = os.getenv('MANIFEST_FILE_NAME', '.manifest.json')
+
+# Files larger than this are hashed from a few samples instead of in full
+SAMPLE_SIZE = 1024 * 1024
+FULL_HASH_LIMIT = 4 * SAMPLE_SIZE
+
+
+def content_hash(file: str) -> str:
+    """
+    Fast content hash: small files are hashed in full, large ones from
+    their size plus the first, middle and last MB
+    """
+    size = os.path.getsize(file)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+
+    with open(file, 'rb') as f:
+        if size <= FULL_HASH_LIMIT:
+            h.update(f.read())
+        else:
+            for offset in [0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE]:
+                f.seek(offset)
+                h.update(f.read(SAMPLE_SIZE))
+
+    return h.hexdigest()
+
+
+class Manifest:
+    def __init__(self, working_dir: str, file_name: str = MANIFEST_FILE_NAME) -> None:
+        self.logger = Logger
+        self.path = os.path.join(working_dir, file_name)
+        self.stages: dict = {}
+        # path -> [size, mtime_ns, hash] so unchanged files are never re-read
+        self.hashes: dict = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.stages = data.get('stages', {})
+            self.hashes = data.get('hashes', {})
+        except Exception as e:
+            self.logger.warning(
+                f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def save(self):
+        # Nodes record from their own threads: one save at a time, each
+        # through its own tmp file so another process can't clobber it
+        with self._lock:
+            data = json.dumps(
+                {'stages': self.stages, 'hashes': self.hashes}, indent=1, sort_keys=True)
+
+            fd, tmp = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix=".tmp",
+                                       dir=os.path.dirname(self.path))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    def hash_file(self, file: str) -> str:
+        stat = os.stat(file)
+        key = os.path.abspath(file)
+
+        with self._lock:
+            cached = self.hashes.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        digest = content_hash(file)
+        with self._lock:
+            self.hashes[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def hash_files(self, files: list[str]) -> dict[str, str]:
+        return {os.path.abspath(f): self.hash_file(f) for f in sorted(files) if os.path.isfile(f)}
+
+    def _update_settings(self, h, params: Optional[dict], deps: Optional[list[str]]):
+        h.update(json.dumps(params if params else {},
+                 sort_keys=True, default=str).encode())
+
+        for dep in sorted(deps if deps else []):
+            h.update(f"{dep}={self.get_fingerprint(dep)}".encode())
+
+    def fingerprint(self, inputs: list[str], params: Optional[dict] = None, deps: Optional[list[str]] = None) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(self.hash_files(inputs), sort_keys=True).encode())
+        self._update_settings(h, params, deps)
+        return h.hexdigest()
+
+    def settings(self, params: Optional[dict] = None, deps: Optional[list[str]] = None) -> str:
+        """
+        The part of the fingerprint that doesn't come from the input files
+        """
+        h = hashlib.blake2b(digest_size=16)
+        self._update_settings(h, params, deps)
+        return h.hexdigest()
+
+    def get_fingerprint(self, stage: str) -> Optional[str]:
+        with self._lock:
+            record = self.stages.get(stage)
+        return record['fingerprint'] if record else None
+
+    def outputs_intact(self, stage: str) -> bool:
+        with self._lock:
+            record = self.stages.get(stage)
+        if not record or not record['outputs']:
+            return False
+
+        for file, digest in record['outputs'].items():
+            if not os.path.isfile(file) or self.hash_file(file) != digest:
+                return False
+
+        return True
+
+    def is_current(self, stage: str, fingerprint: str, inputs: list[str], settings: Optional[str] = None) -> bool:
+        """
+        settings: see settings(), without it a stage whose inputs are gone
+        is stale
+        """
+        if not self.outputs_intact(stage):
+            return False
+
+        if self.get_fingerprint(stage) == fingerprint:
+            return True
+
+        # Raws are deleted after conversion (delete_raws), that alone
+        # doesn't make the converted frames stale
+        with self._lock:
+            record = self.stages[stage]
+        if len([f for f in inputs if os.path.isfile(f)]) > 0 or record.get('inputs', 0) == 0:
+            return False
+
+        if settings is None or record.get('settings') != settings:
+            self.logger.warning(f"[{stage}] Settings changed since its inputs were deleted, running it again")
+            return False
+        return True
+
+    def record(self, stage: str, fingerprint: str, inputs: list[str], outputs: list[str], settings: Optional[str] = None):
+        hashed_outputs = self.hash_files(outputs)
+        with self._lock:
+            self.stages[stage] = {
+                'fingerprint': fingerprint,
+                'settings': settings,
+                'inputs': len(inputs),
+                'outputs': hashed_outputs,
+            }
+        self.save()
+
+    def invalidate(self, stage: str):
+        with self._lock:
+            self.stages.pop(stage, None)
+        self.save()
@@ -0,0 +1,357 @@
+import os
+from glob import glob
+from typing import Callable, Optional
+
+from ..siril import Frame, Session
+from ..pool import lease_instance
+from ..siril.trace import trace_context
+from ..siril.preprocess import convert_night, calibrate, get_calibrate_params, get_convert_params, screen, screening_enabled
+from ..siril import stages
+
+from .graph import Node, Pipeline
+from .manifest import Manifest
+from ..metadata import list_raws
+from ..sequence import seq_file
+from ..sequence.compression import COMPRESSED_SUFFIX
+from ..stacking import ACCUMULATOR_DIR_NAME
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Builds the convert -> calibrate -> register -> stack graph of a Session
+
+darks_1 ─ convert ─ stack ───────────────┐
+flats_1 ─ convert ─ calibrate ─ stack ───┤
+lights_1 ─ convert ─ screen ───────── calibrate ─┐
+lights_2 ─ convert ─ screen ───────── calibrate ─┴─ merge ─ register ─ stack
+
+Darks and flats of every night run side by side, and the lights of a night
+are calibrated as soon as that night's master dark and flat exist.
+
+Biases come from the master library, so there is nothing to build for them.
+
+incremental=True registers every night on its own and folds it into the
+target's LightAccumulator instead of merging, one night at a time. A night
+that was already accumulated is not stacked again, adding a night to a
+target stacks the frames of that night only:
+
+lights_1 ─ ... ─ calibrate ─ register ─ accumulate ─┐
+lights_2 ─ ... ─ calibrate ─ register ──────────────┴─ accumulate ─ stack
+
+Every node runs on its own Siril instance, leased from the pool daemon when
+one is running (see pool.lease_instance), with `setcpu` set to the cores the
+node was given by the scheduler. Nodes whose inputs, parameters and upstream
+stages are unchanged since the last run are skipped (see Manifest).
+"""
+
+# (cpu cores, ram GB) asked for by each kind of node
+STAGE_RESOURCES = {
+    "convert": (2, 1),
+    "screen": (4, 2),
+    "calibrate": (4, 2),
+    "stack": (4, 4),
+    "merge": (1, 1),
+    "register": (8, 4),
+    "accumulate": (2, 4),
+}
+
+
+class SessionPipeline:
+    def __init__(self,
+                 session: Session,
+                 delete_raws: bool = False,
+                 cpu_budget: Optional[int] = None,
+                 ram_budget: Optional[float] = None,
+                 force: bool = False,
+                 incremental: bool = False
+                 ) -> None:
+        """
+        force: re-run every stage even when the manifest says it is current
+        incremental: accumulate the lights night by night (see LightAccumulator)
+        """
+        self.logger = Logger
+        self.session = session
+        self.delete_raws = delete_raws
+        self.force = force
+        self.incremental = incremental
+        self.pipeline = Pipeline(cpu_budget=cpu_budget, ram_budget=ram_budget)
+        self.manifest = Manifest(session.working_dir)
+        self.fits_extension = os.environ['FITS_EXTENSION']
+        self.preprocess_prefix = os.environ['PREPROCESS_PREFIX']
+        self.registered_prefix = os.environ['REGISTERED_PREFIX']
+
+    def _siril_task(self, fn: Callable, frame: Frame, *args, night: Optional[str] = None, **kwargs) -> Callable:
+        """
+        night: traced with the Siril commands of the node (see siril.trace)
+        """
+        def task(node: Node):
+            app, siril = lease_instance(
+                name=node.name.replace(':', '_'),
+                cpu_cores=node.cpu,
+                working_dir=self.session.working_dir)
+            try:
+                with trace_context(stage=node.stage, node=node.name, frame=frame.name, night=night):
+                    return fn(siril, self.session, frame, *args, **kwargs)
+            finally:
+                app.Close()
+
+        return task
+
+    def _cached(self, task: Callable, deps: list[str], inputs: Callable, outputs: Callable, params: Optional[Callable]) -> Callable:
+        def run(node: Node):
+            input_files = inputs()
+            stage_params = params() if params else None
+            fingerprint = self.manifest.fingerprint(
+                input_files, stage_params, deps)
+            settings = self.manifest.settings(stage_params, deps)
+
+            if not self.force and self.manifest.is_current(node.name, fingerprint, input_files, settings):
+                self.logger.info(f"[{node.name}] Up to date, skipping")
+                node.cached = True
+                return None
+
+            result = task(node)
+            self.manifest.record(
+                node.name, fingerprint, input_files, outputs(), settings)
+            return result
+
+        return run
+
+    def _add(self,
+             stage: str,
+             name: str,
+             task: Callable,
+             deps: Optional[list[str]] = None,
+             inputs: Optional[Callable] = None,
+             outputs: Optional[Callable] = None,
+             params: Optional[Callable] = None
+             ) -> str:
+        """
+        inputs / outputs / params are called when the node runs (upstream
+        files only exist by then) to fingerprint it in the manifest
+        """
+        deps = deps if deps else []
+        cpu, ram = STAGE_RESOURCES[stage]
+
+        if inputs is not None and outputs is not None:
+            task = self._cached(task, deps, inputs, outputs, params)
+
+        node = Node(f"{stage}:{name}", task, deps=deps,
+                    cpu=cpu, ram=ram, stage=stage)
+        self.pipeline.add(node)
+        return node.name
+
+    def _raws(self, directory: str) -> Callable:
+        return lambda: [os.path.join(directory, f) for f in os.listdir(directory) if not f.startswith('.')]
+
+    def _sequence(self, frame: Frame, sequence: str) -> Callable:
+        """
+        Image files of a sequence, compressed (.fz) or not. The .seq file
+        itself is left out on purpose, Siril rewrites it when the sequence
+        is registered
+        """
+        process_dir = self.session.get_process_dir(frame)
+        return lambda: sum([glob(f"{process_dir}/{sequence}{suffix}.{self.fits_extension}{fz}")
+                            for suffix in ['_*', ''] for fz in ['', COMPRESSED_SUFFIX]], [])
+
+    def _registration(self, frame: Frame, sequence: str) -> Callable:
+        """
+        What registering a sequence writes: its r_ sequence, or only the
+        transforms in its .seq file (REGISTER_NOOUT)
+        """
+        if not stages.lazy_registration():
+            return self._sequence(frame, f"{self.registered_prefix}{sequence}")
+        return lambda: [seq_file(self.session.get_process_dir(frame), sequence)]
+
+    def _image(self, frame: Frame, name: str) -> Callable:
+        return lambda: [f"{self.session.get_process_dir(frame)}/{name}.{self.fits_extension}"]
+
+    def _calibration_inputs(self, frame: Frame, night: str, sequence: str) -> Callable:
+        def inputs():
+            params = get_calibrate_params(self.session, frame, night)
+            masters = [params[k]
+                       for k in ['bias', 'dark', 'flat'] if params.get(k)]
+            return self._sequence(frame, sequence)() + masters
+
+        return inputs
+
+    def _nights(self, frame: Optional[Frame]) -> list[tuple[str, str]]:
+        if frame is None or not os.path.isdir(f"{self.session.working_dir}/{frame.dir}"):
+            return []
+
+        nights = []
+        for d in self.session.list_directories(frame):
+            night = self.session.get_night(frame, d)
+            converted = self.manifest.get_fingerprint(
+                f"convert:{self._name(frame, night)}")
+
+            # Raws of an already converted night may have been deleted
+            if len(os.listdir(d)) == 0 and converted is None:
+                self.logger.info(f"No frames found in {d}")
+                continue
+            nights.append((night, d))
+
+        return nights
+
+    def _name(self, frame: Frame, night: str) -> str:
+        return f"{frame.name}_{night}" if self.session.multiple else frame.name
+
+    def _master(self, frame: Frame, night: str) -> str:
+        return f"{frame.stacked_name}_{night}" if self.session.multiple else frame.stacked_name
+
+    def _build_masters(self, frame: Frame, calibrated: bool) -> dict[str, str]:
+        """
+        Returns the stack node of every night keyed by night
+        """
+        masters = {}
+
+        for night, directory in self._nights(frame):
+            name = self._name(frame, night)
+
+            last = self._add("convert", name, self._siril_task(
+                convert_night, frame, directory, night=night, delete_raws=self.delete_raws),
+                inputs=self._raws(directory),
+                outputs=self._sequence(frame, name),
+                params=lambda frame=frame: get_convert_params(self.session, frame))
+
+            sequence = name
+            if calibrated:
+                sequence = f"{self.preprocess_prefix}{name}"
+                last = self._add("calibrate", name, self._siril_task(
+                    calibrate, frame, night, night=night), deps=[last],
+                    inputs=self._calibration_inputs(frame, night, name),
+                    outputs=self._sequence(frame, sequence),
+                    params=lambda frame=frame, night=night: get_calibrate_params(self.session, frame, night))
+
+            out = self._master(frame, night)
+            masters[night] = self._add("stack", name, self._siril_task(
+                stages.stack, frame, sequence, out, night=night), deps=[last],
+                inputs=self._sequence(frame, sequence),
+                outputs=self._image(frame, out),
+                params=lambda frame=frame, out=out: stages.get_stack_params(self.session, frame, out))
+
+        return masters
+
+    def build(self) -> Pipeline:
+        session = self.session
+
+        dark_masters = self._build_masters(session.darks, calibrated=False)
+        flat_masters = self._build_masters(session.flats, calibrated=True)
+
+        lights = session.lights
+        calibrated = []
+
+        # Masters are matched on the EXIF of the lights, read it before
+        # convert deletes the raws
+        for night, directory in self._nights(lights):
+            if list_raws(directory):
+                session.get_camera(night)
+
+        for night, directory in self._nights(lights):
+            name = self._name(lights, night)
+
+            converted = self._add("convert", name, self._siril_task(
+                convert_night, lights, directory, night=night, delete_raws=self.delete_raws),
+                inputs=self._raws(directory),
+                outputs=self._sequence(lights, name),
+                params=lambda: get_convert_params(self.session, lights))
+
+            deps = [converted]
+            if screening_enabled(session, lights):
+                deps = [self._add("screen", name,
+                                  lambda node, night=night: screen(
+                                      self.session, lights, night, workers=node.cpu),
+                                  deps=[converted],
+                                  inputs=self._sequence(lights, name),
+                                  outputs=lambda name=name: [
+                                      f"{session.get_process_dir(lights)}/{name}_quality.csv"])]
+            if night in dark_masters:
+                deps.append(dark_masters[night])
+            if night in flat_masters:
+                deps.append(flat_masters[night])
+
+            calibrated.append((night, name, self._add("calibrate", name, self._siril_task(
+                calibrate, lights, night, night=night), deps=deps,
+                inputs=self._calibration_inputs(lights, night, name),
+                outputs=self._sequence(
+                    lights, f"{self.preprocess_prefix}{name}"),
+                params=lambda night=night: get_calibrate_params(self.session, lights, night))))
+
+        if not calibrated:
+            return self.pipeline
+
+        if self.incremental:
+            return self._build_accumulation(calibrated)
+
+        if session.multiple:
+            sequence = f"{self.preprocess_prefix}{lights.name}_merged"
+            out = f"{lights.stacked_name}_merged"
+            merged = [
+                f"{self.preprocess_prefix}{name}" for _, name, _ in calibrated]
+            last = self._add("merge", lights.name, self._siril_task(
+                stages.merge, lights, merged, sequence),
+                deps=[node for _, _, node in calibrated],
+                inputs=lambda: sum(
+                    [self._sequence(lights, m)() for m in merged], []),
+                outputs=self._sequence(lights, sequence))
+        else:
+            sequence = f"{self.preprocess_prefix}{lights.name}"
+            out = lights.stacked_name
+            [(_, _, last)] = calibrated
+
+        registered = stages.registered_sequence(sequence)
+        registration = self._registration(lights, sequence)
+        last = self._add("register", lights.name, self._siril_task(
+            stages.register, lights, sequence), deps=[last],
+            inputs=self._sequence(lights, sequence),
+            outputs=registration)
+
+        # Without r_ frames the calibrated ones are stacked with their transforms
+        self._add("stack", lights.name, self._siril_task(
+            stages.stack, lights, registered, out), deps=[last],
+            inputs=lambda: sorted(set(self._sequence(lights, registered)() + registration())),
+            outputs=self._image(lights, out),
+            params=lambda: stages.get_stack_params(self.session, lights, out))
+
+        return self.pipeline
+
+    def _build_accumulation(self, calibrated: list[tuple[str, str, str]]) -> Pipeline:
+        """
+        register ─ accumulate of every night, then the accumulated stack
+        """
+        lights = self.session.lights
+        if stages.lazy_registration():
+            raise Exception("Incremental stacking needs r_ frames, unset REGISTER_NOOUT")
+
+        accumulated = None
+        for night, name, node in calibrated:
+            sequence = f"{self.preprocess_prefix}{name}"
+            registered = self._add("register", name, self._siril_task(
+                stages.register, lights, sequence, night=night), deps=[node],
+                inputs=self._sequence(lights, sequence),
+                outputs=self._registration(lights, sequence))
+
+            # The accumulator is one state for the target, nights go in one at a time
+            accumulated = self._add("accumulate", name,
+                                    lambda node, night=night: stages.accumulate(self.session, lights, night),
+                                    deps=[registered] + ([accumulated] if accumulated else []))
+
+        out = f"{lights.stacked_name}_merged" if self.session.multiple else lights.stacked_name
+        self._add("stack", lights.name,
+                  lambda node: stages.render_accumulation(self.session, lights, out),
+                  deps=[accumulated],
+                  inputs=lambda: [f"{self.session.get_process_dir(lights)}/{ACCUMULATOR_DIR_NAME}/{f}"
+                                  for f in ['state.json', 'total.npz']],
+                  outputs=self._image(lights, out))
+
+        return self.pipeline
+
+    def run(self) -> Pipeline:
+        self.build()
+        self.logger.info(
+            f"Running {len(self.pipeline.nodes)} pipeline nodes with {self.pipeline.cpu_budget} cpus / {self.pipeline.ram_budget:.0f}GB")
+        self.pipeline.run()
+        self.pipeline.raise_for_errors()
+        return self.pipeline
@@ -0,0 +1,2 @@
+from .daemon import SirilPool, PoolServer, PooledInstance, serve
+from .client import RemoteSiril, get_siril, lease_instance, pool_available
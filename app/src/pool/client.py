@@ -0,0 +1,154 @@
+import os
+import json
+import socket
+from typing import Optional
+
+from pysiril.siril import *  # type: ignore
+from pysiril.wrapper import *  # type: ignore
+
+from .daemon import SOCKET_PATH
+from ..siril.instance import start_instance
+from ..siril.trace import traced
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Client side of the Siril pool
+
+RemoteSiril has the Open / Close / Execute / GetData methods pysiril's
+Wrapper calls, so it can be dropped in wherever a Siril() was used:
+
+    App = get_siril()
+    siril = Wrapper(App)
+    App.Open()   # leases a warm instance (or starts Siril without a pool)
+    ...
+    App.Close()  # hands it back
+
+lease_instance() does the same for the pipeline, with the (app, siril)
+pair of start_instance():
+
+    app, siril = lease_instance(name="stack_lights", cpu_cores=4)
+"""
+
+# Seconds to wait for a free pooled instance before starting a local one
+LEASE_TIMEOUT = float(os.getenv('SIRIL_POOL_LEASE_TIMEOUT', '5'))
+
+
+class RemoteSiril:
+    def __init__(self, socket_path: str = SOCKET_PATH, timeout: Optional[float] = None) -> None:
+        # Wrapper keeps a reference to the trace of the Siril it wraps
+        self.tr = Logger
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.slot = None
+        self._socket = None
+        self._file = None
+        self._data: list = []
+
+    def _request(self, **request) -> dict:
+        self._file.write((json.dumps(request) + "\n").encode())
+        self._file.flush()
+        line = self._file.readline()
+
+        if not line:
+            raise Exception("Siril pool closed the connection")
+
+        return json.loads(line)
+
+    def Open(self) -> bool:
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(self.socket_path)
+        self._file = self._socket.makefile('rwb')
+
+        response = self._request(op='lease', timeout=self.timeout)
+        if response['ok'] is not True:
+            Logger.error(f"Failed to lease a Siril instance: {response.get('error')}")
+            self.Close()
+            return False
+
+        self.slot = response['slot']
+        Logger.info(f"Leased pooled Siril instance {self.slot}")
+        return True
+
+    def Close(self):
+        if self._socket is None:
+            return
+
+        try:
+            self._request(op='release')
+        except Exception:
+            pass
+        finally:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+            self._file = None
+            Logger.info(f"Released pooled Siril instance {self.slot}")
+
+    def Execute(self, commandes: str, bEndTest: bool = True) -> bool:
+        if self._socket is None:
+            return False
+
+        response = self._request(
+            op='execute', command=commandes, end_test=bEndTest)
+        self._data = response.get('data', [])
+        return response['ok']
+
+    def GetData(self) -> list:
+        return self._data
+
+
+def pool_available(socket_path: str = SOCKET_PATH) -> bool:
+    if os.getenv('SIRIL_POOL', '1') == '0' or not os.path.exists(socket_path):
+        return False
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def get_siril():
+    """
+    A pooled instance when the pool daemon is running, a new Siril otherwise
+    """
+    if pool_available():
+        return RemoteSiril()
+
+    return Siril()  # type: ignore
+
+
+def lease_instance(
+        name: Optional[str] = None,
+        cpu_cores: Optional[int] = None,
+        working_dir: Optional[str] = None,
+        fits_extension: str = os.getenv('FITS_EXTENSION', 'fit')
+):
+    """
+    A pooled instance configured like start_instance() when the pool
+    daemon is running and has one free within LEASE_TIMEOUT, a new local
+    instance otherwise. app.Close() hands a pooled one back
+    """
+    if pool_available():
+        app = RemoteSiril(timeout=LEASE_TIMEOUT)
+        try:
+            leased = app.Open()
+        except OSError as e:
+            Logger.warning(f"Siril pool unreachable: {e}")
+            leased = False
+
+        if leased:
+            # The pool resets setext, set16bits and setcompress on release
+            siril = traced(Wrapper(app), name=name if name else f"pool_{app.slot}")  # type: ignore
+            if cpu_cores:
+                siril.setcpu(cpu_cores)
+            if working_dir:
+                siril.cd(working_dir)
+            return app, siril
+
+        Logger.info(f"No pooled Siril instance free, starting {name} locally")
+
+    return start_instance(name=name, cpu_cores=cpu_cores, working_dir=working_dir, fits_extension=fits_extension)
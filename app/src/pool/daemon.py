@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import argparse
+import threading
+import socketserver
+from typing import Optional
+
+from ..siril.instance import start_instance, set_compression
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Keeps N Siril instances warm and leases them to local callers
+
+Starting Siril takes several seconds, and every stage module (convert,
+calibrate, register, stack, postprocess) used to pay for it. The daemon
+starts the instances once and hands them out over a unix socket. The
+protocol is newline-delimited JSON, one lease per connection:
+
+    {"op": "lease", "timeout": 60}       -> {"ok": true, "slot": 0}
+    {"op": "execute", "command": "...",
+     "end_test": true}                   -> {"ok": true, "data": [...]}
+    {"op": "release"}                    -> {"ok": true}
+    {"op": "status"}                     -> {"ok": true, "slots": [...]}
+
+Closing the connection releases the lease. On release the instance is reset
+(cd, setext, set16bits, setcompress, setcpu) so the next caller finds it in a known
+state. Idle instances are health checked and crashed ones are restarted.
+
+Usage:
+    poetry run python -m src.pool.daemon --size=3
+"""
+
+SOCKET_PATH = os.getenv('SIRIL_POOL_SOCKET', '/tmp/siril-pool.sock')
+
+
+class PooledInstance:
+    def __init__(self, slot: int, cpu_cores: int, home: str, fits_extension: str) -> None:
+        self.slot = slot
+        self.cpu_cores = cpu_cores
+        self.home = home
+        self.fits_extension = fits_extension
+        self.app = None
+        self.siril = None
+        self.leased = False
+        self.leases = 0
+        self.restarts = 0
+
+    def start(self):
+        self.app, self.siril = start_instance(
+            name=f"pool_{self.slot}",
+            cpu_cores=self.cpu_cores,
+            working_dir=self.home,
+            fits_extension=self.fits_extension)
+
+    def stop(self):
+        if self.app is not None:
+            self.app.kill()
+            self.app = None
+            self.siril = None
+
+    def restart(self):
+        Logger.warning(f"Restarting pooled Siril instance {self.slot}")
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def reset(self) -> bool:
+        """
+        Puts the instance back in the state start_instance() left it in
+        """
+        results = [
+            self.siril.cd(self.home),
+            self.siril.setext(self.fits_extension),
+            self.siril.set16bits(),
+            set_compression(self.siril),
+            self.siril.setcpu(self.cpu_cores),
+        ]
+        return all([r[0] is True for r in results])
+
+    def healthy(self) -> bool:
+        if self.app is None or not self.app.is_alive():
+            return False
+
+        [ok] = self.siril.setext(self.fits_extension)
+        return ok is True
+
+    def execute(self, command: str, end_test: bool = True) -> tuple[bool, list]:
+        ok = self.app.Execute(command, end_test)
+        return ok, self.app.GetData()
+
+    def status(self) -> dict:
+        return {
+            "slot": self.slot,
+            "leased": self.leased,
+            "alive": self.app is not None and self.app.is_alive(),
+            "leases": self.leases,
+            "restarts": self.restarts,
+        }
+
+
+class SirilPool:
+    def __init__(self,
+                 size: int = 2,
+                 cpu_cores: Optional[int] = None,
+                 home: Optional[str] = None,
+                 health_interval: float = 30
+                 ) -> None:
+        self.logger = Logger
+        self.size = size
+        self.cpu_cores = cpu_cores if cpu_cores else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.home = home if home else os.path.expanduser('~')
+        self.health_interval = health_interval
+        self.instances = [
+            PooledInstance(slot, self.cpu_cores, self.home,
+                           os.getenv('FITS_EXTENSION', 'fit'))
+            for slot in range(size)
+        ]
+        self._available = threading.Condition()
+        self._stopped = threading.Event()
+
+    def start(self):
+        # Each instance takes seconds to open, start them side by side
+        threads = [threading.Thread(target=i.start) for i in self.instances]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        threading.Thread(target=self._health_loop, daemon=True).start()
+        self.logger.info(f"Siril pool started with {self.size} instances")
+
+    def stop(self):
+        self._stopped.set()
+        for instance in self.instances:
+            instance.stop()
+        self.logger.info("Siril pool stopped")
+
+    def lease(self, timeout: Optional[float] = None) -> Optional[PooledInstance]:
+        with self._available:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+
+            while True:
+                for instance in self.instances:
+                    if not instance.leased and instance.app is not None:
+                        instance.leased = True
+                        instance.leases += 1
+                        return instance
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._available.wait(remaining)
+
+    def _restart(self, instance: PooledInstance):
+        """
+        A Siril that fails to start leaves the slot without an app, the
+        health loop tries again
+        """
+        try:
+            instance.restart()
+        except Exception as e:
+            self.logger.error(
+                f"Failed to restart pooled Siril instance {instance.slot}: {e}")
+
+    def release(self, instance: PooledInstance):
+        try:
+            if instance.app is None or not instance.app.is_alive() or not instance.reset():
+                self._restart(instance)
+        except Exception as e:
+            self.logger.error(
+                f"Failed to reset pooled Siril instance {instance.slot}: {e}")
+            self._restart(instance)
+        finally:
+            with self._available:
+                instance.leased = False
+                self._available.notify()
+
+    def check_health(self):
+        for instance in self.instances:
+            with self._available:
+                if instance.leased:
+                    continue
+                # Hold it while checking so it isn't leased mid restart
+                instance.leased = True
+
+            try:
+                if not instance.healthy():
+                    self._restart(instance)
+            except Exception as e:
+                self.logger.error(
+                    f"Health check of pooled Siril instance {instance.slot} failed: {e}")
+                self._restart(instance)
+            finally:
+                with self._available:
+                    instance.leased = False
+                    self._available.notify()
+
+    def _health_loop(self):
+        while not self._stopped.wait(self.health_interval):
+            self.check_health()
+
+    def status(self) -> list[dict]:
+        return [i.status() for i in self.instances]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def reply(self, **response):
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+    def handle(self):
+        pool: SirilPool = self.server.pool  # type: ignore
+        instance: Optional[PooledInstance] = None
+
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                op = request.get('op')
+
+                if op == 'lease':
+                    if instance is None:
+                        instance = pool.lease(request.get('timeout'))
+                    if instance is None:
+                        self.reply(ok=False, error="No Siril instance available")
+                    else:
+                        self.reply(ok=True, slot=instance.slot)
+
+                elif op == 'execute':
+                    if instance is None:
+                        self.reply(ok=False, error="No lease")
+                        continue
+                    ok, data = instance.execute(
+                        request['command'], request.get('end_test', True))
+                    self.reply(ok=ok, data=data)
+
+                elif op == 'release':
+                    if instance is not None:
+                        pool.release(instance)
+                        instance = None
+                    self.reply(ok=True)
+
+                elif op == 'status':
+                    self.reply(ok=True, slots=pool.status())
+
+                else:
+                    self.reply(ok=False, error=f"Unknown op: {op}")
+        finally:
+            if instance is not None:
+                pool.release(instance)
+
+
+class PoolServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, pool: SirilPool, socket_path: str = SOCKET_PATH) -> None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.pool = pool
+        self.socket_path = socket_path
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve(size: int, socket_path: str = SOCKET_PATH, cpu_cores: Optional[int] = None, health_interval: float = 30):
+    pool = SirilPool(size=size, cpu_cores=cpu_cores,
+                     health_interval=health_interval)
+    pool.start()
+    server = PoolServer(pool, socket_path)
+    Logger.info(f"Siril pool listening on {socket_path}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', '--size',
+                        required=False,
+                        type=int,
+                        default=2,
+                        dest="size",
+                        help="Number of Siril instances to keep warm")
+
+    parser.add_argument('-s', '--socket',
+                        required=False,
+                        type=str,
+                        default=SOCKET_PATH,
+                        dest="socket",
+                        help="Unix socket to listen on")
+
+    parser.add_argument('--cpus',
+                        required=False,
+                        type=int,
+                        default=None,
+                        dest="cpus",
+                        help="setcpu value for every instance (default: CPU_CORES)")
+
+    parser.add_argument('--health-interval',
+                        required=False,
+                        type=float,
+                        default=30,
+                        dest="health_interval",
+                        help="Seconds between health checks of idle instances")
+
+    args = parser.parse_args()
+    serve(args.size, socket_path=args.socket, cpu_cores=args.cpus,
+          health_interval=args.health_interval)
@@ -1,23 +1,29 @@
 import os
 import os.path
-import subprocess
 
 from pathlib import Path
+from typing import Optional
 import argparse
 
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
 from astropy import units as u
-from astropy.coordinates import (ICRS, SkyCoord, get_icrs_coordinates)
+from astropy.coordinates import (ICRS, SkyCoord)
 
+from .pool import get_siril
+from .catalog import target_coordinates
+from .background import remove_gradient as remove_background
 from .logger import Logger as _Logger
 
 """
-Stacks a directory of images to a single FITS image
+Post-processes a stacked FITS image
 
 Usage:
-    poetry run python -m src.stack darks.seq -f darks
+    poetry run python -m src.postprocess stacked_r_pp_lights.fit --target="NGC 651"
+
+    from src.postprocess import postprocess
+    postprocess(siril, "stacked_r_pp_lights.fit", target="NGC 651")
 
 """
 
@@ -36,11 +42,6 @@ parser.add_argument('-t', '--target',
                     dest="target",
                     help="Target name")
 
-args = parser.parse_args()
-
-App = Siril()  # type: ignore
-siril = Wrapper(App)  # type: ignore
-
 
 target_ra_hms = None
 target_dec_dms = None
@@ -49,18 +50,13 @@ target_dec = None
 constellation = None
 
 
-def try_target_data():
+def try_target_data(target):
     global target_ra_hms, target_dec_dms, target_ra, target_dec, constellation
 
     # TODO: Consider looking at details.json
     # TODO: Make this more resiliant
 
-    try:
-        coords = get_icrs_coordinates(
-            name=args.target, parse=False, cache=False)
-    except Exception as e:
-        print(e)
-        coords = None
+    coords = target_coordinates(target)
 
     c = SkyCoord(
         ra=coords.ra.to(u.deg),
@@ -76,13 +72,14 @@ def try_target_data():
 
     constellation = c.get_constellation() if c else None
 
-    Logger.info(f"Target: {args.target}")
+    Logger.info(f"Target: {target}")
     Logger.info(f"Coords: {target_ra_hms} {target_dec_dms}")
     Logger.info(f"Coords: {target_ra} {target_dec}")
     Logger.info(f"Constellation: {constellation}")
 
 
-def _solve(ra,
+def _solve(siril,
+           ra,
            dec,
            force=True,
            localasnet=False,
@@ -118,22 +115,12 @@ def _solve(ra,
         Logger.info(f"Plate Solving Completed")
 
 
-def remove_gradient(file, gpu=False):
-    Logger.info(f"Running GraXpert Background Extraction")
-    gradient_cmd = [
-        "graxpert",
-        file,
-        "-cli",
-        "-correction", "Subtraction",
-        "-smoothing", "0.2",
-        "-bg",
-        "-gpu", "true" if gpu else "false",
-        "--command", "background-extraction"
-    ]
-    subprocess.run(gradient_cmd)
+def remove_gradient(file, gpu=False) -> str:
+    Logger.info(f"Running Background Extraction")
+    return remove_background(file, smoothing=0.2, gpu=gpu)
 
 
-def process_stars(starmask):
+def process_stars(siril, starmask):
     siril.load(starmask)
     siril.save(f"{starmask}.bak")
 
@@ -154,14 +141,11 @@ def process_stars(starmask):
         siril.save(starmask)
 
 
-def process_starless(file):
+def process_starless(siril, file):
     starless = f"starless_{Path(file).stem}-processed"
     siril.save(f"{starless}.bak")
 
-    remove_gradient(f"{os.path.dirname(file)}/starless_{Path(file).name}")
-
-    # To be generated from running GraXpert
-    starless_graxpert_path = f"{os.path.dirname(file)}/starless_{Path(file).stem}-processed_GraXpert.fits"
+    starless_graxpert_path = remove_gradient(f"{os.path.dirname(file)}/starless_{Path(file).name}")
 
     siril.load(starless_graxpert_path)
     siril.save(f"{starless}-graxpert")
@@ -169,7 +153,7 @@ def process_starless(file):
     # os.remove("_GraXpert.fits")
 
 
-def star_recomposition(starless, starmask, name):
+def star_recomposition(siril, starless, starmask, name):
     Logger.info(
         f"Combining Starless and Starmask with PixelMath: Starless: {starless}.fit   Stars: {starmask}.fit")
 
@@ -183,7 +167,7 @@ def star_recomposition(starless, starmask, name):
     siril.save(f"{name}-recomposed")
 
 
-def postprocess(file=args.file, target=args.target) -> bool:
+def postprocess(siril, file: str, target: Optional[str] = None) -> bool:
     siril.setcpu(cpu_cores)
     siril.set16bits()
     siril.setext(fits_extension)
@@ -199,10 +183,11 @@ def postprocess(file=args.file, target=args.target) -> bool:
     siril.rmgreen()
 
     if target:
-        try_target_data()
+        try_target_data(target)
 
     if target_dec and target_ra:
         _solve(
+            siril,
             ra=target_ra,
             dec=target_dec,
             localasnet=False,
@@ -225,16 +210,19 @@ def postprocess(file=args.file, target=args.target) -> bool:
     starmask = f"starmask_{name}-processed"
     starless = f"starless_{name}-processed"
 
-    process_stars(file)
-    process_starless(file)
+    process_stars(siril, file)
+    process_starless(siril, file)
 
-    star_recomposition(starless, starmask, name)
+    star_recomposition(siril, starless, starmask, name)
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    App = get_siril()
+
     try:
         App.Open()
-        postprocess()
+        postprocess(Wrapper(App), args.file, target=args.target)  # type: ignore
     except Exception as e:
         Logger.error(f"Error: {e}")
         exit(1)
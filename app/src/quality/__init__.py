@@ -0,0 +1 @@
+from .screen import FrameScreen, measure_image, green_binned, outliers
@@ -0,0 +1,236 @@
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+
+from ..sequence import FrameView, SequenceReader, bayer_pattern
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Screens converted frames before they are calibrated
+
+Every frame is reduced to its green channel (the two greens of each Bayer
+cell averaged, or the G plane of an RGB frame), binned, and measured in a
+worker pool:
+
+    stars       detections above DETECTION_SIGMA of the background
+    fwhm        median FWHM of the stars, in pixels of the full frame
+    roundness   median minor / major axis ratio of the stars
+    background  median level, noise its MAD based sigma
+
+Frames far from the rest of the sequence (fewer stars: clouds, wider stars:
+seeing / focus, elongated stars: wind / tracking, brighter background: dew,
+light) are unselected in the .seq file, so calibration, registration and
+stacking skip them. {sequence}_quality.csv reports every frame.
+
+Usage:
+    FrameScreen(process_dir, "lights").run()
+"""
+
+QUALITY_BINNING = int(os.getenv('QUALITY_BINNING', 2))
+# Frames further than this many sigmas from the sequence are excluded
+QUALITY_SIGMA = float(os.getenv('QUALITY_SIGMA', 3))
+
+DETECTION_SIGMA = 5
+MIN_STAR_AREA = 3
+MAX_STAR_AREA = 400
+# Sequences shorter than this are measured but nothing is excluded
+MIN_FRAMES = 5
+# Spread of a metric is never taken below this fraction of its median
+MIN_RELATIVE_SIGMA = 0.05
+
+REPORT_COLUMNS = ['index', 'file', 'stars', 'fwhm',
+                  'roundness', 'background', 'noise', 'included', 'reasons']
+
+
+def green_binned(view: FrameView, binning: int = QUALITY_BINNING) -> tuple[np.ndarray, int]:
+    """
+    Binned green channel, and the size of its pixels in full frame pixels
+    """
+    if view.shape[0] == 3:
+        green, scale = view.physical((1,)), 1
+    else:
+        raw = view.physical((0,))
+        height, width = raw.shape[0] // 2 * 2, raw.shape[1] // 2 * 2
+        raw = raw[:height, :width]
+        # Greens on the diagonal (GRBG, GBRG) or the anti-diagonal (RGGB, BGGR)
+        if bayer_pattern(view)[0] == 'G':
+            green = (raw[0::2, 0::2] + raw[1::2, 1::2]) / 2
+        else:
+            green = (raw[0::2, 1::2] + raw[1::2, 0::2]) / 2
+        scale = 2
+
+    height, width = green.shape[0] // binning * binning, green.shape[1] // binning * binning
+    binned = green[:height, :width].reshape(
+        height // binning, binning, width // binning, binning).mean(axis=(1, 3))
+
+    return binned.astype(np.float32), scale * binning
+
+
+def measure_image(image: np.ndarray, scale: int = 1) -> dict:
+    background = float(np.median(image))
+    noise = float(1.4826 * np.median(np.abs(image - background)))
+
+    smoothed = cv.GaussianBlur(image, (0, 0), 1)
+    mask = (smoothed > background + DETECTION_SIGMA * max(noise, 1e-6)).astype(np.uint8)
+    count, labels, stats, _ = cv.connectedComponentsWithStats(mask, connectivity=8)
+
+    # Flux weighted moments of every component at once
+    weights = np.clip(image - background, 0, None).ravel()
+    labels = labels.ravel()
+    ys, xs = np.indices(image.shape, dtype=np.float32)
+    ys, xs = ys.ravel(), xs.ravel()
+
+    def moment(values: np.ndarray) -> np.ndarray:
+        return np.bincount(labels, weights=weights * values, minlength=count)
+
+    flux = np.maximum(moment(np.ones_like(xs)), 1e-6)
+    mx, my = moment(xs) / flux, moment(ys) / flux
+    var_x = moment(xs * xs) / flux - mx ** 2
+    var_y = moment(ys * ys) / flux - my ** 2
+    cov = moment(xs * ys) / flux - mx * my
+
+    half_trace = (var_x + var_y) / 2
+    spread = np.sqrt(((var_x - var_y) / 2) ** 2 + cov ** 2)
+    major, minor = half_trace + spread, np.maximum(half_trace - spread, 0)
+
+    area = stats[:, cv.CC_STAT_AREA]
+    stars = (np.arange(count) > 0) & (area >= MIN_STAR_AREA) & (area <= MAX_STAR_AREA) & (major > 0)
+
+    if not stars.any():
+        return {'stars': 0, 'fwhm': float('nan'), 'roundness': float('nan'),
+                'background': background, 'noise': noise}
+
+    fwhm = 2.3548 * np.sqrt((major[stars] + minor[stars]) / 2) * scale
+    roundness = np.sqrt(minor[stars] / major[stars])
+
+    return {
+        'stars': int(stars.sum()),
+        'fwhm': float(np.median(fwhm)),
+        'roundness': float(np.median(roundness)),
+        'background': background,
+        'noise': noise,
+    }
+
+
+def measure_frame(task: tuple[int, FrameView, int]) -> dict:
+    index, view, binning = task
+    image, scale = green_binned(view, binning)
+    view.close()
+    return {'index': index, 'file': os.path.basename(view.path), **measure_image(image, scale)}
+
+
+def robust(values: list[float]) -> tuple[float, float]:
+    """
+    Median and MAD based sigma, floored at MIN_RELATIVE_SIGMA of the median
+    """
+    values = np.asarray([v for v in values if np.isfinite(v)], dtype=np.float64)
+    if len(values) == 0:
+        return float('nan'), float('nan')
+
+    median = float(np.median(values))
+    sigma = 1.4826 * float(np.median(np.abs(values - median)))
+    return median, max(sigma, MIN_RELATIVE_SIGMA * abs(median))
+
+
+def outliers(report: list[dict], sigma: float = QUALITY_SIGMA) -> dict[int, list[str]]:
+    """
+    index -> reasons, for the frames to exclude
+    """
+    if len(report) < MIN_FRAMES:
+        return {}
+
+    stars = robust([r['stars'] for r in report])
+    fwhm = robust([r['fwhm'] for r in report])
+    roundness = robust([r['roundness'] for r in report])
+    background = robust([r['background'] for r in report])
+
+    rejected: dict[int, list[str]] = {}
+    for r in report:
+        reasons = []
+        if r['stars'] == 0:
+            reasons.append('no stars')
+        else:
+            if r['stars'] < stars[0] - sigma * stars[1]:
+                reasons.append('stars')
+            if r['fwhm'] > fwhm[0] + sigma * fwhm[1]:
+                reasons.append('fwhm')
+            if r['roundness'] < roundness[0] - sigma * roundness[1]:
+                reasons.append('roundness')
+        if r['background'] > background[0] + sigma * background[1]:
+            reasons.append('background')
+
+        if reasons:
+            rejected[r['index']] = reasons
+
+    return rejected
+
+
+class FrameScreen:
+    def __init__(self,
+                 process_dir: str,
+                 sequence: str,
+                 fits_extension: str = os.getenv('FITS_EXTENSION', 'fit'),
+                 workers: Optional[int] = None,
+                 binning: int = QUALITY_BINNING,
+                 sigma: float = QUALITY_SIGMA
+                 ) -> None:
+        self.logger = Logger
+        self.process_dir = process_dir
+        self.sequence = sequence
+        self.fits_extension = fits_extension
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.binning = binning
+        self.sigma = sigma
+        self.report_file = os.path.join(
+            process_dir, f"{sequence}_quality.csv")
+
+    def measure(self, reader: SequenceReader) -> list[dict]:
+        tasks = [(i, reader.frame(i), self.binning) for i in reader.indices]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(measure_frame, tasks))
+
+    def write_report(self, report: list[dict]):
+        tmp = f"{self.report_file}.tmp"
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            for r in report:
+                writer.writerow({k: round(v, 3) if isinstance(v, float) else v
+                                 for k, v in r.items()})
+        os.replace(tmp, self.report_file)
+
+    def run(self) -> list[dict]:
+        """
+        Measures every frame, unselects the outliers and writes the report
+        """
+        reader = SequenceReader(
+            self.process_dir, self.sequence, self.fits_extension)
+        self.logger.info(
+            f"Screening {len(reader)} frames of {self.sequence} on {self.workers} workers")
+
+        try:
+            report = self.measure(reader)
+        finally:
+            reader.close()
+
+        rejected = outliers(report, self.sigma)
+        for r in report:
+            r['included'] = r['index'] not in rejected
+            r['reasons'] = ' '.join(rejected.get(r['index'], []))
+            if not r['included']:
+                self.logger.warning(
+                    f"Excluding {r['file']} ({r['reasons']}): {r['stars']} stars, fwhm {r['fwhm']:.2f}, roundness {r['roundness']:.2f}, background {r['background']:.0f}")
+
+        reader.set_excluded(sorted(rejected.keys()))
+        self.write_report(report)
+
+        self.logger.info(
+            f"Screened {self.sequence}: {len(report) - len(rejected)}/{len(report)} frames kept, report: {self.report_file}")
+        return report
@@ -7,6 +7,8 @@ import argparse
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
+from .pool import get_siril
+from .registration import StarRegistration, TRANSFORMATIONS
 from .logger import Logger as _Logger
 
 """
@@ -14,6 +16,11 @@ Registers a sequence of images
 
 Usage:
     poetry run python -m src.register pp_lights.seq --maxstars=100
+    poetry run python -m src.register pp_lights.seq --maxstars=500 --backend=native --transf=similarity
+    poetry run python -m src.register pp_lights.seq --noout   # then: src.stack pp_lights.seq --resample
+
+    from src.register import register
+    register(siril, "pp_lights.seq", maxstars=100)
 
 """
 
@@ -47,16 +54,37 @@ parser.add_argument('--maxstars',
                     dest="maxstars",
                     help="Maximum number of stars to find within each frame")
 
-args = parser.parse_args()
-
-
-App = Siril()  # type: ignore
-siril = Wrapper(App)  # type: ignore
+parser.add_argument('-b', '--backend',
+                    required=False,
+                    type=str,
+                    default=os.getenv('REGISTER_BACKEND', 'siril'),
+                    dest="backend",
+                    choices=['siril', 'native'],
+                    help="Register with Siril or with the native StarRegistration")
+
+parser.add_argument('--transf',
+                    required=False,
+                    type=str,
+                    default=os.getenv('REGISTER_TRANSFORMATION', 'homography'),
+                    dest="transformation",
+                    choices=TRANSFORMATIONS,
+                    help="Transformation fitted by the native backend")
+
+parser.add_argument('--noout',
+                    required=False,
+                    action='store_true',
+                    default=os.getenv('REGISTER_NOOUT', '0') != '0',
+                    dest="noout",
+                    help="Only store the transforms in the .seq, no r_ frames are written")
 
 
 def register(
-    seq=args.seq,
-    maxstars=args.maxstars,
+    siril,
+    seq: str,
+    maxstars: int = 100,
+    backend: str = 'siril',
+    transformation: str = 'homography',
+    noout: bool = False,
 ) -> bool:
     siril.setcpu(cpu_cores)
     siril.set16bits()
@@ -78,11 +106,27 @@ def register(
 
     Logger.json("Registration Params", registration_params)
 
+    if backend == 'native':
+        # Star lists are cached, another maxstars / transf doesn't detect again
+        StarRegistration(str(Path(seq).parent), name.rstrip('_'), fits_extension,
+                         maxstars=maxstars,
+                         transformation=transformation,
+                         layer=GREEN_CHANNEL,
+                         prefix=prefix,
+                         output=not noout).run()
+        Logger.info(f"Registered light Frames")
+        return True
+
     [pass2_result] = siril.register(name, **registration_params, pass2=True)
 
     if pass2_result is not True:
         raise Exception(f"Failed to register {name} Frames (2-pass)")
 
+    if noout:
+        # -2pass only writes the transforms to the .seq
+        Logger.info(f"Registered light Frames (transforms only)")
+        return True
+
     [registration_result] = siril.register(
         name, **registration_params, drizzle=True)
 
@@ -95,9 +139,15 @@ def register(
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    App = get_siril()
+
     try:
         App.Open()
-        register()
+        register(Wrapper(App), args.seq, maxstars=args.maxstars,  # type: ignore
+                 backend=args.backend,
+                 transformation=args.transformation,
+                 noout=args.noout)
     except Exception as e:
         Logger.error(f"Error: {e}")
         exit(1)
@@ -0,0 +1,3 @@
+from .engine import StarRegistration, GREEN_CHANNEL
+from .stars import detect_stars, star_profile, StarCache
+from .match import match, TRANSFORMATIONS
@@ -0,0 +1,221 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+from ..sequence import FrameView, SequenceReader, frame_file, frame_header, write_seq, write_image, compression
+from .stars import StarCache, frame_stars
+from .match import match, TRANSFORMATIONS
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Native registration backend, a drop-in for the Siril register steps
+
+Stars of every frame are detected (or read back from their cache, see
+registration.stars) across a process pool, the frame with the most stars
+becomes the reference and every other frame is matched to it in parallel
+(see registration.match).
+
+The homographies are written to the .seq of the sequence, the way Siril
+stores registration data, then every frame is resampled onto the
+reference as {prefix}{sequence}_{index}.fit. Frames that can't be matched
+are left out of the registered sequence.
+
+Without output (Siril's -noout) only the .seq is written, frames that
+can't be matched are unselected in it, and StackEngine resamples the
+frames while stacking them (see SequenceReader.registration).
+
+Usage:
+    StarRegistration(process_dir, "pp_lights", maxstars=500).run()
+    StarRegistration(process_dir, "pp_lights", output=False).run()
+"""
+
+GREEN_CHANNEL = 1
+
+_worker: dict = {}
+
+
+def _match(task: tuple[int, np.ndarray, np.ndarray, str, int]) -> tuple[int, Optional[np.ndarray], int]:
+    index, reference, stars, transformation, maxstars = task
+    matched = match(reference, stars, transformation, maxstars)
+    if matched is None:
+        return index, None, 0
+    return index, matched[0], matched[1]
+
+
+def _init_worker(shape: tuple[int, int, int]):
+    _worker.update(shape=shape)
+
+
+def _resample(task: tuple[FrameView, np.ndarray, str]) -> str:
+    view, h, out = task
+    _, height, width = _worker['shape']
+    data = view.physical()
+
+    resampled = np.stack([
+        cv.warpPerspective(channel, h, (width, height),
+                           flags=cv.INTER_LANCZOS4, borderMode=cv.BORDER_CONSTANT, borderValue=np.nan)
+        for channel in data
+    ])
+    # Lanczos overshoots around stars, pixels outside the frame are 0
+    resampled = np.nan_to_num(np.clip(resampled, data.min(), data.max()))
+
+    header = frame_header(view)
+    if view.integer:
+        resampled = np.round(resampled).astype(np.uint16)
+
+    written = write_image(out, resampled, header)
+    view.close()
+    return written
+
+
+class StarRegistration:
+    def __init__(self,
+                 process_dir: str,
+                 sequence: str,
+                 fits_extension: str = os.getenv('FITS_EXTENSION', 'fit'),
+                 maxstars: Optional[int] = None,
+                 transformation: str = 'homography',
+                 layer: int = GREEN_CHANNEL,
+                 prefix: str = os.getenv('REGISTERED_PREFIX', 'r_'),
+                 workers: Optional[int] = None,
+                 output: bool = True
+                 ) -> None:
+        """
+        maxstars: brightest stars used to match, all detected ones when None
+        transformation: shift, similarity, affine or homography
+        output: write the {prefix} sequence, or only the transforms
+        """
+        if transformation not in TRANSFORMATIONS:
+            raise Exception(f"Unknown transformation: {transformation}")
+
+        self.logger = Logger
+        self.process_dir = process_dir
+        self.sequence = sequence
+        self.fits_extension = fits_extension
+        self.maxstars = maxstars
+        self.transformation = transformation
+        self.layer = layer
+        self.prefix = prefix
+        self.output = output
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.cache = StarCache(process_dir, sequence)
+        # index -> [fwhm, roundness, background] of the frames detected
+        self.profiles: dict[int, np.ndarray] = {}
+
+    def detect(self, reader: SequenceReader, indices: list[int]) -> dict[int, np.ndarray]:
+        tasks = [(i, reader.frame(i), self.layer, self.cache) for i in indices]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(frame_stars, tasks))
+
+        cached = len([r for r in results if r[3]])
+        self.logger.info(
+            f"Stars of {len(results)} frames: {len(results) - cached} detected, {cached} from cache")
+        self.profiles.update({index: profile for index, _, profile, _ in results})
+        return {index: stars for index, stars, _, _ in results}
+
+    def match(self, stars: dict[int, np.ndarray], reference: int) -> dict[int, tuple[np.ndarray, int]]:
+        """
+        index -> (transformation onto the reference, star pairs)
+        """
+        tasks = [(i, stars[reference], s, self.transformation, self.maxstars)
+                 for i, s in stars.items() if i != reference]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(_match, tasks))
+
+        transforms = {reference: (np.eye(3), len(stars[reference][:self.maxstars]))}
+        for index, h, count in results:
+            if h is None:
+                self.logger.warning(f"Could not match frame {index} of {self.sequence}")
+                continue
+            transforms[index] = (h, count)
+
+        return transforms
+
+    def resample(self, reader: SequenceReader, transforms: dict[int, tuple[np.ndarray, int]]) -> str:
+        """
+        Writes the registered sequence, returns its name
+        """
+        registered = f"{self.prefix}{self.sequence}"
+        # FITS sequences number their images from 0, output files from 1
+        start = 1 if reader.is_fitseq else 0
+
+        tasks = [(reader.frame(i), h, frame_file(self.process_dir, registered, i + start, self.fits_extension))
+                 for i, (h, _) in sorted(transforms.items())]
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(reader.shape,)) as pool:
+            list(pool.map(_resample, tasks))
+
+        write_seq(self.process_dir, registered, [i + start for i in transforms], fz=compression() is not None)
+        return registered
+
+    def frame_stats(self, stars: dict[int, np.ndarray], reference: int, transforms: dict[int, tuple[np.ndarray, int]]) -> dict[int, list]:
+        """
+        [fwhm, weighted_fwhm, roundness, quality, background, stars] of
+        every registered frame, what Siril's -filter-fwhm / -filter-wfwhm /
+        -filter-round select on. A frame whose stars couldn't be measured
+        gets the median of the others, so filters neither keep nor drop it
+        """
+        measured = [p for p in self.profiles.values() if np.isfinite(p[0])]
+        fallback = np.median(measured, axis=0) if measured else np.array([1, 1, 0])
+        reference_stars = max(len(stars[reference]), 1)
+
+        stats = {}
+        for i, (_, count) in transforms.items():
+            profile = self.profiles.get(i, fallback)
+            fwhm, roundness, background = np.where(np.isfinite(profile), profile, fallback)
+            # Siril's wFWHM: the FWHM grows with the stars missing from the reference's count
+            weighted_fwhm = fwhm + 2 * fwhm * (reference_stars - len(stars[i])) / reference_stars
+            stats[i] = [fwhm, weighted_fwhm, roundness, 0, background, count]
+        return stats
+
+    def write_transforms(self, reader: SequenceReader, transforms: dict[int, tuple[np.ndarray, int]],
+                         stats: Optional[dict[int, list]] = None) -> str:
+        """
+        Stores the homographies in the .seq of the sequence, as Siril does
+        """
+        return reader.set_transforms(
+            self.layer,
+            {i: h.ravel().tolist() for i, (h, _) in transforms.items()},
+            stats=stats)
+
+    def run(self) -> dict[int, tuple[np.ndarray, int]]:
+        reader = SequenceReader(
+            self.process_dir, self.sequence, self.fits_extension)
+        indices = [i for i in reader.indices if i not in reader.excluded]
+        if not indices:
+            raise Exception(f"No frames to register in {self.sequence}")
+
+        self.logger.info(
+            f"Registering {len(indices)} frames of {self.sequence} ({self.transformation}) on {self.workers} workers")
+
+        try:
+            stars = self.detect(reader, indices)
+            reference = max(indices, key=lambda i: len(stars[i]))
+            self.logger.info(
+                f"Reference frame: {reference} ({len(stars[reference])} stars)")
+
+            transforms = self.match(stars, reference)
+            if len(indices) > 1 and len(transforms) < 2:
+                raise Exception(f"Failed to register {self.sequence}: no frame matched the reference")
+
+            self.write_transforms(reader, transforms, self.frame_stats(stars, reference, transforms))
+            if self.output:
+                registered = self.resample(reader, transforms)
+            else:
+                unmatched = [i for i in indices if i not in transforms]
+                reader.set_excluded(sorted(set(reader.excluded + unmatched)))
+                registered = f"{self.sequence} (transforms only)"
+        finally:
+            reader.close()
+
+        self.logger.info(
+            f"Registered {len(transforms)}/{len(indices)} frames of {self.sequence}: {registered}")
+        return transforms
@@ -0,0 +1,166 @@
+import os
+from itertools import combinations
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Matches two star lists with triangle asterisms and fits a transformation
+
+Every star and its NEIGHBOURS nearest neighbours form triangles, described
+by two scale and rotation invariant ratios of their sides. The invariants of
+the reference go in a KD-tree (OpenCV's FLANN); each triangle of the frame
+is matched to its nearest reference triangle. Each match proposes an affine
+transform from its three vertices, and the one most stars agree with wins.
+The final transformation is fitted on all the star pairs it brings:
+
+    shift, similarity, affine or homography (same as Siril's -transf=)
+
+A transformation is a 3x3 matrix mapping frame pixels onto the reference.
+"""
+
+TRANSFORMATIONS = ['shift', 'similarity', 'affine', 'homography']
+
+NEIGHBOURS = 4
+# Brightest stars triangles are built from
+ASTERISM_STARS = 50
+INVARIANT_TOLERANCE = 0.02
+# Distance in pixels under which a transformed star matches a reference star
+PIXEL_TOLERANCE = float(os.getenv('REGISTER_PIXEL_TOLERANCE', 2))
+MAX_CANDIDATES = 200
+MIN_PAIRS = int(os.getenv('REGISTER_MIN_PAIRS', 10))
+
+_KDTREE = 1
+
+
+def kdtree(points: np.ndarray):
+    return cv.flann_Index(np.ascontiguousarray(points, dtype=np.float32),
+                          dict(algorithm=_KDTREE, trees=4))
+
+
+def nearest(tree, points: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Indices and (euclidean) distances of the k nearest points in a tree
+    """
+    indices, distances = tree.knnSearch(
+        np.ascontiguousarray(points, dtype=np.float32), k, params={})
+    return indices, np.sqrt(distances)
+
+
+def triangles(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Triangles of every star with its nearest neighbours: (M, 2) invariants
+    and (M, 3) vertices, ordered by the length of their opposite side
+    """
+    k = min(NEIGHBOURS + 1, len(points))
+    if k < 3:
+        return np.zeros((0, 2), np.float32), np.zeros((0, 3), np.int32)
+
+    neighbours, _ = nearest(kdtree(points), points, k)
+    vertices = {tuple(sorted(t)) for row in neighbours for t in combinations(row, 3)}
+    vertices = np.array(sorted(vertices), dtype=np.int32)
+
+    p = points[vertices]                                    # (M, 3, 2)
+    # Side opposite each vertex
+    sides = np.stack([np.linalg.norm(p[:, 1] - p[:, 2], axis=1),
+                      np.linalg.norm(p[:, 0] - p[:, 2], axis=1),
+                      np.linalg.norm(p[:, 0] - p[:, 1], axis=1)], axis=1)
+    order = np.argsort(sides, axis=1)[:, ::-1]
+    sides = np.take_along_axis(sides, order, axis=1)
+    vertices = np.take_along_axis(vertices, order, axis=1)
+
+    valid = sides[:, 2] > 1
+    invariants = np.stack([sides[:, 1] / sides[:, 0],
+                           sides[:, 2] / sides[:, 1]], axis=1)
+    return invariants[valid].astype(np.float32), vertices[valid]
+
+
+def fit(source: np.ndarray, target: np.ndarray, transformation: str) -> Optional[np.ndarray]:
+    """
+    3x3 matrix of a transformation mapping source points onto target points
+    """
+    if transformation == 'shift':
+        h = np.eye(3)
+        h[:2, 2] = np.median(target - source, axis=0)
+        return h
+
+    if transformation == 'similarity':
+        m, _ = cv.estimateAffinePartial2D(source, target, method=cv.LMEDS)
+    elif transformation == 'affine':
+        m, _ = cv.estimateAffine2D(source, target, method=cv.LMEDS)
+    elif transformation == 'homography':
+        h, _ = cv.findHomography(source, target, cv.RANSAC, PIXEL_TOLERANCE)
+        return h
+    else:
+        raise Exception(f"Unknown transformation: {transformation}")
+
+    return np.vstack([m, [0, 0, 1]]) if m is not None else None
+
+
+def transform(points: np.ndarray, h: np.ndarray) -> np.ndarray:
+    return cv.perspectiveTransform(np.ascontiguousarray(points[None], dtype=np.float64), h)[0]
+
+
+def pairs(source: np.ndarray, target_tree, h: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Indices of the source stars that h brings onto a target star, and of those stars
+    """
+    indices, distances = nearest(target_tree, transform(source, h))
+    close = distances[:, 0] < PIXEL_TOLERANCE
+    return np.nonzero(close)[0], indices[close, 0]
+
+
+def match(reference: np.ndarray, stars: np.ndarray, transformation: str = 'homography', maxstars: Optional[int] = None) -> Optional[tuple[np.ndarray, int]]:
+    """
+    Transformation of a frame onto the reference from their star lists
+    (x, y, flux, brightest first), and the number of star pairs it is
+    fitted on. None when the frames can't be matched
+    """
+    reference = reference[:maxstars, :2].astype(np.float64)
+    stars = stars[:maxstars, :2].astype(np.float64)
+    if min(len(reference), len(stars)) < max(3, MIN_PAIRS):
+        return None
+
+    ref_invariants, ref_vertices = triangles(reference[:ASTERISM_STARS])
+    invariants, vertices = triangles(stars[:ASTERISM_STARS])
+    if len(ref_invariants) == 0 or len(invariants) == 0:
+        return None
+
+    matched, distances = nearest(kdtree(ref_invariants), invariants)
+    candidates = np.nonzero(distances[:, 0] < INVARIANT_TOLERANCE)[0]
+    candidates = candidates[np.argsort(distances[candidates, 0])][:MAX_CANDIDATES]
+
+    reference_tree = kdtree(reference)
+    best, best_count = None, 0
+
+    for c in candidates:
+        source = stars[vertices[c]].astype(np.float32)
+        target = reference[ref_vertices[matched[c, 0]]].astype(np.float32)
+        h = np.vstack([cv.getAffineTransform(source, target), [0, 0, 1]])
+
+        count = len(pairs(stars, reference_tree, h)[0])
+        if count > best_count:
+            best, best_count = h, count
+            if count >= 0.8 * min(len(stars), len(reference)):
+                break
+
+    if best is None or best_count < MIN_PAIRS:
+        return None
+
+    source_pairs, target_pairs = pairs(stars, reference_tree, best)
+    h = fit(stars[source_pairs], reference[target_pairs], transformation)
+    if h is None:
+        return None
+
+    # Refit on the pairs the final model agrees with
+    source_pairs, target_pairs = pairs(stars, reference_tree, h)
+    if len(source_pairs) < MIN_PAIRS:
+        return None
+    refined = fit(stars[source_pairs], reference[target_pairs], transformation)
+
+    return (refined if refined is not None else h), len(source_pairs)
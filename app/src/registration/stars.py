@@ -0,0 +1,167 @@
+import os
+from typing import Optional
+
+import numpy as np
+import cv2 as cv
+
+from ..sequence import FrameView
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Star detection for registration, and the star lists cached per frame
+
+Stars are the local maxima of the smoothed image above DETECTION_SIGMA of
+the background, found for the whole image at once with a dilation. Each is
+refined to the flux weighted centroid of its 5x5 neighbourhood.
+
+The FWHM and roundness of a frame are the medians of the second moments of
+its PROFILE_STARS brightest stars, what Siril stores with the registration
+of a frame and filters on (-filter-fwhm, -filter-round).
+
+Detection keeps up to MAX_DETECTIONS stars, brightest first, and caches them
+with the profile in {sequence}_stars/{index}.npz next to the sequence. A
+re-registration with other maxstars / transformation settings only slices
+the cached lists.
+"""
+
+DETECTION_SIGMA = float(os.getenv('REGISTER_DETECTION_SIGMA', 5))
+MAX_DETECTIONS = 2000
+# Brightest pixel of a saturated star, stars above it are not centroided well
+SATURATION = 0.98
+
+_OFFSETS = np.arange(-2, 3)
+
+# Stars measured for the profile of a frame, and the half size of their patches
+PROFILE_STARS = 50
+PROFILE_RADIUS = 4
+
+
+def detect_stars(image: np.ndarray, sigma: float = DETECTION_SIGMA, limit: int = MAX_DETECTIONS) -> np.ndarray:
+    """
+    (N, 3) x, y, flux of the stars of a 2D image, brightest first
+    """
+    image = np.asarray(image, dtype=np.float32)
+    background = float(np.median(image[::4, ::4]))
+    noise = 1.4826 * float(np.median(np.abs(image[::4, ::4] - background)))
+
+    smoothed = cv.GaussianBlur(image, (0, 0), 1.5)
+    peaks = (smoothed == cv.dilate(smoothed, np.ones((5, 5), np.uint8))) & \
+        (smoothed > background + sigma * max(noise, 1e-6))
+
+    # Centroid windows have to fit in the image
+    peaks[:3, :] = peaks[-3:, :] = False
+    peaks[:, :3] = peaks[:, -3:] = False
+    ys, xs = np.nonzero(peaks)
+
+    saturated = image[ys, xs] >= SATURATION * image.max()
+    ys, xs = ys[~saturated], xs[~saturated]
+    if len(xs) == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+
+    patches = image[ys[:, None, None] + _OFFSETS[None, :, None],
+                    xs[:, None, None] + _OFFSETS[None, None, :]] - background
+    patches = np.clip(patches, 0, None)
+    flux = np.maximum(patches.sum(axis=(1, 2)), 1e-6)
+    cx = xs + (patches.sum(axis=1) * _OFFSETS).sum(axis=1) / flux
+    cy = ys + (patches.sum(axis=2) * _OFFSETS).sum(axis=1) / flux
+
+    order = np.argsort(-flux)[:limit]
+    return np.stack([cx[order], cy[order], flux[order]], axis=1).astype(np.float32)
+
+
+def star_profile(image: np.ndarray, stars: np.ndarray) -> np.ndarray:
+    """
+    [fwhm (pixels), roundness (minor / major axis), background] of a 2D
+    image from its brightest stars, fwhm and roundness are nan without stars
+    """
+    image = np.asarray(image, dtype=np.float32)
+    background = float(np.median(image[::4, ::4]))
+    height, width = image.shape
+
+    xs = np.rint(stars[:, 0]).astype(np.int64)
+    ys = np.rint(stars[:, 1]).astype(np.int64)
+    r = PROFILE_RADIUS
+    inside = (xs >= r) & (xs < width - r) & (ys >= r) & (ys < height - r)
+    xs, ys = xs[inside][:PROFILE_STARS], ys[inside][:PROFILE_STARS]
+    if len(xs) == 0:
+        return np.array([np.nan, np.nan, background])
+
+    window = np.arange(-r, r + 1)
+    patches = np.clip(image[ys[:, None, None] + window[None, :, None],
+                            xs[:, None, None] + window[None, None, :]] - background, 0, None)
+    dy, dx = window[None, :, None].astype(np.float32), window[None, None, :].astype(np.float32)
+
+    flux = np.maximum(patches.sum(axis=(1, 2)), 1e-6)
+    mx = (patches * dx).sum(axis=(1, 2)) / flux
+    my = (patches * dy).sum(axis=(1, 2)) / flux
+    var_x = (patches * dx * dx).sum(axis=(1, 2)) / flux - mx ** 2
+    var_y = (patches * dy * dy).sum(axis=(1, 2)) / flux - my ** 2
+    cov = (patches * dx * dy).sum(axis=(1, 2)) / flux - mx * my
+
+    # Axes of the moment ellipse, as quality.screen measures them
+    half_trace = (var_x + var_y) / 2
+    spread = np.sqrt(((var_x - var_y) / 2) ** 2 + cov ** 2)
+    major, minor = half_trace + spread, np.maximum(half_trace - spread, 0)
+    valid = major > 0
+    if not valid.any():
+        return np.array([np.nan, np.nan, background])
+
+    fwhm = 2.3548 * np.sqrt((major[valid] + minor[valid]) / 2)
+    roundness = np.sqrt(minor[valid] / major[valid])
+    return np.array([float(np.median(fwhm)), float(np.median(roundness)), background])
+
+
+def layer_image(view: FrameView, layer: int) -> np.ndarray:
+    return view.physical((min(layer, view.shape[0] - 1),))
+
+
+class StarCache:
+    def __init__(self, process_dir: str, sequence: str) -> None:
+        self.directory = os.path.join(process_dir, f"{sequence}_stars")
+
+    def _file(self, index: int) -> str:
+        return os.path.join(self.directory, f"{index:05d}.npz")
+
+    def _key(self, view: FrameView, layer: int) -> np.ndarray:
+        stat = os.stat(view.path)
+        return np.array([stat.st_size, stat.st_mtime_ns, view.hdu, layer, DETECTION_SIGMA], dtype=np.float64)
+
+    def get(self, index: int, view: FrameView, layer: int) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """
+        (stars, profile) of a frame, None when not cached (or cached
+        without its profile)
+        """
+        try:
+            with np.load(self._file(index)) as cached:
+                if np.array_equal(cached['key'], self._key(view, layer)):
+                    return cached['stars'], cached['profile']
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+        return None
+
+    def put(self, index: int, view: FrameView, layer: int, stars: np.ndarray, profile: np.ndarray):
+        os.makedirs(self.directory, exist_ok=True)
+        # np.savez adds .npz to names that don't end with it
+        tmp = f"{self._file(index)}.tmp.npz"
+        np.savez(tmp, key=self._key(view, layer), stars=stars, profile=profile)
+        os.replace(tmp, self._file(index))
+
+
+def frame_stars(task: tuple[int, FrameView, int, StarCache]) -> tuple[int, np.ndarray, np.ndarray, bool]:
+    """
+    Stars and profile (see star_profile) of a frame from the cache,
+    detected when missing or stale. Returns (index, stars, profile, cached)
+    """
+    index, view, layer, cache = task
+    cached = cache.get(index, view, layer)
+    if cached is not None:
+        return index, cached[0], cached[1], True
+
+    image = layer_image(view, layer)
+    stars = detect_stars(image)
+    profile = star_profile(image, stars)
+    view.close()
+    cache.put(index, view, layer, stars, profile)
+    return index, stars, profile, False
@@ -0,0 +1,70 @@
+import os
+import os.path
+
+from pathlib import Path
+import argparse
+
+from .quality import FrameScreen
+from .quality.screen import QUALITY_BINNING, QUALITY_SIGMA
+from .logger import Logger as _Logger
+
+"""
+Unselects the bad frames of a converted sequence before it is calibrated
+
+Usage:
+    poetry run python -m src.screen lights.fit --sigma=3
+
+    from src.screen import screen
+    screen(siril, "lights.fit", sigma=3)
+
+"""
+
+fits_extension = os.getenv('FITS_EXTENSION', 'fit')
+
+Logger = _Logger(__name__)
+parser = argparse.ArgumentParser()
+
+parser.add_argument('seq', type=str, help="Sequence (.seq or FITS sequence) to screen")
+
+parser.add_argument('--sigma',
+                    required=False,
+                    type=float,
+                    default=QUALITY_SIGMA,
+                    dest="sigma",
+                    help="Frames further than this many sigmas from the sequence are excluded")
+
+parser.add_argument('--binning',
+                    required=False,
+                    type=int,
+                    default=QUALITY_BINNING,
+                    dest="binning",
+                    help="Binning of the green channel the frames are measured on")
+
+
+def screen(
+    siril,
+    seq: str,
+    sigma: float = QUALITY_SIGMA,
+    binning: int = QUALITY_BINNING,
+) -> bool:
+    """
+    siril is not used, it keeps the signature of the other stages
+    """
+    Logger.info(f"Screening {seq}")
+
+    report = FrameScreen(str(Path(seq).parent), Path(seq).stem.rstrip('_'),
+                         fits_extension, binning=binning, sigma=sigma).run()
+
+    Logger.info(
+        f"Screened {seq}: {len([r for r in report if r['included']])}/{len(report)} frames kept")
+    return True
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    try:
+        screen(None, args.seq, sigma=args.sigma, binning=args.binning)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
@@ -0,0 +1,4 @@
+from .seqfile import seq_name, seq_file, frame_file, list_frames, write_seq, read_seq, set_excluded, set_transforms, included_frames, merge_sequences, IDENTITY
+from .fitsmap import FrameView, bayer_pattern, open_fits, open_frame, primary_header, frame_header
+from .reader import SequenceReader
+from .compression import compression, write_image, existing_file
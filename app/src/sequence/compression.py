@@ -0,0 +1,128 @@
+import os
+from typing import Optional
+
+import numpy as np
+from astropy.io import fits
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Tile-compressed storage of intermediate sequences (FITS_COMPRESSION)
+
+    FITS_COMPRESSION=rice         RICE_1, fast, lossless on 16-bit frames
+    FITS_COMPRESSION=hcompress    HCOMPRESS_1, smaller, slower (Siril writes Rice)
+    FITS_COMPRESSION=gzip1|gzip2  GZIP_1 / GZIP_2
+
+Frames are written the way Siril's setcompress writes them: the image goes
+in a compressed extension of {name}.fit.fz, the .seq gets its fz flag and
+the codec is recorded in every frame (ZCMPTYPE). Integer frames are always
+compressed losslessly; float frames are never quantized, they fall back to
+GZIP_2 (Rice and HCOMPRESS only compress floats by quantizing them).
+
+Readers don't need the setting, see sequence.fitsmap and
+SequenceReader: both layouts are found and read transparently.
+
+Usage:
+    out = write_image(frame_file(process_dir, "pp_lights", 1, "fit"), data, header)
+"""
+
+CODECS = {
+    'rice': 'RICE_1',
+    'hcompress': 'HCOMPRESS_1',
+    'gzip1': 'GZIP_1',
+    'gzip2': 'GZIP_2',
+}
+
+COMPRESSED_SUFFIX = '.fz'
+
+# Rows per HCOMPRESS tile, Rice and GZIP compress one row per tile
+HCOMPRESS_ROWS = 16
+# HCOMPRESS can't compress a tile of fewer rows, nor an image this narrow
+HCOMPRESS_MIN_ROWS = 4
+
+
+def compression() -> Optional[str]:
+    """
+    Siril name of the codec intermediates are written with, None when they
+    are not compressed
+    """
+    codec = os.getenv('FITS_COMPRESSION', 'none').lower()
+    if codec in ['', 'none', '0']:
+        return None
+    if codec not in CODECS:
+        raise Exception(f"Unknown FITS compression: {codec}, expected one of {list(CODECS)}")
+    return codec
+
+
+def compressed_file(path: str, codec: Optional[str] = None) -> str:
+    """
+    File an image written to `path` ends up in
+    """
+    return f"{path}{COMPRESSED_SUFFIX}" if codec else path
+
+
+def existing_file(path: str) -> str:
+    """
+    `path`, or its compressed twin when only that one exists
+    """
+    if not os.path.isfile(path) and os.path.isfile(f"{path}{COMPRESSED_SUFFIX}"):
+        return f"{path}{COMPRESSED_SUFFIX}"
+    return path
+
+
+def hcompress_rows(height: int) -> int:
+    """
+    Rows of the HCOMPRESS tiles of an image: HCOMPRESS_ROWS, made taller
+    until the last tile of the image is a whole one or has at least
+    HCOMPRESS_MIN_ROWS rows
+    """
+    rows = min(HCOMPRESS_ROWS, height)
+    while 0 < height % rows < HCOMPRESS_MIN_ROWS:
+        rows += 1
+    return rows
+
+
+def compressed_hdu(data: np.ndarray, header: Optional[fits.Header], codec: str) -> fits.CompImageHDU:
+    compression_type = CODECS[codec]
+    if data.dtype.kind == 'f':
+        compression_type = CODECS['gzip2']
+    elif compression_type == CODECS['hcompress'] and min(data.shape[-2:]) < HCOMPRESS_MIN_ROWS:
+        compression_type = CODECS['rice']
+
+    tile_shape = (1,) * (data.ndim - 1) + (data.shape[-1],)
+    if compression_type == CODECS['hcompress']:
+        tile_shape = (1,) * (data.ndim - 2) + (hcompress_rows(data.shape[-2]), data.shape[-1])
+
+    # No quantization, GZIP keeps floats bit for bit
+    quantize = {'quantize_level': 0} if data.dtype.kind == 'f' else {}
+    return fits.CompImageHDU(data=data, header=header, compression_type=compression_type,
+                             tile_shape=tile_shape, **quantize)
+
+
+def write_image(path: str, data: np.ndarray, header: Optional[fits.Header] = None, codec: Optional[str] = None) -> str:
+    """
+    Writes a 2D or (channels, height, width) image to `path`, compressed to
+    path.fz with the FITS_COMPRESSION codec (or `codec`). Returns the file
+    written; its twin from a run in the other mode is removed
+    """
+    codec = codec if codec is not None else compression()
+    if data.ndim == 3 and data.shape[0] == 1:
+        data = data[0]
+
+    out = compressed_file(path, codec)
+    if codec:
+        hdus = fits.HDUList([fits.PrimaryHDU(), compressed_hdu(data, header, codec)])
+    else:
+        hdus = fits.HDUList([fits.PrimaryHDU(data=data, header=header)])
+
+    tmp = f"{out}.tmp"
+    hdus.writeto(tmp, overwrite=True)
+    os.replace(tmp, out)
+
+    stale = path if codec else f"{path}{COMPRESSED_SUFFIX}"
+    if os.path.isfile(stale):
+        os.remove(stale)
+
+    return out
@@ -0,0 +1,301 @@
+import os
+from typing import Optional
+
+import numpy as np
+from astropy.io import fits
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Zero-copy access to the images of FITS files
+
+The header of every HDU is parsed by hand and its data unit memory-mapped
+with numpy, nothing is read until it is sliced. BZERO / BSCALE are only
+applied to the part of an image that is asked for:
+
+    [frame] = open_fits("pp_lights_00001.fit")
+    frame.shape                 # (3, 4000, 6000), always (channels, height, width)
+    frame.raw[1, :100]          # view on the stored values, no copy
+    frame[1, :100]              # same rows, scaled to float32
+    frame.physical()            # the whole image, scaled
+
+A FITS sequence (convert / calibrate with fitseq) is one file with an image
+per HDU, open_fits returns a FrameView for each of them.
+
+Tile-compressed images (.fit.fz, see sequence.compression) can't be mapped:
+slicing one decompresses only the tiles the slice covers, raw decompresses
+the whole image once. A tile is always decompressed whole, read them in
+full-width bands of tile_rows rows.
+"""
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Cards of an extension HDU a primary HDU can't have
+EXTENSION_KEYWORDS = ['XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'EXTVER', 'EXTLEVEL', 'INHERIT']
+
+BITPIX_DTYPES = {
+    8: np.dtype('u1'),
+    16: np.dtype('>i2'),
+    32: np.dtype('>i4'),
+    64: np.dtype('>i8'),
+    -32: np.dtype('>f4'),
+    -64: np.dtype('>f8'),
+}
+
+
+def _value(raw: str):
+    raw = raw.split('/')[0].strip() if not raw.strip().startswith("'") else raw.strip()
+
+    if raw.startswith("'"):
+        return raw[1:raw.rfind("'")].rstrip()
+    if raw in ['T', 'F']:
+        return raw == 'T'
+
+    try:
+        return int(raw)
+    except ValueError:
+        pass
+    try:
+        return float(raw.replace('D', 'E'))
+    except ValueError:
+        return raw
+
+
+def read_header(f) -> Optional[tuple[dict, int]]:
+    """
+    Header of the HDU starting at the current position of f, and the offset
+    of its data unit. None at the end of the file
+    """
+    header: dict = {}
+
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            return None
+
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE].decode('ascii', errors='replace')
+            key = card[:8].strip()
+
+            if key == 'END':
+                return header, f.tell()
+            if card[8:10] == '= ' and key not in header:
+                header[key] = _value(card[10:])
+
+
+def image_header(header: dict) -> dict:
+    """
+    Header of the image held by a tile-compressed HDU (ZBITPIX, ZNAXISn...)
+    """
+    image = dict(header)
+    image['BITPIX'] = header['ZBITPIX']
+    image['NAXIS'] = header['ZNAXIS']
+    for n in range(1, header['ZNAXIS'] + 1):
+        image[f'NAXIS{n}'] = header[f'ZNAXIS{n}']
+    return image
+
+
+def data_size(header: dict) -> int:
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+
+    size = 1
+    for n in range(1, naxis + 1):
+        size *= header[f'NAXIS{n}']
+
+    # PCOUNT is the heap of a binary table, ie: the tiles of a compressed image
+    return abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + size)
+
+
+class FrameView:
+    def __init__(self, path: str, hdu: int, offset: int, header: dict, compressed: bool = False) -> None:
+        """
+        path, hdu: file and index of the HDU holding the image
+        offset: byte offset of the data unit in the file
+        compressed: the HDU is a tile-compressed image, header is the
+        header of that image (see image_header)
+        """
+        self.path = path
+        self.hdu = hdu
+        self.offset = offset
+        self.header = header
+        self.compressed = compressed
+        self.bscale = header.get('BSCALE', 1)
+        self.bzero = header.get('BZERO', 0)
+        self.dtype = BITPIX_DTYPES[header['BITPIX']]
+
+        naxis = [header[f'NAXIS{n}'] for n in range(1, header['NAXIS'] + 1)]
+        width, height = naxis[0], naxis[1] if len(naxis) > 1 else 1
+        channels = naxis[2] if len(naxis) > 2 else 1
+        self.shape = (channels, height, width)
+        self._raw: Optional[np.ndarray] = None
+        self._hdul: Optional[fits.HDUList] = None
+
+    # Only the location of the image is pickled, workers map it themselves
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_raw'] = None
+        state['_hdul'] = None
+        return state
+
+    def __repr__(self) -> str:
+        return f"<FrameView {os.path.basename(self.path)}[{self.hdu}] {self.shape} {self.dtype}>"
+
+    def _compressed_hdu(self):
+        if self._hdul is None:
+            self._hdul = fits.open(self.path, do_not_scale_image_data=True)
+        return self._hdul[self.hdu]
+
+    @property
+    def raw(self) -> np.ndarray:
+        """
+        Stored values, memory-mapped read only (decompressed for
+        tile-compressed images)
+        """
+        if self._raw is None:
+            if self.compressed:
+                self._raw = np.asarray(self._compressed_hdu().data,
+                                       dtype=self.dtype).reshape(self.shape)
+            else:
+                self._raw = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                      offset=self.offset, shape=self.shape)
+        return self._raw
+
+    def stored(self, key=()) -> np.ndarray:
+        """
+        raw[key], a compressed image only decompresses the tiles key covers
+        """
+        if not self.compressed or self._raw is not None:
+            return self.raw[key]
+
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        section = self._compressed_hdu().section
+
+        if self.header['NAXIS'] == 2:
+            data = np.asarray(section[key[1], key[2]])[np.newaxis][key[0]]
+        else:
+            data = np.asarray(section[key])
+
+        return data.astype(self.dtype)
+
+    @property
+    def tile_rows(self) -> int:
+        """
+        Rows of a compression tile (ZTILE2), 0 for an image that isn't
+        tile-compressed
+        """
+        if not self.compressed:
+            return 0
+        return int(self.header.get('ZTILE2', 1)) if self.header['NAXIS'] > 1 else 1
+
+    @property
+    def scaled(self) -> bool:
+        return self.bscale != 1 or self.bzero != 0
+
+    @property
+    def unsigned16(self) -> bool:
+        """
+        Siril's 16-bit images: int16 with BZERO = 32768
+        """
+        return self.dtype == np.dtype('>i2') and self.bscale == 1 and self.bzero == 32768
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.physical(key)
+
+    def physical(self, key=(), dtype=np.float32) -> np.ndarray:
+        """
+        Physical values of raw[key], only that part is read and scaled
+        """
+        data = self.stored(key)
+
+        if self.unsigned16:
+            # Flipping the sign bit is the exact int16 + 32768 -> uint16
+            return (data.view(np.dtype('>u2')) ^ np.uint16(0x8000)).astype(dtype)
+        if not self.scaled:
+            return data.astype(dtype)
+
+        return data.astype(dtype) * np.array(self.bscale, dtype=dtype) + np.array(self.bzero, dtype=dtype)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.physical(dtype=dtype if dtype else np.float32)
+
+    @property
+    def integer(self) -> bool:
+        return self.dtype.kind in 'iu'
+
+    def close(self):
+        if isinstance(self._raw, np.memmap):
+            self._raw._mmap.close()  # type: ignore
+        self._raw = None
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+
+def bayer_pattern(view: FrameView) -> str:
+    """
+    BAYERPAT in the order the rows are stored in: Siril writes bottom-up,
+    which swaps the rows of the pattern when the height is even
+    """
+    pattern = str(view.header.get('BAYERPAT', 'RGGB')).upper()
+    if str(view.header.get('ROWORDER', '')).upper() == 'BOTTOM-UP' and view.shape[1] % 2 == 0:
+        pattern = pattern[2:] + pattern[:2]
+    return pattern
+
+
+def primary_header(header: fits.Header) -> fits.Header:
+    """
+    Copy of the header of an image HDU for a primary HDU holding a processed
+    copy of the image: without the cards of an extension (a frame of a FITS
+    sequence) nor BZERO / BSCALE, the data written is physical
+    """
+    header = header.copy()
+    for key in EXTENSION_KEYWORDS + ['BZERO', 'BSCALE']:
+        header.remove(key, ignore_missing=True, remove_all=True)
+    return header
+
+
+def frame_header(view: FrameView) -> fits.Header:
+    """
+    Header of the image of a FrameView, to write what was made of it
+    """
+    return primary_header(fits.getheader(view.path, ext=view.hdu))
+
+
+def open_fits(path: str) -> list[FrameView]:
+    """
+    Every image HDU of a FITS file, a FITS sequence has one per frame
+    """
+    frames = []
+
+    with open(path, 'rb') as f:
+        hdu = 0
+        while True:
+            parsed = read_header(f)
+            if parsed is None:
+                break
+
+            header, offset = parsed
+            size = data_size(header)
+
+            if size > 0 and header.get('XTENSION', 'IMAGE') == 'IMAGE' and header['NAXIS'] >= 2:
+                frames.append(FrameView(path, hdu, offset, header))
+            elif header.get('ZIMAGE') is True and header.get('ZNAXIS', 0) >= 2:
+                frames.append(FrameView(path, hdu, offset, image_header(header), compressed=True))
+
+            f.seek(offset + -(-size // BLOCK_SIZE) * BLOCK_SIZE)
+            hdu += 1
+
+    if not frames:
+        raise Exception(f"No image found in {path}")
+
+    return frames
+
+
+def open_frame(path: str) -> FrameView:
+    return open_fits(path)[0]
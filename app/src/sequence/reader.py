@@ -0,0 +1,187 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+from .fitsmap import FrameView, open_fits, open_frame
+from .compression import existing_file
+from .seqfile import IDENTITY, frame_file, list_frames, read_seq, seq_name, set_excluded, set_transforms, write_seq
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Reads the images of a Siril sequence without copying them
+
+Works for both layouts Siril writes:
+    - one file per image: pp_lights_00001.fit, pp_lights_00002.fit, ...
+    - a FITS sequence (fitseq): pp_lights.fit with one image per HDU
+
+The .seq file, when there is one, decides which images are selected.
+Tile-compressed images (.fit.fz, FITS_COMPRESSION) are read the same way.
+
+Usage:
+    sequence = SequenceReader(process_dir, "pp_lights")
+    for frame in sequence.frames():
+        histogram = np.histogram(frame.raw[1, ::4, ::4], bins=256)
+    block = sequence.tile(0, 256, 0, 256)    # (frames, channels, 256, 256)
+    homographies = sequence.transforms()      # index -> 3x3, once registered
+"""
+
+
+class SequenceReader:
+    def __init__(self,
+                 process_dir: str,
+                 sequence: str,
+                 fits_extension: str = os.getenv('FITS_EXTENSION', 'fit')
+                 ) -> None:
+        self.logger = Logger
+        self.process_dir = process_dir
+        self.sequence = sequence.rstrip('_')
+        self.fits_extension = fits_extension
+
+        self.fitseq = existing_file(os.path.join(
+            process_dir, f"{self.sequence}.{fits_extension}"))
+        self.is_fitseq = os.path.isfile(self.fitseq)
+
+        # index -> FrameView, opened on first use
+        self._frames: dict[int, FrameView] = {}
+        # layer -> index -> homography, from the R lines of the .seq
+        self._transforms: dict[int, dict[int, list[float]]] = {}
+        self.indices, self.excluded = self._read_indices()
+
+    def _seq_file(self) -> Optional[str]:
+        for name in [seq_name(self.sequence), self.sequence]:
+            path = os.path.join(self.process_dir, f"{name}.seq")
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _read_indices(self) -> tuple[list[int], list[int]]:
+        seq = self._seq_file()
+        parsed = read_seq(seq) if seq else None
+
+        if self.is_fitseq:
+            views = open_fits(self.fitseq)
+            # Images of a FITS sequence are numbered from 0, in HDU order
+            self._frames = {i: view for i, view in enumerate(views)}
+            indices = list(self._frames.keys())
+        else:
+            indices = list_frames(
+                self.process_dir, self.sequence, self.fits_extension)
+
+        images = parsed["images"] if parsed else []
+        transforms = parsed["transforms"] if parsed else {}
+        if self.is_fitseq:
+            positions = {index: position for position, (index, _) in enumerate(images)}
+            transforms = {layer: {positions[i]: h for i, h in t.items()}
+                          for layer, t in transforms.items()}
+            images = [(position, included)
+                      for position, (_, included) in enumerate(images)]
+        self._transforms = transforms
+        excluded = [i for i, included in images if not included]
+
+        if not indices:
+            raise Exception(
+                f"No images found for sequence {self.sequence} in {self.process_dir}")
+
+        return indices, excluded
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def frame(self, index: int) -> FrameView:
+        if index not in self._frames:
+            self._frames[index] = open_frame(existing_file(frame_file(
+                self.process_dir, self.sequence, index, self.fits_extension)))
+        return self._frames[index]
+
+    def frames(self, selected: bool = True) -> list[FrameView]:
+        return [self.frame(i) for i in self.indices if not selected or i not in self.excluded]
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return self.frame(self.indices[0]).shape
+
+    @property
+    def compression(self) -> Optional[str]:
+        """
+        Codec the images are stored with (ie: RICE_1), None when they are not compressed
+        """
+        frame = self.frame(self.indices[0])
+        return frame.header.get('ZCMPTYPE') if frame.compressed else None
+
+    def _writable_seq_file(self) -> tuple[str, dict[int, int]]:
+        """
+        The .seq file (written when missing), and the index it gives to each
+        image of this reader
+        """
+        seq = self._seq_file()
+
+        if seq is None:
+            if self.is_fitseq:
+                raise Exception(f"No .seq file for the FITS sequence {self.sequence}")
+            seq = write_seq(self.process_dir, self.sequence, self.indices, self.excluded)
+
+        if not self.is_fitseq:
+            return seq, {i: i for i in self.indices}
+
+        # The .seq numbers the images of a FITS sequence its own way, in HDU order
+        images = read_seq(seq)["images"]
+        return seq, {position: index for position, (index, _) in enumerate(images)}
+
+    def set_excluded(self, excluded: list[int]) -> str:
+        """
+        Unselects exactly these images (indices of this reader) in the .seq
+        file, so Siril and frames() skip them
+        """
+        seq, ids = self._writable_seq_file()
+        set_excluded(seq, [ids[i] for i in excluded])
+        self.excluded = sorted(excluded)
+        return seq
+
+    def set_transforms(self, layer: int, transforms: dict[int, list[float]], stats: Optional[dict[int, list]] = None) -> str:
+        """
+        Stores registration homographies (indices of this reader) in the .seq file
+        """
+        seq, ids = self._writable_seq_file()
+        set_transforms(seq, layer,
+                       {ids[i]: h for i, h in transforms.items()},
+                       layers=self.shape[0],
+                       stats={ids[i]: v for i, v in stats.items()} if stats else None)
+        self._transforms[layer] = {i: list(transforms.get(i, IDENTITY)) for i in ids}
+        return seq
+
+    def transforms(self, layer: Optional[int] = None) -> dict[int, np.ndarray]:
+        """
+        Registration of the images (indices of this reader): 3x3 homographies
+        mapping each image onto the reference. Empty when the sequence isn't
+        registered. Without a layer, the first layer that holds more than
+        identities is used
+        """
+        if layer is None:
+            layer = next((l for l, t in sorted(self._transforms.items())
+                          if any(h != IDENTITY for h in t.values())), None)
+
+        return {i: np.array(h, dtype=np.float64).reshape(3, 3)
+                for i, h in self._transforms.get(layer, {}).items()}
+
+    def registration(self, selected: bool = True) -> list[Optional[np.ndarray]]:
+        """
+        Homography of each image of frames(), in the same order (None for
+        images the .seq has no transform for)
+        """
+        transforms = self.transforms()
+        return [transforms.get(i) for i in self.indices if not selected or i not in self.excluded]
+
+    def tile(self, y0: int, y1: int, x0: int, x1: int, selected: bool = True) -> np.ndarray:
+        """
+        Physical values of the same region of every frame, (frames, channels, y, x)
+        """
+        return np.stack([f.physical((slice(None), slice(y0, y1), slice(x0, x1)))
+                         for f in self.frames(selected)])
+
+    def close(self):
+        for f in self._frames.values():
+            f.close()
@@ -0,0 +1,235 @@
+import os
+import re
+import shutil
+from typing import Optional
+
+from .compression import existing_file, COMPRESSED_SUFFIX
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Reads and writes the .seq files Siril keeps next to a sequence of FITS files
+
+A sequence "lights" of 3 images is stored as lights_00001.fit ... and a
+lights_.seq file listing them:
+
+    #Siril sequence file
+    S 'lights_' 1 3 3 5 -1 4 0 0
+    L -1
+    I 1 1
+    I 2 1
+    I 3 1
+
+Registration adds one R line per image and layer, after the I lines, ending
+with the homography that maps the image onto the reference:
+
+    R1 fwhm weighted_fwhm roundness quality background stars H h00 h01 ... h22
+"""
+
+SEQ_VERSION = 4
+FIXED_LENGTH = 5
+
+IDENTITY = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
+
+
+def seq_name(sequence: str) -> str:
+    return sequence if sequence.endswith('_') else f"{sequence}_"
+
+
+def seq_file(process_dir: str, sequence: str) -> str:
+    return os.path.join(process_dir, f"{seq_name(sequence)}.seq")
+
+
+def frame_file(process_dir: str, sequence: str, index: int, fits_extension: str) -> str:
+    return os.path.join(process_dir, f"{seq_name(sequence)}{index:0{FIXED_LENGTH}d}.{fits_extension}")
+
+
+def list_frames(process_dir: str, sequence: str, fits_extension: str) -> list[int]:
+    """
+    Indices of the images of a sequence found on disk, compressed (.fz) or not
+    """
+    if not os.path.isdir(process_dir):
+        return []
+
+    pattern = re.compile(
+        rf"^{re.escape(seq_name(sequence))}(\d+)\.{re.escape(fits_extension)}(?:{re.escape(COMPRESSED_SUFFIX)})?$")
+
+    return sorted({int(m.group(1)) for m in [pattern.match(f) for f in os.listdir(process_dir)] if m})
+
+
+def write_seq(process_dir: str, sequence: str, indices: list[int], excluded: Optional[list[int]] = None, fitseq: bool = False, fz: bool = False) -> str:
+    """
+    (Re)writes the .seq file of a sequence of individual FITS files, or of
+    a FITS sequence ({sequence}.seq, images numbered from 0 in HDU order)
+
+    fz: the images are tile-compressed, {name}.fit.fz
+    """
+    indices = sorted(indices)
+    excluded = excluded if excluded else []
+    beg = indices[0] if indices else 0
+    selected = len([i for i in indices if i not in excluded])
+    name = sequence.rstrip('_') if fitseq else seq_name(sequence)
+
+    lines = [
+        "#Siril sequence file. Contains list of images, selection, registration data and statistics",
+        "#S 'sequence_name' start_index nb_images nb_selected fixed_len reference_image version variable_size fz_flag",
+        f"S '{name}' {beg} {len(indices)} {selected} {FIXED_LENGTH} -1 {SEQ_VERSION} 0 {1 if fz else 0}",
+    ]
+    if fitseq:
+        lines.append("TF")
+    lines.append("L -1")
+    lines += [f"I {i} {0 if i in excluded else 1}" for i in indices]
+
+    path = os.path.join(process_dir, f"{name}.seq")
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+    return path
+
+
+def read_seq(path: str) -> dict:
+    """
+    Name, start index, fz flag, (index, included) of every image of a .seq
+    file and the homographies of its registered layers: {layer: {index: [9 values]}}
+    """
+    sequence = {"name": None, "beg": 0, "number": 0, "fz": False, "images": [], "transforms": {}}
+    registrations: dict[int, list[list[float]]] = {}
+
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or line.startswith('#'):
+                continue
+
+            if fields[0] == 'S':
+                sequence["name"] = line.split("'")[1]
+                fields = line.split("'")[2].split()
+                sequence["beg"] = int(fields[0])
+                sequence["number"] = int(fields[1])
+                # beg number selnum fixed_len reference version variable fz
+                sequence["fz"] = len(fields) > 7 and fields[7] == '1'
+            elif fields[0] == 'I':
+                sequence["images"].append((int(fields[1]), fields[2] == '1'))
+            elif fields[0].startswith('R') and len(fields[0]) == 2 and 'H' in fields:
+                h = fields.index('H')
+                registrations.setdefault(int(fields[0][1]), []).append(
+                    [float(v) for v in fields[h + 1:h + 10]])
+
+    # R lines of a layer are in the order of the images
+    for layer, transforms in registrations.items():
+        sequence["transforms"][layer] = {
+            index: transform for (index, _), transform in zip(sequence["images"], transforms)}
+
+    return sequence
+
+
+def set_transforms(path: str, layer: int, transforms: dict[int, list[float]], layers: int = 3, stats: Optional[dict[int, list]] = None) -> str:
+    """
+    Replaces the registration of a layer in an existing .seq file, images
+    without a transform get the identity
+
+    stats: index -> [fwhm, weighted_fwhm, roundness, quality, background, stars]
+    """
+    with open(path, 'r') as f:
+        lines = [line for line in f.read().splitlines()
+                 if not line.startswith(f"R{layer} ")]
+
+    images = [int(line.split()[1]) for line in lines if line.startswith('I ')]
+    stats = stats if stats else {}
+
+    for n, line in enumerate(lines):
+        # Siril needs the number of layers to read registration data
+        if line.startswith('L ') and int(line.split()[1]) < 0:
+            lines[n] = f"L {layers}"
+
+    for i in images:
+        fwhm, weighted_fwhm, roundness, quality, background, stars = stats.get(i, [0, 0, 0, 0, 0, 0])
+        h = " ".join(f"{v:.10g}" for v in transforms.get(i, IDENTITY))
+        lines.append(
+            f"R{layer} {fwhm:g} {weighted_fwhm:g} {roundness:g} {quality:g} {background:g} {int(stars)} H {h}")
+
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+    return path
+
+
+def set_excluded(path: str, excluded: list[int]) -> str:
+    """
+    Rewrites the include flag of every image of an existing .seq file (and
+    its selected count), everything else Siril stored in it is kept
+    """
+    excluded = set(excluded)
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+
+    selected = 0
+    for n, line in enumerate(lines):
+        fields = line.split()
+        if fields and fields[0] == 'I':
+            included = int(fields[1]) not in excluded
+            selected += included
+            lines[n] = " ".join(fields[:2] + ['1' if included else '0'] + fields[3:])
+
+    for n, line in enumerate(lines):
+        if line.startswith('S '):
+            # S 'name' beg number selnum ...
+            name, rest = line.rsplit("'", 1)
+            fields = rest.split()
+            fields[2] = str(selected)
+            lines[n] = f"{name}' {' '.join(fields)}"
+
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+    return path
+
+
+def included_frames(process_dir: str, sequence: str, fits_extension: str) -> list[str]:
+    """
+    Files of the images of a sequence that are selected in its .seq file
+    (every image on disk when there is no .seq file)
+    """
+    indices = list_frames(process_dir, sequence, fits_extension)
+    path = seq_file(process_dir, sequence)
+
+    if os.path.isfile(path):
+        excluded = [i for i, included in read_seq(path)["images"] if not included]
+        indices = [i for i in indices if i not in excluded]
+
+    return [existing_file(frame_file(process_dir, sequence, i, fits_extension)) for i in indices]
+
+
+def merge_sequences(process_dir: str, sequences: list[str], out: str, fits_extension: str) -> str:
+    """
+    Native Siril merge: the selected images of `sequences`, in this order,
+    become the sequence `out` numbered from 1. Images are hard linked
+    (copied where the filesystem can't link), returns the .seq file
+    """
+    for i in list_frames(process_dir, out, fits_extension):
+        os.remove(existing_file(frame_file(process_dir, out, i, fits_extension)))
+
+    merged = 0
+    fz = False
+    for sequence in sequences:
+        for path in included_frames(process_dir, sequence, fits_extension):
+            merged += 1
+            suffix = COMPRESSED_SUFFIX if path.endswith(COMPRESSED_SUFFIX) else ''
+            fz = fz or bool(suffix)
+            target = f"{frame_file(process_dir, out, merged, fits_extension)}{suffix}"
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copyfile(path, target)
+
+    if not merged:
+        raise Exception(f"No frames to merge in {sequences}")
+
+    return write_seq(process_dir, out, list(range(1, merged + 1)), fz=fz)
@@ -2,6 +2,10 @@ from .siril import SirilWrapper
 from .frame import Frame
 from .session import Session
 from .postprocess import PostProcess
-from .master_library import get_library_file
+from .master_library import get_library_file, MasterLibrary
 # from .convert import convert
-from .preprocess import preprocess
+from .preprocess import preprocess, preprocess_night
+from .multinight import MultiNightExecutor, NightResult
+from .instance import SirilInstance, start_instance
+from .watch import FrameWatcher, SirilIngest
+from .trace import traced, trace_context, get_tracer
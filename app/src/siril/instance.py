@@ -0,0 +1,155 @@
+import os
+import subprocess
+import tempfile
+import uuid
+from typing import Optional
+
+from pysiril.siril import *  # type: ignore
+from pysiril.wrapper import *  # type: ignore
+
+# pysiril.siril puts its lib/ directory on sys.path when imported
+import PipeReader  # type: ignore
+import PipeWriter  # type: ignore
+import ThreadSiril  # type: ignore
+
+from .trace import traced
+from ..sequence.compression import compression
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Siril instances that can run side by side
+
+pysiril hard-codes /tmp/siril_command.in and /tmp/siril_command.out, so two
+Siril() objects in the same machine fight over the same pipes. SirilInstance
+starts `siril -p` with its own pair of pipes (-r / -w) so every night, worker
+or pool slot can drive an independent Siril process.
+"""
+
+# Codecs setcompress takes, see sequence.compression.CODECS
+SIRIL_CODECS = ['rice', 'gzip1', 'gzip2']
+
+
+class _SirilThread(ThreadSiril.ThreadSiril):
+    def __init__(self, trace, siril_exe: str, pipe_in: str, pipe_out: str):
+        super().__init__(trace, siril_exe)
+        self.pipe_in = pipe_in
+        self.pipe_out = pipe_out
+        self.process = None
+        self.Siril_output = ""
+
+    def run(self):
+        self.runningSiril = True
+        cmd_siril = [self.siril_exe, "-p",
+                     "-r", self.pipe_in,
+                     "-w", self.pipe_out]
+
+        try:
+            if os.getenv('LANG') is None:
+                os.environ['LANG'] = 'C'
+            self.process = subprocess.Popen(
+                cmd_siril, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+            self.Siril_output = self.process.communicate()[0].decode("utf-8")
+        except Exception as e:
+            self.Siril_output = f"Aborted: {' '.join(cmd_siril)}\n"
+            self.tr.error(f"*** _SirilThread::run() {e}\n")
+
+        self.runningSiril = False
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+
+class SirilInstance(Siril):  # type: ignore
+    def __init__(self,
+                 name: Optional[str] = None,
+                 siril_exe: Optional[str] = None,
+                 pipe_dir: Optional[str] = None,
+                 delai_start: int = 7
+                 ) -> None:
+        super().__init__(siril_exe=siril_exe, delai_start=delai_start)
+
+        self.name = name if name else uuid.uuid4().hex[:8]
+        pipe_dir = pipe_dir if pipe_dir else tempfile.gettempdir()
+
+        self.pipe_in = os.path.join(pipe_dir, f"siril_command_{self.name}.in")
+        self.pipe_out = os.path.join(
+            pipe_dir, f"siril_command_{self.name}.out")
+
+        self.thSiril = _SirilThread(
+            self.tr, self.siril_exe, self.pipe_in, self.pipe_out)
+        self.thReader = PipeReader.ThreadReader(
+            self.tr, self.qStatus, self.pipe_out, self.__check_alive__)
+        self.PipeWriter = PipeWriter.PipeWriter(
+            self.tr, self.qStatus, self.pipe_in, self.__check_alive__)
+
+    def is_alive(self) -> bool:
+        return self.bOpened and self.__check_alive__()
+
+    def kill(self):
+        """
+        Hard stop for an instance that no longer answers on its pipes
+        """
+        Logger.warning(f"Killing Siril instance: {self.name}")
+        try:
+            self.Close()
+        except Exception:
+            pass
+        self.thSiril.kill()
+
+        for pipe in [self.pipe_in, self.pipe_out]:
+            if os.path.exists(pipe):
+                os.remove(pipe)
+
+
+def set_compression(siril) -> tuple:
+    """
+    Makes Siril write tile-compressed FITS (.fit.fz) when FITS_COMPRESSION
+    is set, plain FITS otherwise
+
+    setcompress only takes the SIRIL_CODECS, Siril writes its frames with
+    Rice when FITS_COMPRESSION=hcompress (the native stages still write
+    HCOMPRESS, readers take both). No quantization is sent: instances are
+    16-bit (set16bits) and Siril only quantizes float frames
+    """
+    codec = compression()
+    if not codec:
+        return siril.setcompress(0)
+
+    if codec not in SIRIL_CODECS:
+        Logger.warning(f"Siril can't write {codec} frames, using rice")
+        codec = 'rice'
+    return siril.setcompress(1, type=codec, quantif=None)
+
+
+def start_instance(
+        name: Optional[str] = None,
+        cpu_cores: Optional[int] = None,
+        working_dir: Optional[str] = None,
+        fits_extension: str = os.getenv('FITS_EXTENSION', 'fit')
+):
+    """
+    Opens a SirilInstance and returns it with a Wrapper configured the
+    same way SirilWrapper.start() configures the main one, its commands
+    traced (see siril.trace)
+    """
+    app = SirilInstance(name=name)
+
+    if app.Open() is not True:
+        raise Exception(f"Failed to start Siril instance {app.name}")
+
+    siril = traced(Wrapper(app), name=app.name)  # type: ignore
+    siril.set16bits()
+    siril.setext(fits_extension)
+    set_compression(siril)
+
+    if cpu_cores:
+        siril.setcpu(cpu_cores)
+
+    if working_dir:
+        siril.cd(working_dir)
+
+    Logger.info(f"Siril instance started: {app.name}")
+    return app, siril
@@ -1,56 +1,366 @@
 import os
-from exiftool import ExifToolHelper  # type: ignore
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Optional
 
+from ..sequence import open_frame
+from ..metadata import get_exif_service
 from ..logger import Logger as _Logger
 from .frame import Frame
 
 Logger = _Logger(__name__)
 
+"""
+Index of the master frames of the library
 
-def get_camera_exif(light: Frame, night: str = None) -> tuple:
+Every master under BIAS_LIBRARY and MASTER_LIBRARY_PATH is recorded in a
+SQLite index with its type, camera model, ISO, exposure, sensor temperature
+and date. These come from the FITS header Siril writes (INSTRUME, ISOSPEED,
+EXPTIME, CCD-TEMP, DATE-OBS), falling back to what both naming schemes put
+in the file name:
+
+    {model}_{iso}_stacked_bias.fit           (capture_master_biases)
+    {model}_{iso}_{exposure}s_{name}.fit     (the legacy Stack)
+
+A refresh only re-reads the directories whose mtime changed, and only the
+headers of the files that are new or changed, so a session pays a few
+stat() calls instead of a scan of the library.
+
+Lookups are range queries on (type, model, iso, exposure, temperature)
+indexes: the nearest exposure first, then the nearest temperature, the
+nearest date breaking ties.
+
+Usage:
+    library = MasterLibrary()
+    library.nearest('darks', 'Canon_EOS_Rebel_T8i', 800, exposure=120, temperature=18)
+"""
+
+MASTER_TYPES = ['biases', 'darks', 'flats']
+
+INDEX_FILE_NAME = os.getenv('MASTER_LIBRARY_INDEX', '.master_library.sqlite')
+
+# Masters further than this from what is asked for are not a match
+MAX_EXPOSURE_DELTA = float(os.getenv('MASTER_MAX_EXPOSURE_DELTA', 0.5))
+MAX_TEMPERATURE_DELTA = float(os.getenv('MASTER_MAX_TEMPERATURE_DELTA', 5))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS masters (
+    path TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    model TEXT,
+    iso INTEGER,
+    exposure REAL,
+    temperature REAL,
+    date TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS masters_exposure ON masters (type, model, iso, exposure, temperature);
+CREATE INDEX IF NOT EXISTS masters_temperature ON masters (type, model, iso, temperature);
+"""
+
+# Canon_EOS_Rebel_T8i_800_stacked_bias, Canon_EOS_Rebel_T8i_800_120s_stacked_dark
+FILE_NAME_PATTERN = re.compile(
+    r'^(?P<model>.+?)_(?P<iso>\d+)(?:_(?P<exposure>\d+(?:\.\d+)?)s)?_(?P<name>[^_].*)$')
+
+
+def library_roots() -> list[str]:
+    roots = [os.getenv('BIAS_LIBRARY'), os.getenv('MASTER_LIBRARY_PATH')]
+    return list(dict.fromkeys([r.rstrip('/') for r in roots if r]))
+
+
+def master_type(path: str) -> Optional[str]:
+    """
+    biases / darks / flats, from the directory or the file name
+    """
+    lower = path.lower()
+    for directory, frame_type in [(os.getenv('BIASES_DIR_NAME'), 'biases'),
+                                  (os.getenv('DARKS_DIR_NAME'), 'darks'),
+                                  (os.getenv('FLATS_DIR_NAME'), 'flats')]:
+        if directory and f"/{directory.lower()}/" in lower:
+            return frame_type
+
+    name = os.path.basename(lower)
+    for word, frame_type in [('bias', 'biases'), ('offset', 'biases'), ('dark', 'darks'), ('flat', 'flats')]:
+        if word in name:
+            return frame_type
+
+    return None
+
+
+def _number(value) -> Optional[float]:
     try:
-        Logger.info("Getting camera ISO and Model")
-        first_light_image_file = f"{light.dir}/{night}/{os.listdir(light.dir)[0]}" if night else f"{light.dir}/{os.listdir(light.dir)[0]}"
-
-        Logger.info(f"first_light_image_file: {first_light_image_file}")
-        with ExifToolHelper() as exif:
-            tags = exif.get_tags(files=first_light_image_file, tags=[
-                "EXIF:ISO", "Make", "Model"])[0]
-            iso = tags.get('EXIF:ISO')
-            model = tags.get('EXIF:Model').replace(' ', "_")
-
-        Logger.info(f"ISO: {iso}, Model: {model}")
-        return (iso, model)
+        return float(value) if value not in [None, ''] else None
+    except (TypeError, ValueError):
+        return None
+
+
+def read_master(path: str) -> Optional[dict]:
+    """
+    Metadata of a master, None when it isn't one
+    """
+    frame_type = master_type(path)
+    if frame_type is None:
+        return None
+
+    try:
+        header = open_frame(path).header
+    except Exception as e:
+        Logger.warning(f"Skipping unreadable master {path}: {e}")
+        return None
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = FILE_NAME_PATTERN.match(stem)
+    named = match.groupdict() if match else {}
+
+    model = header.get('INSTRUME') or named.get('model')
+    iso = _number(header.get('ISOSPEED', header.get('GAIN'))) or _number(named.get('iso'))
+    exposure = _number(header.get('EXPTIME', header.get('EXPOSURE')))
+    temperature = _number(header.get('CCD-TEMP', header.get('SET-TEMP')))
+
+    if exposure is None:
+        exposure = _number(named.get('exposure'))
+
+    return {
+        'path': path,
+        'type': frame_type,
+        'model': str(model).strip().replace(' ', '_') if model else None,
+        'iso': int(iso) if iso is not None else None,
+        'exposure': exposure,
+        'temperature': temperature,
+        'date': header.get('DATE-OBS'),
+    }
+
+
+class MasterLibrary:
+    def __init__(self, roots: Optional[list[str]] = None, index: Optional[str] = None) -> None:
+        """
+        roots: directories to index, defaults to BIAS_LIBRARY and MASTER_LIBRARY_PATH
+        index: SQLite file, defaults to INDEX_FILE_NAME in the first root
+        """
+        self.logger = Logger
+        self.roots = roots if roots is not None else library_roots()
+        if not self.roots:
+            raise Exception("No master library: set BIAS_LIBRARY or MASTER_LIBRARY_PATH")
+
+        self.index = index if index else os.path.join(self.roots[0], INDEX_FILE_NAME)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.index, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.refreshed = False
+
+    def close(self):
+        self.db.close()
+
+    def _directories(self, root: str) -> list[str]:
+        directories = []
+        for directory, subdirectories, _ in os.walk(root):
+            subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+            directories.append(directory)
+        return directories
+
+    def refresh(self, full: bool = False) -> int:
+        """
+        Indexes new and changed masters, forgets deleted ones. Returns the
+        number of files that had to be read
+
+        full: also look into directories whose mtime didn't change, a master
+        overwritten in place doesn't touch its directory
+        """
+        extension = f".{os.getenv('FITS_EXTENSION', 'fit')}"
+        read = 0
+
+        with self._lock, self.db:
+            known = {row['path']: row['mtime_ns'] for row in
+                     self.db.execute("SELECT path, mtime_ns FROM directories")}
+            seen = set()
+
+            for root in self.roots:
+                if not os.path.isdir(root):
+                    continue
+
+                for directory in self._directories(root):
+                    seen.add(directory)
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                    if not full and known.get(directory) == mtime_ns:
+                        continue
+
+                    read += self._refresh_directory(directory, extension)
+                    self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)",
+                                    (directory, mtime_ns))
+
+            for directory in set(known) - seen:
+                self.db.execute("DELETE FROM directories WHERE path = ?", (directory,))
+                self.db.execute("DELETE FROM masters WHERE substr(path, 1, ?) = ?",
+                                (len(directory) + 1, f"{directory}/"))
+
+        self.refreshed = True
+        if read:
+            self.logger.info(f"Indexed {read} masters in {self.index}")
+        return read
+
+    def _refresh_directory(self, directory: str, extension: str) -> int:
+        indexed = {row['path']: (row['size'], row['mtime_ns']) for row in self.db.execute(
+            "SELECT path, size, mtime_ns FROM masters WHERE substr(path, 1, ?) = ?",
+            (len(directory) + 1, f"{directory}/"))}
+        # Only the files of this directory, not of its subdirectories
+        indexed = {p: v for p, v in indexed.items() if os.path.dirname(p) == directory}
+        read = 0
+        present = set()
+
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not entry.name.lower().endswith(extension):
+                continue
+
+            stat = entry.stat()
+            present.add(entry.path)
+            if indexed.get(entry.path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            master = read_master(entry.path)
+            read += 1
+            if master is None:
+                continue
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO masters VALUES (:path, :type, :model, :iso, :exposure, :temperature, :date, :size, :mtime_ns)",
+                {**master, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+        for path in set(indexed) - present:
+            self.db.execute("DELETE FROM masters WHERE path = ?", (path,))
+
+        return read
+
+    def _nearest_value(self, column: str, where: str, params: list, value: float) -> Optional[float]:
+        """
+        Closest value of an indexed column, from one range query each side
+        """
+        below = self.db.execute(
+            f"SELECT {column} FROM masters WHERE {where} AND {column} <= ? ORDER BY {column} DESC LIMIT 1",
+            params + [value]).fetchone()
+        above = self.db.execute(
+            f"SELECT {column} FROM masters WHERE {where} AND {column} >= ? ORDER BY {column} ASC LIMIT 1",
+            params + [value]).fetchone()
+
+        candidates = [row[0] for row in [below, above] if row is not None]
+        return min(candidates, key=lambda v: abs(v - value)) if candidates else None
+
+    def nearest(self,
+                frame_type: str,
+                model: str,
+                iso: Optional[int],
+                exposure: Optional[float] = None,
+                temperature: Optional[float] = None,
+                date: Optional[str] = None,
+                max_exposure_delta: float = MAX_EXPOSURE_DELTA,
+                max_temperature_delta: float = MAX_TEMPERATURE_DELTA
+                ) -> Optional[str]:
+        """
+        Path of the closest master, None when there is no acceptable match
+
+        exposure is only matched for darks, a bias or a flat of another
+        exposure is just as good
+        """
+        if frame_type not in MASTER_TYPES:
+            raise Exception(f"Unknown master type: {frame_type}")
+        if not self.refreshed:
+            self.refresh()
+
+        where = "type = ? AND model = ? AND iso IS ?"
+        params: list = [frame_type, model.replace(' ', '_'), iso]
+
+        with self._lock:
+            if frame_type == 'darks' and exposure is not None:
+                nearest_exposure = self._nearest_value('exposure', where, params, exposure)
+                if nearest_exposure is None or abs(nearest_exposure - exposure) > max_exposure_delta:
+                    return None
+                where += " AND exposure = ?"
+                params.append(nearest_exposure)
+
+            if temperature is not None:
+                nearest_temperature = self._nearest_value('temperature', where, params, temperature)
+                if nearest_temperature is not None:
+                    if abs(nearest_temperature - temperature) > max_temperature_delta:
+                        return None
+                    where += " AND temperature = ?"
+                    params.append(nearest_temperature)
+
+            row = self.db.execute(
+                f"SELECT path FROM masters WHERE {where} "
+                "ORDER BY date IS NULL, abs(julianday(date) - julianday(?)) ASC LIMIT 1",
+                params + [date if date else datetime.now().isoformat()]).fetchone()
+
+        return row['path'] if row else None
+
+    def masters(self, frame_type: Optional[str] = None) -> list[dict]:
+        if not self.refreshed:
+            self.refresh()
+
+        query = "SELECT * FROM masters" + (" WHERE type = ?" if frame_type else "") + \
+            " ORDER BY type, model, iso, exposure, temperature"
+        with self._lock:
+            return [dict(row) for row in self.db.execute(query, [frame_type] if frame_type else [])]
+
+
+_library: Optional[MasterLibrary] = None
+
+
+def get_library() -> MasterLibrary:
+    """
+    The process wide library, refreshed once
+    """
+    global _library
+    if _library is None:
+        _library = MasterLibrary()
+    return _library
+
+
+def get_camera_exif(light: Frame, night: str = None) -> dict:
+    try:
+        Logger.info("Getting camera ISO, Model, Exposure and Temperature")
+        directory = f"{light.dir}/{night}" if night else light.dir
+
+        camera = get_exif_service().first(directory)
+        Logger.info(f"Camera: {camera['model']} ISO {camera['iso']} {camera['exposure']}s {camera['temperature']}°C")
+        return camera
     except Exception as e:
         Logger.error('get_camera_exif failed')
         raise e
 
 
-def get_library_file(type: Frame, light=Frame, night: str = None) -> str:
+def get_library_file(type: Frame, light=Frame, night: str = None, camera: Optional[dict] = None) -> str:
+    """
+    camera: EXIF of the lights (see Session.get_camera), read from the
+    first light when not given
+    """
     try:
-        if type.name != os.environ['BIASES_NAME']:
-            raise Exception("Only Master Biases are supported for now")
-
-        (iso, model) = get_camera_exif(light, night=night)
-
-        master_library_filepath = "/".join([
-            # /master-library
-            f"{os.environ['BIAS_LIBRARY']}",
-            # /Canon_EOS_Rebel_T8i
-            model,
-            # /biases
-            os.environ['BIASES_DIR_NAME'],
-            # /Canon_EOS_Rebel_T8i_800_stacked_bias
-            f"{model}_{iso}_{os.environ['BIASES_STACKED_PREFIX']}{os.environ['BIASES_NAME']}"
-            # .fit
-        ]) + f".{os.environ['FITS_EXTENSION']}"
+        frame_type = {
+            os.environ['BIASES_NAME']: 'biases',
+            os.environ.get('DARKS_NAME'): 'darks',
+            os.environ.get('FLATS_NAME'): 'flats',
+        }.get(type.name)
+        if frame_type is None:
+            raise Exception(f"No master library for {type.name} frames")
+
+        if camera is None:
+            camera = get_camera_exif(light, night=night)
+
+        master_library_filepath = get_library().nearest(
+            frame_type, camera['model'], camera['iso'],
+            exposure=camera['exposure'],
+            temperature=camera['temperature'],
+            date=camera['timestamp'])
 
         Logger.info(f"master_file_name: {master_library_filepath}")
 
-        if os.path.isfile(master_library_filepath):
-            return master_library_filepath
-        else:
-            return ""
+        return master_library_filepath if master_library_filepath else ""
 
     except Exception as e:
         Logger.error('get_library_file failed')
@@ -0,0 +1,136 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from .frame import Frame
+from .session import Session
+from .trace import trace_context
+from .preprocess import preprocess_night
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Runs the per-night work of a multi-night session in parallel
+
+Every night gets its own Siril process (leased from the pool daemon when
+one runs, see pool.lease_instance) and an equal share of CPU_CORES through
+`setcpu`, so 4-8 nights of lights are converted and calibrated side by side
+instead of one after the other.
+
+Usage:
+    executor = MultiNightExecutor(session)
+    executor.run(lights, delete_raws=True)
+    executor.raise_for_errors()
+"""
+
+
+class NightResult:
+    def __init__(self, frame: Frame, night: str, directory: str) -> None:
+        self.frame = frame
+        self.night = night
+        self.directory = directory
+        self.result = None
+        self.error: Optional[Exception] = None
+        self.elapsed: float = 0
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        status = "ok" if self.success else f"error: {self.error}"
+        return f"<NightResult {self.frame.name}_{self.night} {status} {self.elapsed:.1f}s>"
+
+
+class MultiNightExecutor:
+    def __init__(self,
+                 session: Session,
+                 workers: Optional[int] = None,
+                 cpu_cores: Optional[int] = None
+                 ) -> None:
+        self.logger = Logger
+        self.session = session
+        self.workers = workers
+        self.cpu_cores = cpu_cores if cpu_cores else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.results: list[NightResult] = []
+
+    def cpu_share(self, jobs: int) -> int:
+        return max(1, self.cpu_cores // max(1, jobs))
+
+    def run(self,
+            frame: Frame,
+            task: Callable = preprocess_night,
+            **kwargs
+            ) -> list[NightResult]:
+        """
+        Runs `task(Siril, session, frame, directory, **kwargs)` once per night
+
+        Errors are not raised, they are collected on the NightResult of the
+        night that failed so that one bad night doesn't cancel the others.
+        """
+        if self.session.multiple:
+            self.session.validate_supported(frame)
+
+        directories = self.session.list_directories(frame)
+
+        if len(directories) == 0:
+            self.logger.info(f"No nights found for {frame.name}")
+            return []
+
+        workers = self.workers if self.workers else len(directories)
+        workers = min(workers, len(directories))
+        cpu_cores = self.cpu_share(workers)
+
+        self.logger.info(
+            f"Processing {len(directories)} nights of {frame.name} with {workers} Siril instances ({cpu_cores} cpus each)")
+
+        # src.pool imports src.siril
+        from ..pool import lease_instance
+
+        def run_night(directory: str) -> NightResult:
+            night = self.session.get_night(frame, directory)
+            night_result = NightResult(frame, night, directory)
+            started = time.perf_counter()
+            app = None
+
+            try:
+                app, siril = lease_instance(
+                    name=f"{frame.name}_{night}", cpu_cores=cpu_cores)
+                with trace_context(stage=task.__name__, frame=frame.name, night=night):
+                    night_result.result = task(
+                        siril, self.session, frame, directory, **kwargs)
+            except Exception as e:
+                self.logger.error(
+                    f"Failed to process {frame.name} frames from: {night} {e}")
+                night_result.error = e
+            finally:
+                if app is not None:
+                    app.Close()
+                night_result.elapsed = time.perf_counter() - started
+
+            return night_result
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_night, directories))
+
+        self.results.extend(results)
+
+        for r in results:
+            self.logger.info(f"{r}")
+
+        return results
+
+    def errors(self) -> list[NightResult]:
+        return [r for r in self.results if not r.success]
+
+    def raise_for_errors(self):
+        failed = self.errors()
+        if failed:
+            nights = ", ".join(
+                [f"{r.frame.name}_{r.night}" for r in failed])
+            raise Exception(
+                f"Failed to process nights: {nights}", [r.error for r in failed])
@@ -1,10 +1,10 @@
 import os
 from pathlib import Path
-import subprocess
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
+from ..graxpert import graxpert
 from ..logger import Logger as _Logger
 
 Logger = _Logger(__name__)
@@ -85,14 +85,7 @@ class Post:
 
     def denoise(self, file, gpu=False):
         self.logger.info(f"Denoising: {file}")
-        gradient_cmd = [
-            'graxpert',
-            file,
-            "-cli",
-            "-gpu", "true" if gpu else "false",
-            "--command", "denoising"
-        ]
-        subprocess.run(gradient_cmd)
+        graxpert(file, "denoising", gpu=gpu)
 
         self.logger.info("Denoising Complete")
         self.logger.info(
@@ -100,18 +93,9 @@ class Post:
         # self.siril.load(f"{Path(file).stem}_GraXpert.fits")
 
     def remove_gradient(self, file: str, gpu=False):
-        gradient_cmd = [
-            "graxpert",
-            file,
-            "-cli",
-            "-correction", "Subtraction",
-            "-smoothing", "0.1",
-            "-bg",
-            "-gpu", "true" if gpu else "false",
-            "--command", "background-extraction"
-        ]
         self.logger.info(f"Running GraXpert Background Extraction")
-        subprocess.run(gradient_cmd)
+        graxpert(file, "background-extraction",
+                 ["-correction", "Subtraction", "-smoothing", "0.1", "-bg"], gpu=gpu)
         self.logger.info(f"Gradient Removed")
 
     def final(self, file, stretch=True, remove_work=True, denoise=False, star_stretch=True, extra_star_denoise=False, ra=None, dec=None, ):
@@ -1,14 +1,23 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import subprocess
+from typing import Callable
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
+from .trace import trace_context
+from ..astrometry import get_solve_cache
+from ..background import remove_gradient
+from ..graxpert import graxpert
+from ..sequence import existing_file
 from ..logger import Logger as _Logger
 
 Logger = _Logger(__name__)
 
+GRADIENT_SMOOTHING = 0.1
+
 
 class PostProcess:
     logger: _Logger = None
@@ -98,50 +107,50 @@ class PostProcess:
         self.SirilWrapper.siril.clahe(cliplimit=cliplimit, tileSize=tileSize)
         return self
 
+    def _graxpert(self, siril, file: str, command: str, args: list[str], gpu=False) -> str:
+        """
+        Runs a GraXpert command on `file` and loads what it wrote in
+        `siril`, returns the path of that output
+        """
+        output = graxpert(file, command, args, gpu=gpu)
+        siril.cd(os.path.dirname(file))
+        siril.load(Path(output).name)
+        return output
+
+    def _remove_gradient(self, siril, file: str, gpu=False) -> str:
+        """
+        Background extraction of `file`, by GraXpert or natively (see
+        BACKGROUND_BACKEND), loaded in `siril`, returns the path of its output
+        """
+        output = remove_gradient(file, smoothing=GRADIENT_SMOOTHING, gpu=gpu)
+        siril.cd(os.path.dirname(file))
+        siril.load(Path(output).name)
+        return output
+
     def denoise(self, gpu=False):
         """
         Denoising the image can take a long time
         """
         self.assert_loaded()
         self.logger.info(f"Denoising: {self.loaded}")
-        gradient_cmd = [
-            'graxpert',
-            self.loaded,
-            "-cli",
-            "-gpu", "true" if gpu else "false",
-            "--command", "denoising"
-        ]
 
-        subprocess.run(gradient_cmd)
+        output = self._graxpert(self.SirilWrapper.siril, self.loaded, "denoising", [], gpu=gpu)
 
         self.logger.info("Denoising Complete")
-        self.logger.info(
-            f"THE DENOISING FINAL IMAGE PATH: {Path(self.loaded).stem}_GraXpert.fits")
-        self.SirilWrapper.siril.load(f"{Path(self.loaded).stem}_GraXpert.fits")
+        self.logger.info(f"THE DENOISING FINAL IMAGE PATH: {output}")
         self._save()
-        os.remove(
-            f"{os.path.dirname(self.loaded)}/{Path(self.loaded).stem}_GraXpert.fits")
+        os.remove(output)
         return self
 
     def remove_gradient(self, gpu=False):
-        self.logger.info(f"Running GraXpert Background Extraction")
+        self.logger.info(f"Running Background Extraction")
         self.assert_loaded()
-        gradient_cmd = [
-            "graxpert",
-            self.loaded,
-            "-cli",
-            "-correction", "Subtraction",
-            "-smoothing", "0.1",
-            "-bg",
-            "-gpu", "true" if gpu else "false",
-            "--command", "background-extraction"
-        ]
-        subprocess.run(gradient_cmd)
+
+        output = self._remove_gradient(self.SirilWrapper.siril, self.loaded, gpu=gpu)
+
         self.logger.info(f"Gradient Removed")
-        self.SirilWrapper.siril.load(f"{Path(self.loaded).stem}_GraXpert.fits")
         self._save()
-        os.remove(
-            f"{os.path.dirname(self.loaded)}/{Path(self.loaded).stem}_GraXpert.fits")
+        os.remove(output)
 
         return self
 
@@ -156,7 +165,15 @@ class PostProcess:
               noflip=False,
               limitmag=None,
               catalog=None,
+              cache=True,
               ):
+        """
+        With cache, an image solved before (same pixels and optics) gets its
+        cached solution instead of being solved again. The solution is
+        cached for the pixels saved after the solve: without noflip Siril
+        may have flipped the image, its solution doesn't fit the pixels it
+        was loaded with
+        """
 
         self.logger.info(f"Plate Solving")
 
@@ -185,8 +202,27 @@ class PostProcess:
             'catalog': catalog,
         }
 
-        self.SirilWrapper.siril.platesolve(**platesolve_params)
+        # The stack as it is on disk, Siril only has the stretch in memory
+        solve_cache = get_solve_cache() if cache else None
+        key = solve_cache.key(self.loaded, focal=focal, pixelsize=pixelsize) if solve_cache else None
+
+        if solve_cache and solve_cache.get(key) is not None:
+            self.SirilWrapper.siril.save(self.loaded)
+            solve_cache.apply(key, self.loaded)
+            self.SirilWrapper.siril.load(self.loaded)
+            self.logger.info(f"Plate Solving Completed (cached)")
+            return self
+
+        [solved] = self.SirilWrapper.siril.platesolve(**platesolve_params)
         self.SirilWrapper.siril.save(self.loaded)
+
+        if solved is True and solve_cache:
+            # A later run loads the file saved here
+            solve_cache.store(solve_cache.key(self.loaded, focal=focal, pixelsize=pixelsize), self.loaded)
+            # Not flipped, the solution also fits the pixels as they were loaded
+            if noflip:
+                solve_cache.store(key, self.loaded)
+
         self.SirilWrapper.siril.load(self.loaded)
         self.logger.info(f"Plate Solving Completed")
         return self
@@ -202,6 +238,118 @@ class PostProcess:
         )
         return self
 
+    def _progress(self, branch: str, message: str):
+        self.logger.info(f"[{branch}] {message}")
+
+    def _process_stars(self, siril, star_stretch=True, extra_star_denoise=False):
+        """
+        Star Processing: asinh stretch and denoise of the star mask
+        """
+        siril.cd(os.path.dirname(self.starmask))
+        siril.load(Path(self.starmask).stem)
+        siril.save(f"{Path(self.starmask).stem}.bak")
+
+        if star_stretch:
+            # ASINH Stretch
+            self._progress('stars', "ASINH Stretch: 0 // 0.2 on Stars")
+            [completed] = siril.asinh(1, human=True, offset=0.2)
+            if completed is not True:
+                raise Exception("ASINH Stretch on Stars Failed")
+
+        # Denoise
+        self._progress('stars', "Denoising Stars")
+        [completed] = siril.denoise(
+            mod=1, nocosmetic=False, da3d=extra_star_denoise)
+        if completed is not True:
+            raise Exception("Denoising Stars Failed")
+
+        self._progress('stars', f"Saving: {self.starmask}")
+        siril.save(self.starmask)
+
+    def _process_starless(self, siril, denoise=False):
+        """
+        Starless Processing: background extraction (and GraXpert denoise),
+        asinh stretch
+        """
+        siril.cd(os.path.dirname(self.starless))
+        siril.load(Path(self.starless).stem)
+        siril.save(f"{Path(self.starless).stem}.bak")
+
+        starless_file = existing_file(f"{self.starless}.{os.environ['FITS_EXTENSION']}")
+
+        #  Remove Gradient
+        self._progress('starless', "Running Background Extraction")
+        output = self._remove_gradient(siril, starless_file)
+        siril.save(self.starless)
+        os.remove(output)
+
+        if denoise:
+            self._progress('starless', "Denoising with GraXpert")
+            output = self._graxpert(siril, starless_file, "denoising", [])
+            siril.save(self.starless)
+            os.remove(output)
+
+        # ASINH Stretch
+        self._progress('starless', "ASINH Stretch: 0 // 0.2 on Background")
+        [completed] = siril.asinh(1, human=True, offset=0.18)
+        if completed is not True:
+            raise Exception("ASINH Stretch on Background Failed")
+
+        self._progress('starless', f"Saving: {self.starless}")
+        siril.save(self.starless)
+
+    def _run_branches(self, branches: dict[str, Callable]):
+        """
+        Runs `branch(siril)` of every branch at the same time, the first one
+        on this Siril and the others on Siril instances of their own (one
+        after the other on this Siril with POSTPROCESS_PARALLEL=0, or when
+        an instance can't start). Raises the first error once all ended
+        """
+        names = list(branches)
+        instances: dict = {}
+
+        if os.getenv('POSTPROCESS_PARALLEL', '1') != '0':
+            # src.pool imports src.siril
+            from ..pool import lease_instance
+
+            cpu_cores = max(1, int(os.getenv('CPU_CORES', os.cpu_count())) // len(names))
+            for name in names[1:]:
+                try:
+                    instances[name] = lease_instance(name=f"postprocess_{name}", cpu_cores=cpu_cores)
+                except Exception as e:
+                    self.logger.warning(f"Running the {name} branch after the others: {e}")
+
+        def run(name: str, siril):
+            started = time.perf_counter()
+            self._progress(name, "Started")
+            with trace_context(stage='postprocess', node=name, frame=self.frame.name):
+                branches[name](siril)
+            self._progress(name, f"Completed in {time.perf_counter() - started:.1f}s")
+
+        parallel = [name for name in names if name in instances]
+        sequential = [name for name in names if name not in instances]
+
+        errors = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(parallel))) as pool:
+                futures = [pool.submit(run, name, instances[name][1]) for name in parallel]
+                for name in sequential:
+                    try:
+                        run(name, self.SirilWrapper.siril)
+                    except Exception as e:
+                        errors.append(e)
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+        finally:
+            for app, _ in instances.values():
+                app.Close()
+
+        if errors:
+            raise errors[0]
+
     def _star_recomposition(self, starless, starmask):
         self.logger.info(
             f"Combining Starless and Starmask with PixelMath: Starless: {starless}.fit   Stars: {starmask}.fit")
@@ -263,58 +411,14 @@ class PostProcess:
 
         self.starnet()
 
-        """
-        Star Processing
-        """
-        self.SirilWrapper.siril.cd(os.path.dirname(self.starmask))
-        self.SirilWrapper.siril.load(Path(self.starmask).stem)
-        self.SirilWrapper.siril.save(f"{Path(self.starmask).stem}.bak")
-
-        if star_stretch:
-            # ASINH Stretch
-            self.logger.info(f"ASINH Stretch: 0 // 0.2 on Stars")
-            [completed] = self.SirilWrapper.siril.asinh(
-                1, human=True, offset=0.2)
-            if completed is not True:
-                raise Exception("ASINH Stretch on Stars Failed")
-
-        # Denoise
-        self.logger.info(f"Denoising Stars")
-        [completed] = self.SirilWrapper.siril.denoise(
-            mod=1, nocosmetic=False, da3d=extra_star_denoise)
-        if completed is not True:
-            raise Exception("Denoising Stars Failed")
-
-        self.logger.info(f"Saving: {self.starmask}")
-        self.SirilWrapper.siril.save(self.starmask)
+        # Stars on a second Siril instance while GraXpert works on the background
+        self._run_branches({
+            'starless': lambda siril: self._process_starless(siril, denoise=denoise),
+            'stars': lambda siril: self._process_stars(siril, star_stretch=star_stretch,
+                                                       extra_star_denoise=extra_star_denoise),
+        })
 
-        """
-        Starless Processing
-        """
         self.SirilWrapper.siril.cd(os.path.dirname(self.starless))
-        self.SirilWrapper.siril.load(Path(self.starless).stem)
-        self.SirilWrapper.siril.save(f"{Path(self.starless).stem}.bak")
-
-        # Generated from running GraXpert
-        starless_graxpert_path = f"{os.path.dirname(self.starless)}/{Path(self.starless).stem}_GraXpert.fits"
-
-        #  Remove Gradient
-        self.remove_gradient(self.starless)
-
-        if denoise:
-            self.denoise(starless_graxpert_path)
-            self.SirilWrapper.siril.save(self.starless)
-
-        self.SirilWrapper.siril.load(self.starless)
-
-        # ASINH Stretch
-        self.logger.info(f"ASINH Stretch: 0 // 0.2 on Background")
-        [completed] = self.SirilWrapper.siril.asinh(1, human=True, offset=0.18)
-        if completed is not True:
-            raise Exception("ASINH Stretch on Background Failed")
-
-        self.logger.info(f"Saving: {self.starless}")
-        self.SirilWrapper.siril.save(self.starless)
 
         """
         Star Recomposition
@@ -1,9 +1,17 @@
 import os
 from pathlib import Path
+from typing import Optional
 from .session import Session
 from .frame import Frame
+from .stages import get_backend
+from .trace import trace_context
 from pysiril.wrapper import *  # type: ignore
 
+from ..calibration import CalibrationEngine
+from ..conversion import RawConverter
+from ..metadata import list_raws
+from ..sequence import compression
+from ..quality import FrameScreen
 from ..logger import Logger as _Logger
 
 Logger = _Logger(__name__)
@@ -32,6 +40,227 @@ def convert(
     return conversion_result
 
 
+def get_convert_backend(session: Session, frame: Frame) -> str:
+    """
+    "siril" or "native" (RawConverter)
+    """
+    return get_backend(session, frame, 'convert')
+
+
+def get_convert_params(session: Session, frame: Frame) -> dict:
+    """
+    What the converted frames depend on besides the raws
+    """
+    return {
+        "backend": get_convert_backend(session, frame),
+        "fits_extension": os.environ['FITS_EXTENSION'],
+        "compression": compression(),
+    }
+
+
+def convert_native(
+    frame: Frame,
+    session: Session,
+    directory: str,
+    night: str
+) -> bool:
+    """
+    Decodes the raws of a night in a process pool, to the same files and
+    .seq Siril's convert would write
+    """
+    conversion_name = frame.name if not session.multiple else f"{frame.name}_{night}"
+
+    Logger.info(f"Converting Frames {conversion_name} natively")
+
+    out_directory = frame.process_dir if not session.multiple else f"../{frame.process_dir}"
+    RawConverter(os.path.normpath(os.path.join(directory, out_directory)),
+                 conversion_name, os.environ['FITS_EXTENSION']).run(list_raws(directory))
+
+    Logger.info(f"{frame.name} Frames Converted")
+    return True
+
+
+def convert_night(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        directory: str,
+        delete_raws: bool = False
+) -> bool:
+    """
+    Converts the raws of a single directory (night) into the process directory
+
+    Returns False when the directory has no frames to convert
+    """
+    if len(os.listdir(directory)) == 0:
+        Logger.info(f"No frames found in {directory}")
+        # Check process directory to see if frames have already been converted
+        return False
+
+    night = session.get_night(frame, directory)
+
+    Logger.info(f"Converting {frame.name}") if not session.multiple else Logger.info(
+        f"Converting {frame.name} frames from: {night}")
+
+    """
+    Convert RAW to FITS
+    """
+    if get_convert_backend(session, frame) == 'native':
+        conversion_result = convert_native(frame, session, directory, night)
+    else:
+        Siril.cd(directory)
+        conversion_result = convert(frame, session, Siril, night)
+
+    if conversion_result is True:
+        if delete_raws:
+            try:
+                Logger.info(f"dir: {directory}")
+                for filename in os.listdir(directory):
+                    # TODO: Make this configurable
+                    # or better, compare to the fits results
+                    if filename.endswith(".cr3"):
+                        os.remove(os.path.join(directory, filename))
+            except Exception as e:
+                Logger.warning(
+                    f"Failed to delete raws for {frame.name} frames", e)
+    else:
+        raise Exception()
+
+    return True
+
+
+def screening_enabled(session: Session, frame: Frame) -> bool:
+    """
+    Lights are screened unless SCREEN_LIGHTS=0
+    """
+    return frame == session.lights and os.getenv('SCREEN_LIGHTS', '1') != '0'
+
+
+def screen(
+        session: Session,
+        frame: Frame,
+        night: str,
+        workers: Optional[int] = None
+) -> bool:
+    """
+    Unselects the bad frames of the converted sequence of a single night,
+    see quality.FrameScreen
+    """
+    if not screening_enabled(session, frame):
+        return False
+
+    sequence_name = f"{frame.name}" if not session.multiple else f"{frame.name}_{night}"
+    FrameScreen(session.get_process_dir(frame), sequence_name,
+                os.environ['FITS_EXTENSION'], workers=workers).run()
+    return True
+
+
+def get_calibrate_params(session: Session, frame: Frame, night: str) -> dict:
+    calibrate_params = {
+        "cfa": True,
+        "equalize_cfa": True,
+        "all": True,
+        "prefix": os.environ['PREPROCESS_PREFIX'],
+        "sighi": 3,
+        "siglo": 3,
+    }
+
+    if frame == session.lights:
+        calibrate_params['debayer'] = True
+        # Only the frames that passed screening
+        calibrate_params['all'] = not screening_enabled(session, frame)
+
+        stacked_flats = session.get_stacked_file(
+            session.flats, night=night)
+        Logger.info(
+            f"Calibrating {frame.name} frames using Stacked Flats: {stacked_flats}")
+
+        stacked_darks = session.get_stacked_file(
+            session.darks, night=night)
+        Logger.info(
+            f"Calibrating {frame.name} frames using Stacked Darks: {stacked_darks}")
+
+        if stacked_darks:
+            calibrate_params["dark"] = stacked_darks
+            calibrate_params["cc"] = 'dark'
+
+        if stacked_flats:
+            calibrate_params["flat"] = stacked_flats
+
+    if frame == session.flats:
+        stacked_biases = session.get_stacked_file(
+            session.biases, night=night)
+
+        if stacked_biases:
+            calibrate_params["bias"] = stacked_biases
+
+    return calibrate_params
+
+
+def get_calibrate_backend(session: Session, frame: Frame) -> str:
+    """
+    "siril" or "native" (CalibrationEngine)
+    """
+    return get_backend(session, frame, 'calibrate')
+
+
+def calibrate(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        night: str
+) -> bool:
+    """
+    Calibrates the converted sequence of a single night
+    """
+    calibrate_params = get_calibrate_params(session, frame, night)
+
+    Logger.info(f"Calibration Parameters: {calibrate_params}")
+    sequence_name = f"{frame.name}" if not session.multiple else f"{frame.name}_{night}"
+
+    if get_calibrate_backend(session, frame) == 'native':
+        CalibrationEngine(calibrate_params).run(
+            session.get_process_dir(frame), sequence_name, os.environ['FITS_EXTENSION'])
+        Logger.info(f"{frame.name} Frames Calibrated")
+        return True
+
+    # Converted sequences are written to the process directory
+    Siril.cd(session.get_process_dir(frame))
+
+    [calibrate_result] = Siril.calibrate(
+        sequence_name, **calibrate_params)
+
+    if calibrate_result is True:
+        Logger.info(f"{frame.name} Frames Calibrated")
+
+    return calibrate_result
+
+
+def preprocess_night(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        directory: str,
+        delete_raws: bool = False
+) -> bool:
+    """
+    Converts and calibrates the frames of a single directory (night)
+
+    Returns False when the directory has no frames to process
+    """
+    if not convert_night(Siril, session, frame, directory, delete_raws=delete_raws):
+        return False
+
+    night = session.get_night(frame, directory)
+
+    screen(session, frame, night)
+
+    """
+    Calibrate FITS
+    """
+    return calibrate(Siril, session, frame, night)
+
+
 def preprocess(
         Siril: Wrapper,  # type: ignore
         session: Session,
@@ -39,96 +268,12 @@ def preprocess(
         delete_raws: bool = False
 ):
     try:
-        directories = [f"{session.working_dir}/{frame.dir}/"]
-
         if session.multiple:
             session.validate_supported(frame)
-            directories = session.getMultiNightDirectories(
-                f"{session.working_dir}/{frame.dir}/")
-
-        for d in directories:
-            # Get the night name from the directory
-
-            if len(os.listdir(d)) == 0:
-                Logger.info(f"No frames found in {d}")
-                # Check process directory to see if frames have already been converted
-                continue
-
-            night = d.replace(
-                f"{session.working_dir}/{frame.dir}/{os.environ['MULTINIGHT_DIR_NAME']}", '')
-
-            Logger.info(f"Converting {frame.name}") if not session.multiple else Logger.info(
-                f"Converting {frame.name} frames from: {night}")
-
-            Siril.cd(d)
-
-            """
-            Convert RAW to FITS
-            """
-            conversion_result = convert(frame, session, Siril, night)
-
-            if conversion_result is True:
-                if delete_raws:
-                    try:
-                        Logger.info(f"dir: {dir}")
-                        for filename in os.listdir(dir):
-                            # TODO: Make this configurable
-                            # or better, compare to the fits results
-                            if filename.endswith(".cr3"):
-                                os.remove(os.path.join(d, filename))
-                    except Exception as e:
-                        Logger.warning(
-                            f"Failed to delete raws for {frame.name} frames", e)
-            else:
-                raise Exception()
-
-            """
-            Calibrate FITS
-            """
-            calibrate_params = {
-                "cfa": True,
-                "equalize_cfa": True,
-                "all": True,
-                "prefix": os.environ['PREPROCESS_PREFIX'],
-                "sighi": 3,
-                "siglo": 3,
-            }
-
-            if frame == session.lights:
-                calibrate_params['debayer'] = True
-
-                stacked_flats = session.get_stacked_file(
-                    session.flats, night=night)
-                Logger.info(
-                    f"Calibrating {frame.name} frames using Stacked Flats: {stacked_flats}")
-
-                stacked_darks = session.get_stacked_file(
-                    session.darks, night=night)
-                Logger.info(
-                    f"Calibrating {frame.name} frames using Stacked Darks: {stacked_darks}")
-
-                if stacked_darks:
-                    calibrate_params["dark"] = stacked_darks
-                    calibrate_params["cc"] = 'dark'
-
-                if stacked_flats:
-                    calibrate_params["flat"] = stacked_flats
-
-            if frame == session.flats:
-                stacked_biases = session.get_stacked_file(
-                    session.biases, night=night)
-
-                if stacked_biases:
-                    calibrate_params["bias"] = stacked_biases
-
-            Logger.info(f"Calibration Parameters: {calibrate_params}")
-            sequence_name = f"{frame.name}" if not session.multiple else f"{frame.name}_{night}"
-
-            [calibrate_result] = Siril.calibrate(
-                sequence_name, **calibrate_params)
-
-            if calibrate_result is True:
-                Logger.info(f"{frame.name} Frames Converted")
+
+        for d in session.list_directories(frame):
+            with trace_context(night=session.get_night(frame, d)):
+                preprocess_night(Siril, session, frame, d, delete_raws=delete_raws)
 
     except Exception as e:
         raise Exception(f"Failed to Convert {frame.name} frames", e)
@@ -1,11 +1,18 @@
 from .master_library import get_library_file
 import os
+import json
+import tempfile
+import threading
 from typing import Optional
 from .frame import Frame
+from ..metadata import get_exif_service
 from ..logger import Logger as _Logger
 
 Logger = _Logger(__name__)
 
+# Camera of every night, kept next to the converted lights
+CAMERA_FILE_NAME = os.getenv('CAMERA_FILE_NAME', 'cameras.json')
+
 
 class Session:
     def __init__(self,
@@ -24,6 +31,9 @@ class Session:
         self.multiple = multiple
         #
         self.working_dir = working_dir
+        # night -> EXIF of the first light, raws may be deleted once converted
+        self._cameras: dict[str, dict] = {}
+        self._cameras_lock = threading.Lock()
 
     def validate_supported(self, frame: Frame):
         if frame not in [self.darks, self.flats, self.lights]:
@@ -44,10 +54,83 @@ class Session:
         return [f"{self.working_dir}/{frame.dir}/"] if not self.multiple else self.getMultiNightDirectories(
             f"{self.working_dir}/{frame.dir}/")
 
+    def get_process_dir(self, frame: Frame) -> str:
+        return f"{self.working_dir}/{frame.dir}/{frame.process_dir}"
+
+    def get_night(self, frame: Frame, dir: str) -> str:
+        """
+        Night name of a multi-night directory, ie: "/lights/night_1" -> "1"
+        """
+        if not self.multiple:
+            return ""
+
+        return dir.replace(
+            f"{self.working_dir}/{frame.dir}/{os.environ['MULTINIGHT_DIR_NAME']}", '')
+
+    def get_directory(self, frame: Frame, night="") -> str:
+        for directory in self.list_directories(frame):
+            if self.get_night(frame, directory) == night:
+                return directory
+
+        raise Exception(f"No {frame.name} directory for night {night}")
+
+    def get_metadata(self, frame: Frame, night="") -> list[dict]:
+        """
+        EXIF of every raw of a night, see metadata.ExifService
+        """
+        return get_exif_service().read_directory(self.get_directory(frame, night))
+
+    def _camera_file(self) -> str:
+        return os.path.join(self.get_process_dir(self.lights), CAMERA_FILE_NAME)
+
+    def _load_cameras(self) -> dict[str, dict]:
+        try:
+            with open(self._camera_file(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_cameras(self, cameras: dict[str, dict]):
+        directory = os.path.dirname(self._camera_file())
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(prefix=f"{CAMERA_FILE_NAME}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cameras, f, indent=1, sort_keys=True, default=str)
+            os.replace(tmp, self._camera_file())
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def get_camera(self, night="") -> dict:
+        """
+        Model, ISO, exposure, temperature and timestamp of the lights
+
+        Read from the raws and saved in CAMERA_FILE_NAME, a night whose raws
+        were deleted after conversion (delete_raws) is read from there
+        """
+        with self._cameras_lock:
+            if night not in self._cameras:
+                # The whole night is read in the same exiftool batch, and cached
+                metadata = self.get_metadata(self.lights, night)
+                cameras = self._load_cameras()
+
+                if metadata:
+                    if cameras.get(night) != metadata[0]:
+                        cameras[night] = metadata[0]
+                        self._save_cameras(cameras)
+                elif night not in cameras:
+                    raise Exception(f"No raw lights for night {night}")
+                self._cameras[night] = cameras[night]
+            return self._cameras[night]
+
     def get_stacked_file(self, frame: Frame, night="") -> str:
         if frame is self.biases:
             return get_library_file(
-                type=self.biases, light=self.lights, night=night)
+                type=self.biases, light=self.lights, night=night,
+                camera=self.get_camera(night))
         else:
             base = f"{self.working_dir}/{frame.dir}/{frame.process_dir}"
 
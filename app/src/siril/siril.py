@@ -6,11 +6,17 @@ from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
 from astropy import units as u
-from astropy.coordinates import (ICRS, SkyCoord, get_icrs_coordinates)
+from astropy.coordinates import (ICRS, SkyCoord)
 
 from .frame import Frame
 from .session import Session
 from .preprocess import preprocess
+from .multinight import MultiNightExecutor
+from .stages import get_stack_params
+from . import stages
+from .instance import set_compression
+from .trace import trace_context
+from ..catalog import target_name, target_coordinates
 
 from ..logger import Logger as _Logger
 
@@ -30,6 +36,8 @@ class SirilWrapper:
         self.app = sirilApp  # Siril()  # type: ignore
         self.siril = sirilWrapper  # Wrapper(self.app)  # type: ignore
         self.session = session
+        # PostProcess builds its paths from it
+        self.working_dir = session.working_dir
 
         # self.session.working_dir = working_dir
         # self.session.lights = lights
@@ -37,6 +45,8 @@ class SirilWrapper:
         # self.biases = biases
         # self.session.flats = flats
         self.fits_extension = "fit"
+        self.preprocess_prefix = os.environ['PREPROCESS_PREFIX']
+        self.registered_prefix = os.environ['REGISTERED_PREFIX']
         self.remove_work = remove_work
         self.to_remove = []
 
@@ -46,13 +56,14 @@ class SirilWrapper:
         self.target_dec = None
         self.constellation = None
 
-        # self.get_target_data(target)
+        self.get_target_data(target)
 
     def start(self):
         self.logger.info("Starting Siril")
         self.app.Open()
         self.siril.set16bits()
         self.siril.setext(self.fits_extension)
+        set_compression(self.siril)
         self.siril.cd(self.session.working_dir)
         self.logger.info("Siril Started")
 
@@ -66,6 +77,19 @@ class SirilWrapper:
                 self.logger.info(f"Removing: {f}")
                 # os.remove(f)
 
+    def preprocess(self, frame: Frame, delete_raws: bool = False, parallel: bool = True):
+        """
+        Converts and calibrates a frame type. Multi-night sessions run every
+        night on its own Siril instance unless parallel is False
+        """
+        if self.session.multiple and parallel:
+            executor = MultiNightExecutor(self.session)
+            executor.run(frame, delete_raws=delete_raws)
+            executor.raise_for_errors()
+        else:
+            with trace_context(stage='preprocess', frame=frame.name):
+                preprocess(self.siril, self.session, frame, delete_raws=delete_raws)
+
     def register(self, frame: Frame):
 
         try:
@@ -83,26 +107,14 @@ class SirilWrapper:
                     f"Calibrating {frame.name} frames from: {night}")
 
                 self.logger.info(f"Registering {frame.name}")
-                self.cd_process_dir(frame)
-
-                register_name = f"{self.preprocess_prefix}{frame.name}" if not self.session.multiple else f"{self.preprocess_prefix}{frame.name}_{night}"
 
-                GREEN_CHANNEL = 1
+                with trace_context(stage='register', frame=frame.name, night=night):
+                    self.cd_process_dir(frame)
 
-                self.siril.register(
-                    register_name,
-                    nostarlist=True,
-                    layer=GREEN_CHANNEL,
-                    pass2=True
-                )
+                    register_name = f"{self.preprocess_prefix}{frame.name}" if not self.session.multiple else f"{self.preprocess_prefix}{frame.name}_{night}"
 
-                self.siril.register(
-                    register_name,
-                    nostarlist=True,
-                    prefix=self.registered_prefix,
-                    layer=GREEN_CHANNEL,
-                    drizzle=True,
-                )
+                    # Siril 2-pass + drizzle, or the native backend (REGISTER_BACKEND)
+                    stages.register(self.siril, self.session, frame, register_name)
 
                 # Work to be removed upon completion
                 # preprocessed_work_file = f"{self.session.working_dir}/{frame.dir}/{self.preprocess_prefix}{frame.process_dir}/{frame.name}"
@@ -135,34 +147,11 @@ class SirilWrapper:
         else:
             stack_sequence = f"{frame.name}{name_postfix}"
 
-        stack_params = {
-            "out": f"{frame.stacked_name}{name_postfix}",
-            "type": "rej",
-            'sigma_low': "3",
-            'sigma_high': "3"
-        }
+        stack_params = get_stack_params(
+            self.session, frame, f"{frame.stacked_name}{name_postfix}")
 
         self.logger.info(f'Stack Sequence: {stack_sequence}')
 
-        if (frame == self.session.biases):
-            stack_params['norm'] = 'no'
-            stack_params['rejection_type'] = "w"
-
-        if (frame == self.session.darks):
-            stack_params['norm'] = 'no'
-            stack_params['rejection_type'] = "w"
-
-        if (frame == self.session.flats):
-            stack_params['norm'] = "mul"
-            stack_params['rejection_type'] = "w"
-
-        if (frame == self.session.lights):
-            stack_params['norm'] = "addscale"
-            stack_params['rejection_type'] = "l"
-            stack_params['rgb_equal'] = True
-            stack_params['filter_fwhm'] = "90%"
-            stack_params['filter_round'] = "90%"
-
         """
         sequencename,
         type=None,
@@ -221,7 +210,12 @@ class SirilWrapper:
         # Complete
         self.logger.info(f"Stacked {frame.name}")
 
-    def stack(self, frame: Frame, rmgreen=False):
+    def stack(self, frame: Frame, rmgreen=False, incremental=False):
+        """
+        incremental: fold every night's registered lights into the target's
+        LightAccumulator (only nights that changed are stacked) instead of
+        restacking the merged sequence
+        """
         try:
             if self.session.multiple:
                 self.session.validate_supported(frame)
@@ -232,72 +226,37 @@ class SirilWrapper:
             if frame != self.session.lights:
                 # Non-light stacking to get a stacked file for each night
                 for d in nights:
-                    self._stack(dir=d, frame=frame, rmgreen=rmgreen)
+                    with trace_context(stage='stack', frame=frame.name, night=self.session.get_night(frame, d)):
+                        self._stack(dir=d, frame=frame, rmgreen=rmgreen)
+            elif incremental:
+                self.accumulate(frame)
             else:
-                self.cd_process_dir(frame)
-
-                sequences = []
-                for f in glob(f"{self.registered_prefix}{self.preprocess_prefix}{frame.name}*.seq"):
-                    self.logger.info(f"Found: {f}")
-                    sequences.append(f)
-
-                self.logger.info(f"Sequences: {sequences}")
-                # self.siril.merge('r_pp_light_1_.seq',
-                #                  'r_pp_light_2_.seq', 'merged.seq')
-
-                # self.siril.register(
-                #     'merged',
-                #     nostarlist=True,
-                #     prefix=self.registered_prefix,
-                #     layer=1,
-                #     drizzle=True,
-                # )
+                with trace_context(stage='stack', frame=frame.name):
+                    self.cd_process_dir(frame)
+
+                    # Light stacking to get a single stacked file for all nights
+                    sequence = stages.registered_sequence(
+                        f"{self.preprocess_prefix}{frame.name}_merged" if self.session.multiple else f"{self.preprocess_prefix}{frame.name}")
+                    out = f"{frame.stacked_name}_merged" if self.session.multiple else frame.stacked_name
 
-                # Light stacking to get a single stacked file for all nights
-                """
-                sequencename,
-                type=None,
-                rejection_type=None,
-                sigma_low=3,
-                sigma_high=3,
-                norm=None,
-                output_norm=False,
-                rgb_equal=False,
-                out=None,
-                filter_fwhm=None,
-                filter_wfwhm=None,
-                filter_round=None,
-                filter_bkg=None,
-                filter_nbstars=None,
-                filter_quality=None,
-                filter_included=False,
-                filter_incl=False,
-                weight_from_noise=False,
-                weight_from_nbstack=False,
-                weight_from_nbstars=False,
-                weight_from_wfwhm=False,
-                fastnorm=False,
-                rejmap=False,
-                rejmaps=False
-                """
-
-                self.siril.stack('r_merged', **{
-                    "out": f"{frame.stacked_name}_merged",
-                    "type": "rej",
-                    'sigma_low': "3",
-                    'sigma_high': "3",
-                    "norm": "addscale",
-                    "rejection_type": "l",
-                    "rgb_equal": True,
-                    "filter_fwhm": "90%",
-                    "filter_round": "90%"
-                })
-                # f"{self.session.working_dir}/{type.dir}/{type.process_dir}"
+                    # r_ frames, or the calibrated ones resampled (REGISTER_NOOUT)
+                    stages.stack(self.siril, self.session, frame, sequence, out)
 
         except Exception as e:
             self.logger.error(f"Failed to Stack {frame.name}", e)
             return
 
+    def accumulate(self, frame: Frame) -> str:
+        """
+        Adds new (or changed) nights of registered lights to the target's
+        accumulator and renders the stack, returns the stacked file
+        """
+        for d in self.session.list_directories(frame):
+            stages.accumulate(self.session, frame, self.session.get_night(frame, d))
+
+        out = f"{frame.stacked_name}_merged" if self.session.multiple else frame.stacked_name
+        return stages.render_accumulation(self.session, frame, out)
+
     def cd_process_dir(self, frame: Frame):
         self.logger.info(
             f"Changing directory to {self.session.working_dir}/{frame.dir}/{frame.process_dir}")
@@ -317,16 +276,9 @@ class SirilWrapper:
         # TODO: Consider looking at details.json
         # TODO: Make this more resiliant
 
-        target_name = target if target is not None else os.path.basename(
-            os.path.normpath(self.session.working_dir)).replace('_', " ")
-        self.target = target_name
+        self.target = target if target is not None else target_name(self.session.working_dir)
 
-        try:
-            coords = get_icrs_coordinates(
-                name=self.target, parse=False, cache=False)
-        except Exception as e:
-            print(e)
-            coords = None
+        coords = target_coordinates(self.target)
 
         c = SkyCoord(
             ra=coords.ra.to(u.deg),
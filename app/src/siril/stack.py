@@ -8,8 +8,13 @@ import os
 from exiftool import ExifToolHelper
 import subprocess
 from ..astrometry.wcs import get_center_coords
+from .master_library import MasterLibrary
 from astropy import units as u
-from astropy.coordinates import (ICRS, SkyCoord, get_icrs_coordinates)
+from astropy.coordinates import (ICRS, SkyCoord)
+from ..catalog import target_name, target_coordinates
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
 
 class FilesConfig:
     def __init__(
@@ -99,15 +104,10 @@ class Stack(StackConfig):
         self.master_bias_file = master_bias_file
         self.master_light_file = master_light_file
 
-        target_name = os.path.basename(
-            os.path.normpath(self.working_dir)).replace('_', " ")
+        # Opened on the first lookup, closed by done()
+        self.library = None
 
-        try:
-            coords = get_icrs_coordinates(
-                name=target_name, parse=False, cache=False)
-        except Exception as e:
-            print(e)
-            coords = None
+        coords = target_coordinates(target_name(self.working_dir))
 
         c = SkyCoord(
             ra=coords.ra.to(u.deg),
@@ -132,11 +132,7 @@ class Stack(StackConfig):
         self.siril.cd(self.working_dir)
 
     def get_library_file(self, file_type: str) -> str:
-        if file_type == 'bias':
-            master_stacked_name = self.bias_stacked_name
-        elif file_type == 'dark':
-            master_stacked_name = self.dark_stacked_name
-        else:
+        if file_type not in ['bias', 'dark']:
             return ''
 
         first_light_image_file = f"{self.lights_dir}/{os.listdir(self.lights_dir)[0]}"
@@ -146,25 +142,16 @@ class Stack(StackConfig):
                 "EXIF:ISO", "Make", "Model", "ExposureTime"])[0]
             iso = tags.get('EXIF:ISO')
             model = tags.get('EXIF:Model')
-            exposure = math.ceil(
-                float(tags.get('EXIF:ExposureTime')))
-            if file_type == 'dark':
-                exposureSec = f"{exposure}s" if file_type == 'dark' else None
-                master_file_name = f"{self.master_library_path}/{model} {iso} {exposureSec} {master_stacked_name}.{self.fits_extension}".replace(
-                    " ", "_")
-            else:
-                master_file_name = f"{self.master_library_path}/{model} {iso} {master_stacked_name}.{self.fits_extension}".replace(
-                    " ", "_")
-
-            print("")
-            print("get_library_file()")
-            print(f"master_file_name: {master_file_name}")
-            print("")
-            print("")
-            if os.path.isfile(master_file_name):
-                return master_file_name
-            else:
-                return ""
+            exposure = float(tags.get('EXIF:ExposureTime'))
+
+        # Same index as Session, it reads this naming too
+        if self.library is None:
+            self.library = MasterLibrary(roots=[self.master_library_path])
+        master_file_name = self.library.nearest(
+            'biases' if file_type == 'bias' else 'darks', model, iso, exposure=exposure)
+
+        Logger.info(f"master_file_name: {master_file_name}")
+        return master_file_name if master_file_name else ""
 
     def biases(self, save_to_master_library: bool = False, overwrite: bool = False):
         biases_exist = os.path.exists(self.biases_dir) and len(
@@ -479,5 +466,8 @@ class Stack(StackConfig):
                          f"{self.light_stacked_name}-green", f"{self.light_stacked_name}-blue")
 
     def done(self):
+        if self.library is not None:
+            self.library.close()
+            self.library = None
         self.app.Close()
         del self.app
@@ -0,0 +1,264 @@
+import os
+from typing import Optional
+
+from pysiril.wrapper import *  # type: ignore
+
+from .frame import Frame
+from .session import Session
+from ..sequence import SequenceReader, merge_sequences, included_frames
+from ..stacking import StackEngine, LightAccumulator, ACCUMULATOR_DIR_NAME
+from ..registration import StarRegistration
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Register / merge / stack steps that only touch the Wrapper they are given
+
+Unlike SirilWrapper.register() and SirilWrapper.stack() these never call
+os.chdir, so they are safe to run from several threads, each one on its
+own Siril instance.
+
+With REGISTER_NOOUT=1 registration only stores its transforms in the .seq
+of the calibrated sequence (no r_ frames are written), and lights are
+stacked natively from the calibrated frames, resampled tile by tile.
+"""
+
+GREEN_CHANNEL = 1
+
+# Frame type of each Session attribute, ie: DARKS_STACK_BACKEND=native
+FRAME_TYPES = ['biases', 'darks', 'flats', 'lights']
+
+
+def get_stack_params(session: Session, frame: Frame, out: str) -> dict:
+    stack_params = {
+        "out": out,
+        "type": "rej",
+        'sigma_low': "3",
+        'sigma_high': "3"
+    }
+
+    if (frame == session.biases):
+        stack_params['norm'] = 'no'
+        stack_params['rejection_type'] = "w"
+
+    if (frame == session.darks):
+        stack_params['norm'] = 'no'
+        stack_params['rejection_type'] = "w"
+
+    if (frame == session.flats):
+        stack_params['norm'] = "mul"
+        stack_params['rejection_type'] = "w"
+
+    if (frame == session.lights):
+        stack_params['norm'] = "addscale"
+        stack_params['rejection_type'] = "l"
+        stack_params['rgb_equal'] = True
+        stack_params['filter_fwhm'] = "90%"
+        stack_params['filter_round'] = "90%"
+
+    return stack_params
+
+
+def get_backend(session: Session, frame: Frame, stage: str) -> str:
+    """
+    "siril" or "native" for a stage, from {FRAME}_{STAGE}_BACKEND falling
+    back to {STAGE}_BACKEND
+    """
+    backend = os.getenv(f"{stage.upper()}_BACKEND", 'siril')
+    for frame_type in FRAME_TYPES:
+        if getattr(session, frame_type) == frame:
+            backend = os.getenv(
+                f"{frame_type.upper()}_{stage.upper()}_BACKEND", backend)
+
+    if backend not in ['siril', 'native']:
+        raise Exception(f"Unknown {stage} backend: {backend}")
+
+    return backend
+
+
+def get_stack_backend(session: Session, frame: Frame) -> str:
+    """
+    "siril" or "native" (StackEngine)
+    """
+    return get_backend(session, frame, 'stack')
+
+
+def get_register_backend(session: Session, frame: Frame) -> str:
+    """
+    "siril" or "native" (StarRegistration)
+    """
+    return get_backend(session, frame, 'register')
+
+
+def get_merge_backend(session: Session, frame: Frame) -> str:
+    """
+    "siril" or "native" (sequence.merge_sequences)
+    """
+    return get_backend(session, frame, 'merge')
+
+
+def lazy_registration() -> bool:
+    """
+    Registration only stores its transforms when REGISTER_NOOUT=1
+    """
+    return os.getenv('REGISTER_NOOUT', '0') != '0'
+
+
+def registered_sequence(sequence: str) -> str:
+    """
+    Sequence to stack once `sequence` is registered
+    """
+    return sequence if lazy_registration() else f"{os.environ['REGISTERED_PREFIX']}{sequence}"
+
+
+def merge(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        sequences: list[str],
+        out: str
+) -> bool:
+    Logger.info(f"Merging {frame.name} sequences: {sequences} -> {out}")
+
+    if get_merge_backend(session, frame) == 'native':
+        merge_sequences(session.get_process_dir(frame), sequences, out, os.environ['FITS_EXTENSION'])
+        Logger.info(f"Merged {frame.name} sequences: {out}")
+        return True
+
+    Siril.cd(session.get_process_dir(frame))
+
+    [merge_result] = Siril.merge(*sequences, out)
+
+    if merge_result is not True:
+        raise Exception(f"Failed to merge {frame.name} sequences")
+
+    return merge_result
+
+
+def register(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        sequence: str,
+        maxstars: Optional[int] = None
+) -> bool:
+    Logger.info(f"Registering {frame.name}: {sequence}")
+
+    if get_register_backend(session, frame) == 'native':
+        StarRegistration(session.get_process_dir(frame), sequence, os.environ['FITS_EXTENSION'],
+                         maxstars=maxstars,
+                         transformation=os.getenv('REGISTER_TRANSFORMATION', 'homography'),
+                         layer=GREEN_CHANNEL,
+                         prefix=os.environ['REGISTERED_PREFIX'],
+                         output=not lazy_registration()).run()
+        Logger.info(f"Registered {frame.name}: {sequence}")
+        return True
+
+    Siril.cd(session.get_process_dir(frame))
+
+    registration_params = {
+        "nostarlist": True,
+        "layer": GREEN_CHANNEL,
+        "maxstars": maxstars
+    }
+
+    [pass2_result] = Siril.register(
+        sequence, **registration_params, pass2=True)
+
+    if pass2_result is not True:
+        raise Exception(f"Failed to register {sequence} Frames (2-pass)")
+
+    if lazy_registration():
+        # -2pass only writes the transforms to the .seq
+        Logger.info(f"Registered {frame.name}: {sequence} (transforms only)")
+        return True
+
+    [registration_result] = Siril.register(
+        sequence, **registration_params, prefix=os.environ['REGISTERED_PREFIX'], drizzle=True)
+
+    if registration_result is not True:
+        raise Exception(f"Failed to register {sequence} Frames with drizzle")
+
+    Logger.info(f"Registered {frame.name}: {sequence}")
+    return True
+
+
+def stack(
+        Siril: Wrapper,  # type: ignore
+        session: Session,
+        frame: Frame,
+        sequence: str,
+        out: str
+) -> bool:
+    Logger.info(f"Stacking {frame.name}: {sequence} -> {out}")
+
+    stack_params = get_stack_params(session, frame, out)
+    Logger.info(f"Stack Parameters: {sequence}, {stack_params}")
+
+    # Siril can't stack frames that were only registered, without r_ frames
+    resample = frame == session.lights and lazy_registration()
+    if resample and get_stack_backend(session, frame) != 'native':
+        Logger.warning(f"{sequence} has no registered frames, stacking it natively")
+
+    if resample or get_stack_backend(session, frame) == 'native':
+        process_dir = session.get_process_dir(frame)
+        reader = SequenceReader(
+            process_dir, sequence, os.environ['FITS_EXTENSION'])
+        StackEngine(reader.frames(), stack_params,
+                    registration=reader.registration() if resample else None).run(process_dir)
+        Logger.info(f"Stacked {frame.name}: {out}")
+        return True
+
+    Siril.cd(session.get_process_dir(frame))
+
+    [stack_result] = Siril.stack(sequence, **stack_params)
+
+    if stack_result is not True:
+        raise Exception(f"Failed to stack {sequence} sequence")
+
+    Logger.info(f"Stacked {frame.name}: {out}")
+    return stack_result
+
+
+def get_accumulator(session: Session, frame: Frame) -> LightAccumulator:
+    """
+    The LightAccumulator of the target, in the process directory of `frame`
+    """
+    return LightAccumulator(f"{session.get_process_dir(frame)}/{ACCUMULATOR_DIR_NAME}")
+
+
+def accumulate(session: Session, frame: Frame, night: str = "") -> bool:
+    """
+    Folds the registered frames of a night (r_pp_lights_{night}) into the
+    target's accumulator. False when there are none, or when they are
+    already in it unchanged: only the frames of new nights are stacked
+    """
+    if lazy_registration():
+        raise Exception("Incremental stacking needs r_ frames, unset REGISTER_NOOUT")
+
+    name = f"{frame.name}_{night}" if night else frame.name
+    sequence = registered_sequence(f"{os.environ['PREPROCESS_PREFIX']}{name}")
+    frames = included_frames(session.get_process_dir(frame), sequence, os.environ['FITS_EXTENSION'])
+
+    if not frames:
+        Logger.info(f"No registered frames found for {sequence}")
+        return False
+
+    key = night if night else frame.name
+    accumulator = get_accumulator(session, frame)
+    if accumulator.is_current(key, frames):
+        Logger.info(f"Night {key} already accumulated")
+        return False
+
+    accumulator.add_night(key, frames, replace=True)
+    return True
+
+
+def render_accumulation(session: Session, frame: Frame, out: str) -> str:
+    """
+    Writes the accumulated stack of the target to {out}.fit, returns it
+    """
+    return get_accumulator(session, frame).render(
+        f"{session.get_process_dir(frame)}/{out}.{os.environ['FITS_EXTENSION']}")
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Timing trace of every Siril command
+
+traced() wraps a pysiril Wrapper so each command it sends is recorded with
+its start and end time, its arguments, its result, the function that called
+it and the trace context of the caller (stage, node, frame, night):
+
+    with trace_context(stage="calibrate", frame="lights", night="1"):
+        siril.calibrate("lights_1", ...)
+
+Contexts nest, inner fields win. A thread starts with an empty context,
+so code running commands on a worker thread sets its own.
+
+The process wide Tracer writes what it recorded as a Chrome trace (open it
+in chrome://tracing or ui.perfetto.dev, every Siril instance is a track)
+and logs a per-stage summary. SIRIL_TRACE=0 turns recording off.
+
+Usage:
+    siril = traced(Wrapper(App), name="main")
+    ...
+    get_tracer().summary()
+    get_tracer().write("siril_trace.json")
+"""
+
+# Longest argument text kept in an event
+MAX_ARGUMENT_LENGTH = 200
+
+_context: ContextVar[dict] = ContextVar('siril_trace_context', default={})
+
+
+@contextmanager
+def trace_context(**fields):
+    """
+    Adds fields (stage, node, frame, night...) to the commands traced inside
+    """
+    token = _context.set({**_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def tracing_enabled() -> bool:
+    return os.getenv('SIRIL_TRACE', '1') != '0'
+
+
+def _argument(value) -> str:
+    text = repr(value)
+    return text if len(text) <= MAX_ARGUMENT_LENGTH else f"{text[:MAX_ARGUMENT_LENGTH]}..."
+
+
+def _caller() -> str:
+    """
+    module.function of the first frame outside of this module
+    """
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return ""
+    return f"{frame.f_globals.get('__name__', '')}.{frame.f_code.co_name}"
+
+
+def _succeeded(result) -> Optional[bool]:
+    # pysiril returns [True] / [False] (with the data of some commands)
+    if isinstance(result, (list, tuple)) and result and isinstance(result[0], bool):
+        return result[0]
+    if isinstance(result, bool):
+        return result
+    return None
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.logger = Logger
+        self.started = time.perf_counter()
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.events: list[dict] = []
+        # Track id and name of every traced Wrapper
+        self.tracks: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def track(self, name: str) -> int:
+        with self._lock:
+            track = len(self.tracks) + 1
+            self.tracks[track] = name
+            return track
+
+    def record(self, track: int, command: str, started: float, ended: float, args: dict):
+        with self._lock:
+            self.events.append({
+                "name": command,
+                "cat": args.get("stage", ""),
+                "ph": "X",
+                "ts": round((started - self.started) * 1e6, 1),
+                "dur": round((ended - started) * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": track,
+                "args": args,
+            })
+
+    def chrome_trace(self) -> dict:
+        with self._lock:
+            events = list(self.events)
+            tracks = dict(self.tracks)
+
+        metadata = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "tid": 0,
+                     "args": {"name": "siril-auto-stacker"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": track,
+                      "args": {"name": f"siril {name}"}} for track, name in tracks.items()]
+
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"started": self.started_at},
+        }
+
+    def write(self, path: str) -> str:
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        os.replace(tmp, path)
+
+        self.logger.info(f"Siril trace: {path} ({len(self.events)} commands)")
+        return path
+
+    def stages(self) -> dict[str, dict[str, list[float]]]:
+        """
+        stage -> command -> durations in seconds
+        """
+        stages: dict[str, dict[str, list[float]]] = {}
+        with self._lock:
+            for event in self.events:
+                stage = event["args"].get("stage") or "-"
+                stages.setdefault(stage, {}).setdefault(event["name"], []).append(event["dur"] / 1e6)
+        return stages
+
+    def summary(self) -> list[tuple[str, int, float, str]]:
+        """
+        Logs, and returns, (stage, commands, seconds, slowest command) from
+        the most time spent in Siril to the least
+        """
+        rows = []
+        for stage, commands in self.stages().items():
+            slowest = max(commands, key=lambda c: sum(commands[c]))
+            rows.append((stage, sum(len(d) for d in commands.values()),
+                         sum(sum(d) for d in commands.values()),
+                         f"{slowest} {sum(commands[slowest]):.1f}s x{len(commands[slowest])}"))
+        rows.sort(key=lambda r: -r[2])
+
+        total = sum(r[2] for r in rows)
+        self.logger.info(f"{'STAGE':<12} {'COMMANDS':>8} {'SECONDS':>9} {'SHARE':>6}  SLOWEST")
+        for stage, count, seconds, slowest in rows:
+            share = seconds / total if total else 0
+            self.logger.info(f"{stage:<12} {count:>8} {seconds:>9.1f} {share:>6.0%}  {slowest}")
+        self.logger.info(f"{'TOTAL':<12} {sum(r[1] for r in rows):>8} {total:>9.1f}")
+
+        return rows
+
+
+class TracedWrapper:
+    def __init__(self, wrapper, tracer: 'Tracer', name: str) -> None:
+        """
+        Records every command of `wrapper` (a pysiril Wrapper) in `tracer`
+        """
+        object.__setattr__(self, '_wrapper', wrapper)
+        object.__setattr__(self, '_tracer', tracer)
+        object.__setattr__(self, '_track', tracer.track(name))
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._wrapper, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def command(*args, **kwargs):
+            fields = {
+                **_context.get(),
+                "caller": _caller(),
+                "arguments": [_argument(a) for a in args] + [f"{k}={_argument(v)}" for k, v in kwargs.items()],
+            }
+            started = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+                fields["succeeded"] = _succeeded(result)
+                return result
+            except Exception as e:
+                fields["error"] = str(e)
+                raise
+            finally:
+                self._tracer.record(self._track, name, started, time.perf_counter(), fields)
+
+        return command
+
+    def __setattr__(self, name: str, value):
+        setattr(self._wrapper, name, value)
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """
+    The process wide tracer
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+    return _tracer
+
+
+def traced(wrapper, name: Optional[str] = None):
+    """
+    `wrapper` with its commands recorded by the process wide Tracer, as is
+    with SIRIL_TRACE=0
+    """
+    if not tracing_enabled():
+        return wrapper
+    return TracedWrapper(wrapper, get_tracer(), name if name else "main")
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import shutil
+from typing import Callable, Optional
+
+from pysiril.wrapper import *  # type: ignore
+
+from .frame import Frame
+from .session import Session
+from .preprocess import get_calibrate_params
+from ..sequence import frame_file, list_frames, write_seq
+from ..metadata import RAW_EXTENSIONS
+
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Converts and calibrates frames while the camera is still shooting
+
+The watcher polls a lights directory. A new raw is only picked up once its
+size and mtime have stopped changing for `settle` seconds, so frames that
+are still being written (gphoto2, a network share, ...) are left alone.
+Every settled raw is handed to a processor with the next sequence index.
+
+SirilIngest (the default processor) converts the single raw to
+{sequence}_{index}.fit in the process directory, calibrates it against the
+masters that exist right now and rewrites the .seq files of both the
+converted and the calibrated sequence, so by dawn pp_lights is complete and
+only registration and stacking are left.
+
+Usage:
+    watcher = FrameWatcher(session, session.lights, processor=SirilIngest(siril, session, session.lights))
+    watcher.run()           # until stop() / Ctrl+C
+    watcher.poll()          # or a single pass, ie: from a test
+"""
+
+INGEST_STATE_FILE_NAME = '.ingested.json'
+
+
+class FrameWatcher:
+    def __init__(self,
+                 session: Session,
+                 frame: Frame,
+                 processor: Callable[[str, int], None],
+                 directory: Optional[str] = None,
+                 settle: float = 5,
+                 interval: float = 2
+                 ) -> None:
+        """
+        processor: called with (raw file, sequence index) for every settled raw
+        directory: directory to watch, defaults to the frame's only directory
+        settle: seconds a file has to stay unchanged before it is processed
+        interval: seconds between two polls
+        """
+        self.logger = Logger
+        self.session = session
+        self.frame = frame
+        self.processor = processor
+        self.directory = directory if directory else session.list_directories(frame)[0]
+        self.settle = settle
+        self.interval = interval
+
+        # path -> (size, mtime_ns, stable since)
+        self._pending: dict[str, tuple[int, int, float]] = {}
+        self._stopped = False
+
+        self.state_file = os.path.join(
+            self.directory, INGEST_STATE_FILE_NAME)
+        # raw file name -> sequence index, survives restarts of the watcher
+        self.ingested: dict[str, int] = {}
+        self.failed: dict[str, str] = {}
+        self._load_state()
+
+    def _load_state(self):
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.ingested = json.load(f)
+
+    def _save_state(self):
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.ingested, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def next_index(self) -> int:
+        return max(self.ingested.values(), default=0) + 1
+
+    def _candidates(self) -> list[str]:
+        return sorted([
+            os.path.join(self.directory, f) for f in os.listdir(self.directory)
+            if not f.startswith('.')
+            and f.split('.')[-1].lower() in RAW_EXTENSIONS
+            and f not in self.ingested
+            and f not in self.failed
+        ])
+
+    def settled(self) -> list[str]:
+        """
+        Raws whose size and mtime haven't changed for `settle` seconds
+        """
+        now = time.monotonic()
+        ready = []
+
+        for file in self._candidates():
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                self._pending.pop(file, None)
+                continue
+
+            previous = self._pending.get(file)
+            if previous is None or previous[:2] != (stat.st_size, stat.st_mtime_ns):
+                self._pending[file] = (stat.st_size, stat.st_mtime_ns, now)
+                continue
+
+            if stat.st_size > 0 and now - previous[2] >= self.settle:
+                ready.append(file)
+
+        return ready
+
+    def poll(self) -> list[str]:
+        """
+        One pass over the directory, returns the raws that were processed
+        """
+        processed = []
+
+        for file in self.settled():
+            name = os.path.basename(file)
+            index = self.next_index()
+            self._pending.pop(file, None)
+
+            try:
+                self.processor(file, index)
+            except Exception as e:
+                self.logger.error(f"Failed to ingest {name}: {e}")
+                self.failed[name] = str(e)
+                continue
+
+            self.ingested[name] = index
+            self._save_state()
+            processed.append(file)
+            self.logger.info(f"Ingested {name} as frame {index}")
+
+        return processed
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self, until: Optional[float] = None):
+        """
+        until: time.time() at which to stop, ie: dawn
+        """
+        self.logger.info(f"Watching {self.directory}")
+        self._stopped = False
+
+        try:
+            while not self._stopped and (until is None or time.time() < until):
+                self.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+        self.logger.info(
+            f"Stopped watching {self.directory}: {len(self.ingested)} frames ingested, {len(self.failed)} failed")
+
+
+class SirilIngest:
+    def __init__(self,
+                 Siril: Wrapper,  # type: ignore
+                 session: Session,
+                 frame: Frame,
+                 directory: Optional[str] = None
+                 ) -> None:
+        self.logger = Logger
+        self.siril = Siril
+        self.session = session
+        self.frame = frame
+        directory = directory if directory else session.list_directories(frame)[0]
+        self.night = session.get_night(frame, directory)
+        self.process_dir = session.get_process_dir(frame)
+        self.sequence = frame.name if not session.multiple else f"{frame.name}_{self.night}"
+        self.calibrated = f"{os.environ['PREPROCESS_PREFIX']}{self.sequence}"
+        self.fits_extension = os.environ['FITS_EXTENSION']
+        self.staging_dir = os.path.join(self.process_dir, '.ingest')
+
+    def convert(self, raw: str, index: int) -> str:
+        """
+        Converts a single raw to {sequence}_{index}.fit
+
+        Siril converts every raw of the current directory, so the raw is
+        linked alone into a staging directory first
+        """
+        os.makedirs(self.staging_dir, exist_ok=True)
+        staged = os.path.join(self.staging_dir, os.path.basename(raw))
+
+        try:
+            os.symlink(os.path.abspath(raw), staged)
+            self.siril.cd(self.staging_dir)
+
+            [conversion_result] = self.siril.convert(
+                self.sequence, out=self.process_dir, start=index)
+
+            if conversion_result is not True:
+                raise Exception(f"Failed to convert {raw}")
+        finally:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+        return frame_file(self.process_dir, self.sequence, index, self.fits_extension)
+
+    def calibrate(self, converted: str) -> bool:
+        calibrate_params = get_calibrate_params(
+            self.session, self.frame, self.night)
+        # calibrate_single works on one image, there is no sequence to select from
+        calibrate_params.pop('all', None)
+
+        self.siril.cd(self.process_dir)
+        [calibrate_result] = self.siril.calibrate_single(
+            os.path.basename(converted), **calibrate_params)
+
+        if calibrate_result is not True:
+            raise Exception(f"Failed to calibrate {converted}")
+
+        return calibrate_result
+
+    def __call__(self, raw: str, index: int):
+        converted = self.convert(raw, index)
+        self.calibrate(converted)
+
+        # convert wrote a .seq with this frame alone, list every frame again
+        for sequence in [self.sequence, self.calibrated]:
+            write_seq(self.process_dir, sequence, list_frames(
+                self.process_dir, sequence, self.fits_extension))
@@ -7,6 +7,9 @@ import argparse
 from pysiril.siril import *  # type: ignore
 from pysiril.wrapper import *  # type: ignore
 
+from .sequence import SequenceReader
+from .stacking import StackEngine
+from .pool import get_siril
 from .logger import Logger as _Logger
 
 """
@@ -14,6 +17,11 @@ Stacks a directory of images to a single FITS image
 
 Usage:
     poetry run python -m src.stack darks.seq -f darks
+    poetry run python -m src.stack darks.seq -f darks --backend=native
+    poetry run python -m src.stack pp_lights.seq -f lights --resample
+
+    from src.stack import stack
+    stack(siril, "darks.seq", "darks")
 
 """
 
@@ -37,13 +45,22 @@ parser.add_argument('-f', '--frame',
                     choices=['lights', 'flats', 'darks', 'biases'],
                     help="Frame type to calibrate: lights, flats, farks or biases")
 
-args = parser.parse_args()
+parser.add_argument('-b', '--backend',
+                    required=False,
+                    type=str,
+                    default=os.getenv('STACK_BACKEND', 'siril'),
+                    dest="backend",
+                    choices=['siril', 'native'],
+                    help="Stack with Siril or with the native StackEngine")
 
-App = Siril()  # type: ignore
-siril = Wrapper(App)  # type: ignore
+parser.add_argument('-r', '--resample',
+                    required=False,
+                    action='store_true',
+                    dest="resample",
+                    help="Resample the frames with the transforms of their .seq (registered with --noout), stacks natively")
 
 
-def stack(seq=args.seq, frame=args.frame) -> bool:
+def stack(siril, seq: str, frame: str = 'lights', backend: str = 'siril', resample: bool = False) -> bool:
     siril.setcpu(cpu_cores)
     siril.set16bits()
     siril.setext(fits_extension)
@@ -78,6 +95,15 @@ def stack(seq=args.seq, frame=args.frame) -> bool:
 
     Logger.json("Stacking Parameters", stack_params)
 
+    if backend == 'native' or resample:
+        # Works for both one file per frame and FITS sequences (fitseq)
+        reader = SequenceReader(
+            str(Path(seq).parent), name, fits_extension)
+        StackEngine(reader.frames(), stack_params,
+                    registration=reader.registration() if resample else None).run(str(Path(seq).parent))
+        Logger.info(f"Stacked {frame} sequence")
+        return True
+
     [stack_result] = siril.stack(seq, **stack_params)
 
     siril.load(f"{stacked_prefix}{name}")
@@ -90,9 +116,13 @@ def stack(seq=args.seq, frame=args.frame) -> bool:
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    App = get_siril()
+
     try:
         App.Open()
-        stack()
+        stack(Wrapper(App), args.seq, frame=args.frame,  # type: ignore
+              backend=args.backend, resample=args.resample)
     except Exception as e:
         Logger.error(f"Error: {e}")
         exit(1)
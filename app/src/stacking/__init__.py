@@ -0,0 +1,2 @@
+from .engine import StackEngine
+from .accumulator import LightAccumulator, ACCUMULATOR_DIR_NAME
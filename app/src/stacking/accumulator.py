@@ -0,0 +1,326 @@
+import os
+import json
+import hashlib
+from typing import Callable, Optional
+
+import numpy as np
+import cv2 as cv
+from astropy.io import fits
+
+from .engine import open_frames, location_scale, sigma_reject
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Persistent per-target light stack that grows one night at a time
+
+Every night's registered frames are normalized (addscale, against the first
+frame the target ever saw), sigma clipped and reduced to three images:
+count, mean and M2 (sum of squared deviations) of the accepted samples.
+Those partials are mergeable (Chan et al.), so adding a night costs the
+frames of that night plus one merge, never a restack of earlier nights.
+
+Nights are registered on their own reference frame, the night's mean is
+aligned on the accumulated stack before merging (see ecc_align).
+
+accumulator/
+    state.json          reference normalization, shape, nights
+    night_<name>.npz    partial of each night, in that night's frame
+    total.npz           every night merged, in the reference frame
+
+Usage:
+    acc = LightAccumulator(f"{process_dir}/accumulator")
+    acc.add_night("3", frames)
+    acc.render(f"{process_dir}/stacked_lights_merged.fit")
+"""
+
+ACCUMULATOR_DIR_NAME = os.getenv('ACCUMULATOR_DIR_NAME', 'accumulator')
+
+# Memory a band of rows of every frame of a night may take while clipping
+BAND_MEMORY = int(os.getenv('STACK_BAND_MEMORY_MB', 256)) * 1024 * 1024
+
+GREEN_CHANNEL = 1
+
+
+def frames_fingerprint(frames: list[str]) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for f in sorted(frames):
+        stat = os.stat(f)
+        h.update(f"{os.path.basename(f)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def merge_partials(a: tuple, b: tuple) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merges two (count, mean, m2) partials pixel by pixel
+    """
+    na, mean_a, m2_a = a
+    nb, mean_b, m2_b = b
+    na = na.astype(np.float64)
+    nb = nb.astype(np.float64)
+
+    n = na + nb
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(n > 0, mean_a + delta * nb / n, 0)
+        m2 = np.where(n > 0, m2_a + m2_b + delta ** 2 * na * nb / n, 0)
+
+    return n.astype(np.uint32), mean.astype(np.float32), m2.astype(np.float32)
+
+
+def _normalized(image: np.ndarray) -> np.ndarray:
+    loc, scale = location_scale(image[np.newaxis])
+    return np.clip((image - loc[0]) / (scale[0] * 20), -1, 1).astype(np.float32)
+
+
+def ecc_align(reference: np.ndarray, image: np.ndarray, downscale: int = 4) -> np.ndarray:
+    """
+    3x3 transform mapping reference coordinates to image coordinates,
+    estimated with OpenCV's ECC on downscaled green channels. Nights taken
+    on either side of a meridian flip are tried both ways
+    """
+    small_ref = _normalized(reference[::downscale, ::downscale])
+    small_img = _normalized(image[::downscale, ::downscale])
+    h, w = small_ref.shape
+
+    flipped = np.array([[-1, 0, w - 1], [0, -1, h - 1]], dtype=np.float32)
+    criteria = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 200, 1e-6)
+
+    best = (-1.0, np.eye(2, 3, dtype=np.float32))
+    for start in [np.eye(2, 3, dtype=np.float32), flipped]:
+        try:
+            cc, warp = cv.findTransformECC(
+                small_ref, small_img, start.copy(), cv.MOTION_EUCLIDEAN, criteria, None, 5)
+        except cv.error:
+            continue
+        if cc > best[0]:
+            best = (cc, warp)
+
+    if best[0] < 0:
+        raise Exception("Failed to align night on the accumulated stack")
+
+    transform = np.vstack([best[1], [0, 0, 1]]).astype(np.float64)
+    transform[:2, 2] *= downscale
+    return transform
+
+
+def warp(data: np.ndarray, transform: np.ndarray, shape: tuple, nearest: bool = False) -> np.ndarray:
+    """
+    Resamples every channel of `data` into the reference frame
+    """
+    h, w = shape[-2:]
+    flags = (cv.INTER_NEAREST if nearest else cv.INTER_LINEAR) | cv.WARP_INVERSE_MAP
+    return np.stack([
+        cv.warpPerspective(channel, transform, (w, h), flags=flags,
+                           borderMode=cv.BORDER_CONSTANT, borderValue=0)
+        for channel in data
+    ])
+
+
+class LightAccumulator:
+    def __init__(self,
+                 directory: str,
+                 sigma_low: float = 3,
+                 sigma_high: float = 3,
+                 aligner: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None
+                 ) -> None:
+        """
+        directory: where the accumulator state is kept, one per target
+        aligner: (reference, image) -> 3x3 transform, defaults to ecc_align
+        """
+        self.logger = Logger
+        self.directory = directory
+        self.sigma_low = sigma_low
+        self.sigma_high = sigma_high
+        self.aligner = aligner if aligner else ecc_align
+        self.state_file = os.path.join(directory, 'state.json')
+        self.total_file = os.path.join(directory, 'total.npz')
+        self.state: dict = {"shape": None, "reference": None, "nights": {}}
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.state = json.load(f)
+
+    def _save_state(self):
+        tmp = f"{self.state_file}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _night_file(self, night: str) -> str:
+        return os.path.join(self.directory, f"night_{night}.npz")
+
+    def nights(self) -> list[str]:
+        return list(self.state["nights"].keys())
+
+    def frames(self) -> int:
+        return sum([n["frames"] for n in self.state["nights"].values()])
+
+    def is_current(self, night: str, frames: list[str]) -> bool:
+        record = self.state["nights"].get(night)
+        return record is not None and record["fingerprint"] == frames_fingerprint(frames)
+
+    def _stack_night(self, frames: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Normalized, sigma clipped (count, mean, m2) of one night, computed a
+        band of rows at a time so a night never has to fit in memory at once
+        """
+        views = open_frames(frames)
+        try:
+            shape = views[0].shape
+
+            # addscale: every frame is brought to the reference location / scale
+            stats = [location_scale(view) for view in views]
+
+            if self.state["reference"] is None:
+                self.state["reference"] = {
+                    "loc": stats[0][0].tolist(), "scale": stats[0][1].tolist()}
+
+            ref_loc = np.array(self.state["reference"]["loc"], dtype=np.float32)
+            ref_scale = np.array(self.state["reference"]["scale"], dtype=np.float32)
+
+            channels, height, width = shape
+            n = np.zeros(shape, dtype=np.uint32)
+            mean = np.zeros(shape, dtype=np.float32)
+            m2 = np.zeros(shape, dtype=np.float32)
+
+            rows = max(1, BAND_MEMORY // (len(views) * channels * width * 4))
+            for y in range(0, height, rows):
+                band = np.stack([
+                    ((view[:, y:y + rows, :] - loc[:, None, None])
+                     * (ref_scale / scale)[:, None, None] + ref_loc[:, None, None])
+                    for view, (loc, scale) in zip(views, stats)
+                ])
+                band = sigma_reject(band, self.sigma_low, self.sigma_high)
+
+                count = np.sum(~np.isnan(band), axis=0)
+                band_mean = np.nanmean(band, axis=0)
+                n[:, y:y + rows, :] = count
+                mean[:, y:y + rows, :] = np.nan_to_num(band_mean)
+                m2[:, y:y + rows, :] = np.nan_to_num(
+                    np.nansum((band - band_mean) ** 2, axis=0))
+        finally:
+            for view in views:
+                view.close()
+
+        return n, mean, m2
+
+    def _load_total(self) -> Optional[tuple]:
+        if not os.path.isfile(self.total_file):
+            return None
+        with np.load(self.total_file) as total:
+            return total['n'], total['mean'], total['m2']
+
+    def _save_total(self, total: tuple):
+        n, mean, m2 = total
+        tmp = f"{self.total_file}.tmp.npz"
+        np.savez(tmp, n=n, mean=mean, m2=m2)
+        os.replace(tmp, self.total_file)
+
+    def _aligned(self, night: str) -> tuple:
+        record = self.state["nights"][night]
+        transform = np.array(record["transform"])
+        shape = tuple(self.state["shape"])
+
+        with np.load(self._night_file(night)) as partial:
+            n, mean, m2 = partial['n'], partial['mean'], partial['m2']
+
+        if np.allclose(transform, np.eye(3)):
+            return n, mean, m2
+
+        return (
+            warp(n.astype(np.float32), transform, shape, nearest=True).astype(np.uint32),
+            warp(mean, transform, shape),
+            warp(m2, transform, shape),
+        )
+
+    def add_night(self, night: str, frames: list[str], replace: bool = False):
+        """
+        Folds the registered frames of a night into the stack
+        """
+        if not frames:
+            raise Exception(f"No frames to accumulate for night {night}")
+
+        if night in self.state["nights"]:
+            if not replace:
+                raise Exception(f"Night {night} is already accumulated")
+            self.remove_night(night)
+
+        self.logger.info(
+            f"Accumulating {len(frames)} frames of night {night}")
+        n, mean, m2 = self._stack_night(frames)
+
+        total = self._load_total()
+        if total is None:
+            self.state["shape"] = list(mean.shape)
+            transform = np.eye(3)
+        else:
+            if list(mean.shape) != self.state["shape"]:
+                raise Exception(
+                    f"Night {night} is {mean.shape}, the accumulated stack is {tuple(self.state['shape'])}")
+            transform = self.aligner(
+                total[1][min(GREEN_CHANNEL, mean.shape[0] - 1)],
+                mean[min(GREEN_CHANNEL, mean.shape[0] - 1)])
+
+        np.savez(self._night_file(night), n=n, mean=mean, m2=m2)
+        self.state["nights"][night] = {
+            "frames": len(frames),
+            "fingerprint": frames_fingerprint(frames),
+            "transform": transform.tolist(),
+        }
+
+        aligned = self._aligned(night)
+        self._save_total(aligned if total is None else merge_partials(total, aligned))
+        self._save_state()
+
+        self.logger.info(
+            f"Accumulated night {night}: {self.frames()} frames over {len(self.nights())} nights")
+
+    def remove_night(self, night: str):
+        """
+        Drops a night and re-merges the partials of the others
+        """
+        self.state["nights"].pop(night, None)
+        if os.path.isfile(self._night_file(night)):
+            os.remove(self._night_file(night))
+
+        total = None
+        for other in self.nights():
+            aligned = self._aligned(other)
+            total = aligned if total is None else merge_partials(total, aligned)
+
+        if total is None:
+            self.state["shape"] = None
+            self.state["reference"] = None
+            if os.path.isfile(self.total_file):
+                os.remove(self.total_file)
+        else:
+            self._save_total(total)
+
+        self._save_state()
+
+    def render(self, out: str) -> str:
+        """
+        Writes the accumulated mean as a 32-bit FITS image in [0, 1]
+        """
+        total = self._load_total()
+        if total is None:
+            raise Exception("Nothing has been accumulated yet")
+
+        n, mean, _ = total
+        image = np.where(n > 0, mean, 0).astype(np.float32)
+        if image.max() > 1:
+            image /= 65535
+        image = np.clip(image, 0, 1)
+
+        header = fits.Header()
+        header['NCOMBINE'] = (self.frames(), 'Number of frames accumulated')
+        header['HISTORY'] = f"Accumulated nights: {', '.join(self.nights())}"
+
+        fits.PrimaryHDU(data=image if image.shape[0] > 1 else image[0], header=header)\
+            .writeto(out, overwrite=True)
+
+        self.logger.info(f"Rendered accumulated stack: {out}")
+        return out
@@ -0,0 +1,396 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Union
+
+import numpy as np
+import cv2 as cv
+from astropy.io import fits
+
+from ..sequence import FrameView, open_frame
+from ..logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Native stacking backend, a drop-in for Wrapper.stack
+
+Takes the same stack_params dicts as Siril (see stages.get_stack_params):
+
+    type            rej / mean, sum, med, min, max
+    rejection_type  s (sigma), w (winsorized sigma), l (linear fit), n (none)
+    sigma_low       lower rejection bound, in sigmas
+    sigma_high      upper rejection bound, in sigmas
+    norm            addscale, add, mul, scale, no
+    rgb_equal       equalize the background of the output channels
+    output_norm     rescale the output to [0, 1]
+    out             output file name, without extension
+
+The frames are normalized against the first one from per-channel median /
+MAD estimates, then stacked one spatial tile at a time across a process
+pool: frames are memory-mapped (see sequence.fitsmap), a worker only ever
+reads the tile it was given out of every frame. Tile-compressed frames are
+stacked in full-width bands instead, so every compression tile is
+decompressed once.
+
+filter_* parameters are not applied here, frame selection comes from the
+include flags of the .seq file (see sequence.included_frames).
+
+Frames of a sequence registered without output (REGISTER_NOOUT, there are
+no r_ frames) are given with their homographies: each worker resamples the
+tile it stacks out of the part of every frame it comes from. Pixels that no
+frame covers are left out of the combination (NaN).
+
+Usage:
+    frames = SequenceReader(process_dir, "pp_flats").frames()
+    StackEngine(frames, stack_params, workers=8).run(process_dir)
+
+    lights = SequenceReader(process_dir, "pp_lights")
+    StackEngine(lights.frames(), stack_params,
+                registration=lights.registration()).run(process_dir)
+"""
+
+TILE_SIZE = int(os.getenv('STACK_TILE_SIZE', 256))
+
+# Below this many samples a pixel is not rejected any further
+MIN_SAMPLES = 3
+MAX_ITERATIONS = 10
+
+# Lanczos reads 4 pixels on each side of a source position
+WARP_MARGIN = 5
+
+_worker: dict = {}
+
+
+def open_frames(frames: list[Union[str, FrameView]]) -> list[FrameView]:
+    """
+    Memory-maps every frame given as a file (FrameViews are used as is)
+    """
+    views = [f if isinstance(f, FrameView) else open_frame(f) for f in frames]
+
+    shape = views[0].shape
+    for view in views:
+        if view.shape != shape:
+            raise Exception(f"{view} is {view.shape}, expected {shape}")
+
+    return views
+
+
+def location_scale(data: Union[np.ndarray, FrameView], step: int = 8) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Per channel median and MAD, estimated on every `step`th pixel
+    """
+    sample = np.asarray(data[:, ::step, ::step], dtype=np.float32)
+    sample = sample.reshape(sample.shape[0], -1)
+    loc = np.median(sample, axis=1)
+    scale = np.median(np.abs(sample - loc[:, None]), axis=1)
+    return loc, np.maximum(scale, 1e-6)
+
+
+def normalization(norm: str, loc: np.ndarray, scale: np.ndarray, ref_loc: np.ndarray, ref_scale: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (gain, offset) per channel so that normalized = data * gain + offset
+    """
+    if norm == 'addscale':
+        gain = ref_scale / scale
+        return gain, ref_loc - loc * gain
+    if norm == 'add':
+        return np.ones_like(loc), ref_loc - loc
+    if norm == 'mul':
+        return ref_loc / np.maximum(loc, 1e-6), np.zeros_like(loc)
+    if norm == 'scale':
+        return ref_scale / scale, np.zeros_like(loc)
+    if norm in [None, 'no']:
+        return np.ones_like(loc), np.zeros_like(loc)
+
+    raise Exception(f"Unsupported stack normalization: {norm}")
+
+
+def _translation(x: float, y: float) -> np.ndarray:
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+
+def warp_tile(frame: FrameView, h: np.ndarray, tile: tuple[int, int, int, int]) -> np.ndarray:
+    """
+    Physical values of a tile of the reference, resampled from a frame that
+    h maps onto the reference (same interpolation as registration's r_
+    frames). Only the region of the frame the tile comes from is read,
+    pixels outside the frame are NaN
+    """
+    y0, y1, x0, x1 = tile
+    channels, height, width = frame.shape
+
+    corners = np.array([[[x0, y0], [x1, y0], [x0, y1], [x1, y1]]], dtype=np.float64)
+    source = cv.perspectiveTransform(corners, np.linalg.inv(h))[0]
+    sx0 = max(int(np.floor(source[:, 0].min())) - WARP_MARGIN, 0)
+    sx1 = min(int(np.ceil(source[:, 0].max())) + WARP_MARGIN + 1, width)
+    sy0 = max(int(np.floor(source[:, 1].min())) - WARP_MARGIN, 0)
+    sy1 = min(int(np.ceil(source[:, 1].max())) + WARP_MARGIN + 1, height)
+
+    if sx0 >= sx1 or sy0 >= sy1:
+        return np.full((channels, y1 - y0, x1 - x0), np.nan, dtype=np.float32)
+
+    region = frame[:, sy0:sy1, sx0:sx1]
+    # Pixels of the region -> pixels of the tile
+    m = _translation(-x0, -y0) @ h @ _translation(sx0, sy0)
+
+    warped = np.stack([
+        cv.warpPerspective(channel, m, (x1 - x0, y1 - y0),
+                           flags=cv.INTER_LANCZOS4, borderMode=cv.BORDER_CONSTANT, borderValue=np.nan)
+        for channel in region
+    ])
+    # Lanczos overshoots around stars
+    return np.clip(warped, region.min(), region.max())
+
+
+def _count(block: np.ndarray) -> np.ndarray:
+    return np.sum(~np.isnan(block), axis=0)
+
+
+def sigma_reject(block: np.ndarray, sigma_low: float, sigma_high: float) -> np.ndarray:
+    for _ in range(MAX_ITERATIONS):
+        median = np.nanmedian(block, axis=0)
+        sigma = np.nanstd(block, axis=0)
+        rejected = ((block < median - sigma_low * sigma) | (block > median + sigma_high * sigma)) \
+            & (_count(block) > MIN_SAMPLES)
+        if not rejected.any():
+            break
+        block[rejected] = np.nan
+
+    return block
+
+
+def winsorized_reject(block: np.ndarray, sigma_low: float, sigma_high: float) -> np.ndarray:
+    """
+    Sigma clipping with a sigma estimated on data winsorized at 1.5 sigma,
+    which is far less pulled by the outliers being rejected
+    """
+    for _ in range(MAX_ITERATIONS):
+        median = np.nanmedian(block, axis=0)
+        sigma = np.nanstd(block, axis=0)
+
+        for _ in range(MAX_ITERATIONS):
+            winsorized = np.clip(block, median - 1.5 * sigma,
+                                 median + 1.5 * sigma)
+            previous = sigma
+            sigma = 1.134 * np.nanstd(winsorized, axis=0)
+            if np.all(np.abs(sigma - previous) <= previous * 0.0005):
+                break
+
+        rejected = ((block < median - sigma_low * sigma) | (block > median + sigma_high * sigma)) \
+            & (_count(block) > MIN_SAMPLES)
+        if not rejected.any():
+            break
+        block[rejected] = np.nan
+
+    return block
+
+
+def linear_fit_reject(block: np.ndarray, sigma_low: float, sigma_high: float) -> np.ndarray:
+    """
+    Fits a line through the sorted samples of every pixel and rejects the
+    samples too far from it, the mean of what is left doesn't depend on
+    order so the block is kept sorted
+    """
+    index = np.arange(block.shape[0], dtype=np.float32).reshape(
+        (-1,) + (1,) * (block.ndim - 1))
+
+    for _ in range(MAX_ITERATIONS):
+        # NaNs sort last, the kept samples of a pixel are 0..n-1
+        block = np.sort(block, axis=0)
+        n = _count(block)
+        valid = index < n
+
+        x = np.where(valid, index, np.nan)
+        mean_x = (n - 1) / 2
+        mean_y = np.nanmean(block, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.nansum((x - mean_x) * (block - mean_y), axis=0) / \
+                np.nansum((x - mean_x) ** 2, axis=0)
+        slope = np.nan_to_num(slope)
+        fit = mean_y + slope * (index - mean_x)
+        sigma = np.nanmean(np.abs(block - fit), axis=0)
+
+        rejected = ((block < fit - sigma_low * sigma) | (block > fit + sigma_high * sigma)) \
+            & (n > MIN_SAMPLES)
+        if not rejected.any():
+            break
+        block[rejected] = np.nan
+
+    return block
+
+
+REJECTIONS = {
+    's': sigma_reject,
+    'w': winsorized_reject,
+    'l': linear_fit_reject,
+}
+
+
+def reject(block: np.ndarray, rejection_type: Optional[str], sigma_low: float, sigma_high: float) -> np.ndarray:
+    """
+    Rejected samples of a (frames, ...) block are replaced with NaN
+    """
+    if rejection_type in [None, 'n', 'none']:
+        return block
+    if rejection_type not in REJECTIONS:
+        raise Exception(f"Unsupported rejection type: {rejection_type}")
+
+    return REJECTIONS[rejection_type](block, sigma_low, sigma_high)
+
+
+def combine(block: np.ndarray, params: dict) -> np.ndarray:
+    stack_type = params.get('type', 'rej')
+
+    if stack_type in ['rej', 'mean']:
+        block = reject(block, params.get('rejection_type'),
+                       float(params.get('sigma_low', 3)),
+                       float(params.get('sigma_high', 3)))
+        return np.nan_to_num(np.nanmean(block, axis=0))
+    # Resampled frames don't cover every pixel of the reference
+    if stack_type == 'sum':
+        return np.nansum(block, axis=0)
+    if stack_type in ['med', 'median']:
+        return np.nan_to_num(np.nanmedian(block, axis=0))
+    if stack_type == 'min':
+        return np.nan_to_num(np.nanmin(block, axis=0))
+    if stack_type == 'max':
+        return np.nan_to_num(np.nanmax(block, axis=0))
+
+    raise Exception(f"Unsupported stack type: {stack_type}")
+
+
+def _init_worker(frames: list[FrameView], transforms: list[tuple[np.ndarray, np.ndarray]], params: dict, registration: list[Optional[np.ndarray]]):
+    _worker.update(frames=frames, transforms=transforms,
+                   params=params, registration=registration)
+
+
+def _read_tile(frame: FrameView, h: Optional[np.ndarray], tile: tuple[int, int, int, int]) -> np.ndarray:
+    y0, y1, x0, x1 = tile
+    if h is None:
+        return frame[:, y0:y1, x0:x1]
+    return warp_tile(frame, h, tile)
+
+
+def _stack_tile(tile: tuple[int, int, int, int]) -> tuple[tuple, np.ndarray]:
+    block = np.stack([
+        _read_tile(frame, h, tile) * gain[:, None, None] + offset[:, None, None]
+        for frame, h, (gain, offset) in zip(_worker['frames'], _worker['registration'], _worker['transforms'])
+    ])
+
+    with warnings.catch_warnings():
+        # Corners of the reference no resampled frame covers are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return tile, combine(block, _worker['params'])
+
+
+class StackEngine:
+    def __init__(self,
+                 frames: list[str],
+                 stack_params: dict,
+                 workers: Optional[int] = None,
+                 tile_size: int = TILE_SIZE,
+                 registration: Optional[list[Optional[np.ndarray]]] = None
+                 ) -> None:
+        """
+        frames: FITS files or FrameViews (ie: SequenceReader.frames()) to
+        stack, the first one is the normalization reference
+        stack_params: same dict as given to Wrapper.stack
+        registration: homography of each frame onto the reference (None for
+        frames used as they are), the frames are resampled while stacking
+        """
+        if registration is not None and len(registration) != len(frames):
+            raise Exception(
+                f"{len(registration)} registration transforms for {len(frames)} frames")
+
+        self.logger = Logger
+        self.frames = frames
+        self.params = stack_params
+        self.workers = workers if workers else int(
+            os.getenv('CPU_CORES', os.cpu_count()))
+        self.tile_size = tile_size
+        self.registration = registration if registration is not None else [None] * len(frames)
+
+    def _normalizations(self, frames: list[FrameView]) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        (gain, offset) per frame and channel, applied to physical values
+        """
+        stats = [location_scale(frame) for frame in frames]
+        ref_loc, ref_scale = stats[0]
+        return [normalization(self.params.get('norm', 'no'), loc, scale, ref_loc, ref_scale)
+                for loc, scale in stats]
+
+    def tiles(self, height: int, width: int, tile_rows: int = 0) -> list[tuple[int, int, int, int]]:
+        """
+        tile_size squares, or full-width bands of whole compression tiles
+        (tile_rows rows, see FrameView.tile_rows) about as large: a square
+        of a compressed frame decompresses every row it crosses in full,
+        once for each square along the row
+        """
+        if tile_rows:
+            rows = -(-max(self.tile_size ** 2 // width, 1) // tile_rows) * tile_rows
+            return [(y, min(y + rows, height), 0, width) for y in range(0, height, rows)]
+
+        return [(y, min(y + self.tile_size, height), x, min(x + self.tile_size, width))
+                for y in range(0, height, self.tile_size)
+                for x in range(0, width, self.tile_size)]
+
+    def stack(self) -> np.ndarray:
+        if not self.frames:
+            raise Exception("No frames to stack")
+
+        frames = open_frames(self.frames)
+        shape = frames[0].shape
+        integer = frames[0].integer
+        transforms = self._normalizations(frames)
+        for frame in frames:
+            frame.close()
+
+        tile_rows = int(np.lcm.reduce([frame.tile_rows for frame in frames if frame.compressed] or [0]))
+        tiles = self.tiles(shape[1], shape[2], tile_rows)
+        resampled = len([h for h in self.registration if h is not None])
+        self.logger.info(
+            f"Stacking {len(self.frames)} frames ({resampled} resampled) in {len(tiles)} tiles on {self.workers} workers")
+
+        result = np.zeros(shape, dtype=np.float32)
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(frames, transforms, self.params, self.registration)) as pool:
+            for (y0, y1, x0, x1), data in pool.map(_stack_tile, tiles):
+                result[:, y0:y1, x0:x1] = data
+
+        # Siril's 16-bit frames are in [0, 65535], its stacks in [0, 1]
+        if integer:
+            result /= 65535
+
+        return self._finish(result)
+
+    def _finish(self, result: np.ndarray) -> np.ndarray:
+        if self.params.get('rgb_equal') and result.shape[0] == 3:
+            medians = np.array([np.median(c[::8, ::8]) for c in result])
+            result += (medians.mean() - medians)[:, None, None]
+
+        if self.params.get('output_norm'):
+            low, high = result.min(), result.max()
+            if high > low:
+                result = (result - low) / (high - low)
+
+        return result
+
+    def run(self, process_dir: str, fits_extension: str = os.getenv('FITS_EXTENSION', 'fit')) -> str:
+        """
+        Stacks the frames and writes params["out"] in process_dir
+        """
+        result = self.stack()
+        out = os.path.join(
+            process_dir, f"{self.params['out']}.{fits_extension}")
+
+        header = fits.Header()
+        header['NCOMBINE'] = (len(self.frames), 'Number of frames stacked')
+        header['HISTORY'] = f"Stacked natively: {', '.join([f'{k}={v}' for k, v in self.params.items()])}"
+
+        fits.PrimaryHDU(data=result if result.shape[0] > 1 else result[0], header=header)\
+            .writeto(out, overwrite=True)
+
+        self.logger.info(f"Stacked {len(self.frames)} frames: {out}")
+        return out
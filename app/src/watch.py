@@ -0,0 +1,113 @@
+import os
+import argparse
+from datetime import datetime, timedelta
+
+from pysiril.siril import *  # type: ignore
+from pysiril.wrapper import *  # type: ignore
+
+from .siril import Frame, Session, FrameWatcher, SirilIngest
+from .pool import get_siril
+from .logger import Logger as _Logger
+
+Logger = _Logger(__name__)
+
+"""
+Converts and calibrates lights as they are shot
+
+Darks and flats (or the master library) have to be stacked beforehand, every
+new light is calibrated against the masters that exist when it lands.
+
+Usage:
+    poetry run python -m src.watch -d /siril-auto-stack/sample/pleiades-sm --until=06:00
+    poetry run python -m src.watch -d /siril-auto-stack/sample/m31 --night=3 --until=05:30
+"""
+
+
+def parse_until(value: str) -> float:
+    """
+    HH:MM today, or tomorrow when that time has already passed
+    """
+    hours, minutes = [int(v) for v in value.split(':')]
+    now = datetime.now()
+    until = now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+    if until <= now:
+        until += timedelta(days=1)
+    return until.timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d', '--workdir',
+                        required=True,
+                        type=str,
+                        dest="workdir",
+                        metavar="<working directory>",
+                        help="Directory with folders: lights, darks, etc...")
+
+    parser.add_argument('-n', '--night',
+                        required=False,
+                        type=str,
+                        default=None,
+                        dest="night",
+                        help="Night to ingest into for multi-night sessions")
+
+    parser.add_argument('--until',
+                        required=False,
+                        type=parse_until,
+                        default=None,
+                        dest="until",
+                        help="HH:MM at which to stop watching")
+
+    parser.add_argument('--settle',
+                        required=False,
+                        type=float,
+                        default=5,
+                        dest="settle",
+                        help="Seconds a raw has to stay unchanged before it is ingested")
+
+    args = parser.parse_args()
+
+    def frame(kind: str) -> Frame:
+        return Frame(
+            name=os.environ[f'{kind}_NAME'],
+            dir=os.environ[f'{kind}_DIR_NAME'],
+            process_dir=os.environ['PROCESS_DIR_NAME'],
+            stacked_prefix=os.environ[f'{kind}_STACKED_PREFIX'],
+        )
+
+    session = Session(
+        working_dir=args.workdir,
+        biases=frame('BIASES'),
+        darks=frame('DARKS'),
+        flats=frame('FLATS'),
+        lights=frame('LIGHTS'),
+        multiple=args.night is not None
+    )
+
+    lights = session.lights
+    directory = session.list_directories(lights)[0] if args.night is None else \
+        f"{args.workdir}/{lights.dir}/{os.environ['MULTINIGHT_DIR_NAME']}{args.night}"
+    os.makedirs(session.get_process_dir(lights), exist_ok=True)
+
+    App = get_siril()
+    siril = Wrapper(App)  # type: ignore
+
+    try:
+        App.Open()
+        siril.set16bits()
+        siril.setext(os.environ['FITS_EXTENSION'])
+        siril.setcpu(int(os.getenv('CPU_CORES', os.cpu_count())))
+
+        watcher = FrameWatcher(
+            session, lights,
+            processor=SirilIngest(siril, session, lights, directory),
+            directory=directory,
+            settle=args.settle)
+        watcher.run(until=args.until)
+    except Exception as e:
+        Logger.error(f"Error: {e}")
+        exit(1)
+    finally:
+        Logger.info("Siril Closed")
+        App.Close()
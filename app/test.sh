@@ -1,14 +1,16 @@
 #!/bin/bash
 clear
 
-BASE_DIR="/mnt/linux/Astrophotography_Photos/IC_1805_Heart_Nebula"
+export BASE_DIR="/mnt/linux/Astrophotography_Photos/IC_1805_Heart_Nebula"
 
 ISO=200
-DARK_DIR="Dark"
-FLAT_DIR="Flat"
-LIGHT_DIR="Light"
+export DARK_DIR="Dark"
+export FLAT_DIR="Flat"
+export LIGHT_DIR="Light"
 
-MASTER_BIAS_FILE="/home/stephen/siril-auto-stacker/masters/Canon_EOS_Rebel_T8i/biases/Canon_EOS_Rebel_T8i_${ISO}_stacked_bias.fit"
+export SIRIL_POOL_SOCKET="${SIRIL_POOL_SOCKET:-/tmp/siril-pool.sock}"
+
+export MASTER_BIAS_FILE="/home/stephen/siril-auto-stacker/masters/Canon_EOS_Rebel_T8i/biases/Canon_EOS_Rebel_T8i_${ISO}_stacked_bias.fit"
 
 function flats {
     poetry run python -m src.convert $BASE_DIR/$FLAT_DIR -fitseq
@@ -32,10 +34,13 @@ function darks {
 function lights {
     poetry run python -m src.convert $BASE_DIR/$LIGHT_DIR -fitseq
 
+    poetry run python -m src.screen $BASE_DIR/$LIGHT_DIR/process/lights.fit
+
     poetry run python -m src.calibrate \
         $BASE_DIR/$LIGHT_DIR/process/lights.fit \
         -f lights \
         -fitseq \
+        --selected \
         -F $BASE_DIR/$FLAT_DIR/process/stacked_pp_flats.fit \
         -D $BASE_DIR/$DARK_DIR/process/stacked_darks.fit
 
@@ -48,14 +53,38 @@ function lights {
         --frame="lights"
 }
 
+# flats, darks and lights in one process on one Siril (see recipe.json)
+function batch {
+    poetry run python -m src.batch recipe.json
+}
+
 function postprocess {
     poetry run python -m src.postprocess \
         $BASE_DIR/$LIGHT_DIR/process/stacked_r_pp_lights.fit \
         --target="NGC 651"
 }
 
-flats
-darks 
-lights
+# Synthetic sessions, compared with the last saved baseline
+function benchmark {
+    poetry run python -m src.benchmarks.pipeline \
+        --sizes 8x1500x1000 24x3000x2000 \
+        --nights=2 \
+        --baseline=benchmarks.json
+}
+
+function start_pool {
+    # Every stage below leases a warm Siril instead of starting its own
+    poetry run python -m src.pool.daemon --size=2 --socket=$SIRIL_POOL_SOCKET &
+    POOL_PID=$!
+    trap "kill $POOL_PID" EXIT
+
+    while [ ! -S $SIRIL_POOL_SOCKET ]; do
+        sleep 1
+    done
+}
+
+start_pool
+
+batch
 
 # postprocess
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from astropy.io import fits
+
+from src.siril import Frame, Session
+from src.siril import stages
+from src.sequence import frame_file, write_seq, write_image
+from src.stacking import accumulator
+
+"""
+Nights are folded into the accumulator one at a time: adding a night to a
+target stacks the frames of that night only
+
+Usage:
+    python -m unittest discover -s tests -t .
+"""
+
+ENV = {
+    'FITS_EXTENSION': 'fit',
+    'PREPROCESS_PREFIX': 'pp_',
+    'REGISTERED_PREFIX': 'r_',
+    'MULTINIGHT_DIR_NAME': 'night_',
+}
+
+
+def star_field(seed: int, size: int = 96) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    image = np.full((3, size, size), 1000, dtype=np.float32)
+    for cy, cx in np.random.default_rng(0).uniform(8, size - 8, (12, 2)):
+        image += 5000 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / 8)
+    return image + rng.normal(0, 10, image.shape).astype(np.float32)
+
+
+class AccumulateTest(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, ENV)
+        self.env.start()
+        os.environ.pop('REGISTER_NOOUT', None)
+        os.environ.pop('FITS_COMPRESSION', None)
+
+        self.working_dir = tempfile.mkdtemp()
+        self.lights = Frame(name='lights', dir='lights', process_dir='process', stacked_prefix='stacked_')
+        self.session = Session(biases=None, darks=None, flats=None, lights=self.lights,
+                               working_dir=self.working_dir, multiple=True)
+        self.process_dir = self.session.get_process_dir(self.lights)
+        os.makedirs(self.process_dir)
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.working_dir)
+
+    def register_night(self, night: str, frames: int) -> list[str]:
+        """
+        What registering the calibrated lights of a night leaves: r_pp_lights_{night}
+        """
+        sequence = f"r_pp_lights_{night}"
+        files = []
+        for index in range(1, frames + 1):
+            files.append(write_image(frame_file(self.process_dir, sequence, index, 'fit'),
+                                     star_field(int(night) * 100 + index)))
+        write_seq(self.process_dir, sequence, list(range(1, frames + 1)))
+        return files
+
+    def accumulate(self, nights: list[str]) -> list[str]:
+        """
+        Accumulates `nights`, returns the frames that were stacked
+        """
+        with mock.patch.object(accumulator, 'open_frames', wraps=accumulator.open_frames) as opened:
+            for night in nights:
+                stages.accumulate(self.session, self.lights, night)
+        return sum([call.args[0] for call in opened.call_args_list], [])
+
+    def test_adding_a_night_stacks_that_night_only(self):
+        night_1 = self.register_night("1", 3)
+        night_2 = self.register_night("2", 4)
+        self.assertEqual(sorted(self.accumulate(["1", "2"])), sorted(night_1 + night_2))
+
+        night_3 = self.register_night("3", 2)
+        self.assertEqual(sorted(self.accumulate(["1", "2", "3"])), sorted(night_3))
+        self.assertEqual(self.accumulate(["1", "2", "3"]), [])
+
+        out = stages.render_accumulation(self.session, self.lights, "stacked_lights_merged")
+        self.assertEqual(fits.getheader(out)['NCOMBINE'], 9)
+        self.assertEqual(stages.get_accumulator(self.session, self.lights).nights(), ["1", "2", "3"])
+
+    def test_changed_night_is_restacked(self):
+        self.register_night("1", 3)
+        self.register_night("2", 3)
+        self.accumulate(["1", "2"])
+
+        night_2 = self.register_night("2", 4)
+        self.assertEqual(sorted(self.accumulate(["1", "2"])), sorted(night_2))
+        self.assertEqual(stages.get_accumulator(self.session, self.lights).frames(), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+from astropy.io import fits
+
+from src.graxpert import GraXpertWorker, output_file
+
+"""
+GraXpertWorker with the stand-in runner: results come back from the worker
+process, a killed worker is started again and a job that takes too long
+kills it
+
+Usage:
+    python -m unittest discover -s tests -t .
+"""
+
+# Seconds every stand-in job takes in the tests that need a job in flight
+DELAY = 2
+
+
+class GraXpertWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, {'GRAXPERT_RUNNER': 'stand-in', 'GRAXPERT_STAND_IN_DELAY': '0'})
+        self.env.start()
+
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'starless.fit')
+        image = np.random.default_rng(0).normal(1000, 10, (3, 32, 48)).astype(np.float32)
+        fits.PrimaryHDU(image).writeto(self.file)
+        self.worker: GraXpertWorker = None  # type: ignore
+
+    def tearDown(self):
+        if self.worker is not None:
+            self.worker.stop()
+        self.env.stop()
+        shutil.rmtree(self.directory)
+
+    def start(self, delay: float = 0, timeout: float = 60) -> GraXpertWorker:
+        os.environ['GRAXPERT_STAND_IN_DELAY'] = str(delay)
+        self.worker = GraXpertWorker(timeout=timeout)
+        self.assertEqual(self.worker.runner, 'stand-in')
+        return self.worker
+
+    def test_submit_and_run(self):
+        worker = self.start()
+
+        future = worker.submit(self.file, "background-extraction", ["-smoothing", "0.1", "-bg"])
+        self.assertEqual(future.result(30), output_file(self.file))
+        self.assertTrue(os.path.isfile(output_file(self.file)))
+        os.remove(output_file(self.file))
+
+        self.assertEqual(worker.run(self.file, "denoising"), output_file(self.file))
+        self.assertTrue(os.path.isfile(output_file(self.file)))
+
+    def test_run_retries_on_a_new_worker_after_kill(self):
+        worker = self.start(delay=DELAY)
+        worker.start()
+        pid = worker.process.pid  # type: ignore
+
+        # Killed while the job is in flight
+        killer = threading.Timer(DELAY / 4, worker.kill)
+        killer.start()
+        self.assertEqual(worker.run(self.file, "denoising"), output_file(self.file))
+        killer.join()
+
+        self.assertTrue(worker.alive())
+        self.assertNotEqual(worker.process.pid, pid)  # type: ignore
+        self.assertEqual(worker.restarts, 1)
+
+    def test_timeout_kills_the_worker(self):
+        worker = self.start(delay=DELAY, timeout=DELAY / 4)
+        worker.start()
+        process = worker.process
+
+        with self.assertRaisesRegex(Exception, "timed out"):
+            worker.run(self.file, "denoising")
+
+        process.wait(10)  # type: ignore
+        self.assertIsNotNone(process.poll())  # type: ignore
+        self.assertFalse(worker.alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
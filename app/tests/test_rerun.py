@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.siril import Frame, Session
+from src.pipeline import session as pipeline
+from src.pipeline import SessionPipeline
+
+"""
+A second run of the pipeline, once convert deleted the raws, matches the
+masters on the camera saved by the first run and skips every stage, unless
+a setting of the stages changed
+
+Siril is replaced by stand-ins that write the files each stage would.
+
+Usage:
+    python -m unittest discover -s tests -t .
+"""
+
+ENV = {
+    'FITS_EXTENSION': 'fit',
+    'PREPROCESS_PREFIX': 'pp_',
+    'REGISTERED_PREFIX': 'r_',
+    'MULTINIGHT_DIR_NAME': 'night_',
+    'SCREEN_LIGHTS': '0',
+}
+
+CAMERA = {'path': 'IMG_0001.cr3', 'model': 'Canon_EOS_Rebel_T8i', 'iso': 800,
+          'exposure': 120.0, 'temperature': 18.0, 'timestamp': '2023-10-14T22:01:13', 'tags': {}}
+
+
+def touch(file: str, content: str = "frame"):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'w') as f:
+        f.write(content)
+
+
+class RerunTest(unittest.TestCase):
+    def setUp(self):
+        self.env = mock.patch.dict(os.environ, ENV)
+        self.env.start()
+        os.environ.pop('REGISTER_NOOUT', None)
+        os.environ.pop('FITS_COMPRESSION', None)
+
+        self.working_dir = tempfile.mkdtemp()
+        self.bias_master = os.path.join(self.working_dir, 'library', 'bias_iso800.fit')
+        touch(self.bias_master)
+
+        for name in ['darks', 'flats', 'lights']:
+            for i in range(1, 3):
+                touch(f"{self.working_dir}/{name}/IMG_000{i}.cr3", "raw")
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.working_dir)
+
+    def session(self) -> Session:
+        frames = [Frame(name=name, dir=name, process_dir='process', stacked_prefix='stacked_')
+                  for name in ['biases', 'darks', 'flats', 'lights']]
+        return Session(*frames, working_dir=self.working_dir)
+
+    def run_pipeline(self) -> tuple[SessionPipeline, list[dict]]:
+        """
+        A new Session every time, nothing is remembered in memory between runs
+        """
+        session = self.session()
+        cameras = []
+
+        def metadata(frame, night=""):
+            raws = sorted(f for f in os.listdir(session.get_directory(frame, night)) if f.endswith('.cr3'))
+            return [dict(CAMERA, path=f) for f in raws]
+
+        def library_file(type, light, night, camera):
+            cameras.append(camera)
+            return self.bias_master
+
+        def convert_night(siril, session, frame, directory, delete_raws=False):
+            touch(f"{session.get_process_dir(frame)}/{frame.name}_00001.fit")
+            if delete_raws:
+                for f in os.listdir(directory):
+                    if f.endswith('.cr3'):
+                        os.remove(os.path.join(directory, f))
+            return True
+
+        def calibrate(siril, session, frame, night):
+            touch(f"{session.get_process_dir(frame)}/pp_{frame.name}_00001.fit")
+            return True
+
+        def register(siril, session, frame, sequence):
+            touch(f"{session.get_process_dir(frame)}/r_{sequence}_00001.fit")
+
+        def stack(siril, session, frame, sequence, out):
+            touch(f"{session.get_process_dir(frame)}/{out}.fit")
+
+        with mock.patch.object(session, 'get_metadata', side_effect=metadata), \
+                mock.patch('src.siril.session.get_library_file', side_effect=library_file), \
+                mock.patch.object(pipeline, 'lease_instance', return_value=(mock.Mock(), mock.Mock())), \
+                mock.patch.object(pipeline, 'convert_night', convert_night), \
+                mock.patch.object(pipeline, 'calibrate', calibrate), \
+                mock.patch.object(pipeline.stages, 'register', register), \
+                mock.patch.object(pipeline.stages, 'stack', stack):
+            runner = SessionPipeline(session, delete_raws=True, cpu_budget=4, ram_budget=8)
+            runner.run()
+
+        return runner, cameras
+
+    def test_rerun_without_raws(self):
+        first, cameras = self.run_pipeline()
+        self.assertFalse(any(node.cached for node in first.pipeline.nodes.values()))
+        self.assertEqual(os.listdir(f"{self.working_dir}/lights"), ['process'])
+        self.assertEqual(cameras[0]['iso'], 800)
+
+        second, cameras = self.run_pipeline()
+        self.assertTrue(all(node.cached for node in second.pipeline.nodes.values()))
+        self.assertEqual(cameras[0]['iso'], 800)
+
+    def test_changed_settings_without_raws(self):
+        self.run_pipeline()
+
+        os.environ['FITS_COMPRESSION'] = 'rice'
+        second, _ = self.run_pipeline()
+        converts = [node for name, node in second.pipeline.nodes.items() if name.startswith('convert:')]
+        self.assertTrue(converts)
+        self.assertFalse(any(node.cached for node in converts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.siril import Frame, Session
+from src.siril.watch import FrameWatcher, INGEST_STATE_FILE_NAME
+
+"""
+Raws copied into a watched directory are ingested once they stop changing,
+in order, and a restarted watcher carries on where the last one stopped
+
+The clock of the watcher is driven by the test, the processor only records
+what it is given.
+
+Usage:
+    python -m unittest discover -s tests -t .
+"""
+
+SETTLE = 5
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.working_dir, 'lights')
+        os.makedirs(self.directory)
+
+        self.lights = Frame(name='lights', dir='lights', process_dir='process', stacked_prefix='stacked_')
+        self.session = Session(biases=None, darks=None, flats=None, lights=self.lights,
+                               working_dir=self.working_dir)
+
+        self.now = 0.0
+        self.clock = mock.patch('src.siril.watch.time.monotonic', side_effect=lambda: self.now)
+        self.clock.start()
+
+    def tearDown(self):
+        self.clock.stop()
+        shutil.rmtree(self.working_dir)
+
+    def watcher(self) -> tuple[FrameWatcher, list[tuple[str, int]]]:
+        processed = []
+        watcher = FrameWatcher(self.session, self.lights,
+                               processor=lambda raw, index: processed.append((os.path.basename(raw), index)),
+                               directory=self.directory, settle=SETTLE)
+        return watcher, processed
+
+    def write(self, name: str, content: bytes, mtime: float):
+        path = os.path.join(self.directory, name)
+        with open(path, 'ab') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def wait(self, seconds: float):
+        self.now += seconds
+
+    def test_growing_file_waits_until_settled(self):
+        watcher, processed = self.watcher()
+
+        self.write('IMG_0001.CR3', b'first half', mtime=1000)
+        self.assertEqual(watcher.poll(), [])
+
+        # Still being written: the size and mtime change, the wait starts over
+        self.wait(SETTLE)
+        self.write('IMG_0001.CR3', b' second half', mtime=1001)
+        self.assertEqual(watcher.poll(), [])
+
+        self.wait(SETTLE - 1)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(processed, [])
+
+        self.wait(1)
+        self.assertEqual(len(watcher.poll()), 1)
+        self.assertEqual(processed, [('IMG_0001.CR3', 1)])
+
+    def test_indices_in_order(self):
+        watcher, processed = self.watcher()
+
+        for i, name in enumerate(['IMG_0002.CR3', 'IMG_0001.CR3', 'IMG_0003.CR3']):
+            self.write(name, b'raw', mtime=1000 + i)
+        watcher.poll()
+        self.wait(SETTLE)
+        watcher.poll()
+
+        self.write('IMG_0004.CR3', b'raw', mtime=1010)
+        watcher.poll()
+        self.wait(SETTLE)
+        watcher.poll()
+
+        self.assertEqual(processed, [('IMG_0001.CR3', 1), ('IMG_0002.CR3', 2),
+                                     ('IMG_0003.CR3', 3), ('IMG_0004.CR3', 4)])
+
+    def test_restart_continues_from_state(self):
+        watcher, processed = self.watcher()
+        for i, name in enumerate(['IMG_0001.CR3', 'IMG_0002.CR3']):
+            self.write(name, b'raw', mtime=1000 + i)
+        watcher.poll()
+        self.wait(SETTLE)
+        watcher.poll()
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, INGEST_STATE_FILE_NAME)))
+
+        restarted, processed = self.watcher()
+        self.assertEqual(restarted.next_index(), 3)
+
+        self.write('IMG_0003.CR3', b'raw', mtime=1010)
+        restarted.poll()
+        self.wait(SETTLE)
+        restarted.poll()
+
+        # Raws ingested before the restart are not processed again
+        self.assertEqual(processed, [('IMG_0003.CR3', 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
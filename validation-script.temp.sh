@@ -21,35 +21,29 @@ function get_first_image_in_path(){ echo $1/$(ls $1 | grep "cr2" | head -1);}
 
 # Grabs the first (head) file in given directory
 # and extracts the relevant exif tags. It then
-# iterates over all other sibling files and compares
-# them; ensuring they match.
+# compares every other sibling file against it,
+# all files read in a single exiftool run.
 # verify_exif_values_match $file
 function verify_exif_values_match(){
-  FILES=$(get_raw_files_in_path $(dirname $1))
-  EXIF_TAGS=("-s2 -ShootingMode -ExposureMode -ImageSize -LensID -Quality -ISO -FocalLength -Aperture -ShutterSpeed")
-  EXIF_CHECK=$(sed "s/:\ /:/g" <<< "$(exiftool $EXIF_TAGS "$1")")
+  DIR=$(dirname $1)
+  EXIF_TAGS=(-ShootingMode -ExposureMode -ImageSize -LensID -Quality -ISO -FocalLength -Aperture -ShutterSpeed)
+  # One tab separated row per file: file name, then the tags
+  ROWS=$(exiftool -q -T -FileName "${EXIF_TAGS[@]}" -ext cr2 "$DIR")
+  EXIF_CHECK=$(grep -P "^$(basename $1)\t" <<< "$ROWS" | cut -f2-)
 
   c=0
-  for f in $FILES; do
-      t=$(sed "s/:\ /:/g" <<< "$(exiftool $EXIF_TAGS "$(dirname $1)/$f")")
-      echo ${EXIF_CHECK[@]} > /tmp/stacklisttwo
-      echo "" > /tmp/stacklistone
-      comp1="$(comm -23 <(sort /tmp/stacklistone) <(sort /tmp/stacklisttwo))"
-      comp2="$(comm -23 <(sort /tmp/stacklistone) <(sort /tmp/stacklisttwo))"
-      echo "${comp1+x}"
-      echo "${comp2+x}"
-      if [ -z $comp1 ] || [ -z $comp2 ]; then
+  total=0
+  while IFS=$'\t' read -r f t; do
+      total=$((total+1))
+      if [ "$t" != "$EXIF_CHECK" ]; then
         warn "Settings Mismatch: $f"
-        # echo ${EXIF_CHECK[@]} ${t[@]} | tr ' ' '\n' | sort | uniq -u | tr '\n' ' '
-        echo ''
-        c=$((c+1)) 
+        c=$((c+1))
       fi
-  done
+  done <<< "$ROWS"
 
   if [ "$c" != 0 ]; then
     warn "$c $1 files mismatched"
   else
-    total=$(wc -w <<< "$FILES")
     pass "$total .CR2 files checked"
   fi
 }